@@ -0,0 +1,322 @@
+"""
+"archive.py" Archive files as virtual folders
+
+Photos are often found inside zip and 7z archives, such as Google Takeout exports. Rather than
+extracting every archive to disk and reading the extracted files back, an archive is listed like
+a folder: each member becomes an ArchiveMember, a File identified as "archive_path!member_name",
+whose content is streamed from the archive straight into the hasher. A member is only written to
+disk when it is actually wanted in the collection, typically because it is unique.
+
+A zip archive is kept open while its members are read, its central directory being parsed
+once; a few dozen zip archives at most are kept open at a time.
+
+zipfile and py7zr, slow to import, are only imported once an archive is opened.
+"""
+import hashlib
+import os
+import sys
+import threading
+
+import metadata
+from hashers import DEFAULT_HASHER
+from tools import File, Error, PARTIAL_HASH_BLOCK, METADATA_BLOCK
+
+ARCHIVE_EXTS = ('.zip', '.7z')
+MEMBER_SEP = '!'
+
+# Zip archives kept open at a time, least recently used first
+OPEN_ARCHIVES = 32
+_open_archives: {'Archive': None} = {}
+_open_lock = threading.Lock()
+
+
+def is_archive(file_name) -> bool:
+    return os.path.splitext(file_name)[1].lower() in ARCHIVE_EXTS
+
+
+def find_file(path, archives: {str: {str: 'ArchiveMember'}}) -> File | None:
+    """Return a File for a path recorded earlier and still found on disk, or an ArchiveMember
+    for one still found in its archive; archives caches the members of the archives listed"""
+    try:
+        if os.path.isfile(path):
+            return File.from_stats(path, os.stat(path))
+    except OSError:
+        return None
+    # The archive path ends at one of the separators
+    start = 0
+    while (end := path.find(MEMBER_SEP, start)) >= 0:
+        archive_path = path[:end]
+        if is_archive(archive_path) and os.path.isfile(archive_path):
+            if archive_path not in archives:
+                archives[archive_path] = {x.file_path: x for x in
+                                          Archive(archive_path).members()}
+            return archives[archive_path].get(path)
+        start = end + 1
+    return None
+
+
+class _Digest:
+    """Writable sink computing the hash, partial hash and metadata of the content written to it
+
+    Also usable as a py7zr writer for a member extracted through a writer factory. The member's
+    hasher, if given, sets the hash algorithm.
+    """
+    def __init__(self, member: 'ArchiveMember' = None):
+        self._hasher = member.hasher if member is not None else DEFAULT_HASHER
+        self._full = self._hasher.new()
+        self._size = 0
+        self._head = b''
+        self._tail = b''
+
+    def write(self, data) -> int:
+        self._full.update(data)
+        self._size += len(data)
+        if len(self._head) < METADATA_BLOCK:
+            self._head += data[:METADATA_BLOCK - len(self._head)]
+        self._tail = (self._tail + data)[-PARTIAL_HASH_BLOCK:]
+        return len(data)
+
+    def read(self, size=None) -> bytes:
+        return b''
+
+    def seek(self, offset, whence=0) -> int:
+        return 0
+
+    def flush(self):
+        pass
+
+    def size(self) -> int:
+        return self._size
+
+    def close(self):
+        pass
+
+    def finish(self, member):
+        """Give the member its hash values, matching those File computes from a file on disk"""
+        cached = member._hash is not None
+        member._hash = self._full.hexdigest()
+        if self._size > 2 * PARTIAL_HASH_BLOCK:
+            member._partial_hash = self._hasher.new(self._head[:PARTIAL_HASH_BLOCK]
+                                                    + self._tail).hexdigest()
+        else:
+            member._partial_hash = member._hash
+        member._exif = metadata.parse(self._head)
+        if member._metrics is not None:
+            member._counted_hash(self._size)
+        if member._cache is not None and not cached:
+            member._cache.put(member, member._hash)
+
+
+class _FileWriter(_Digest):
+    """py7zr writer that saves a member to a file"""
+    def __init__(self, file_path, member: 'ArchiveMember' = None):
+        super().__init__(member)
+        self._file = open(file_path, 'wb')
+
+    def write(self, data) -> int:
+        self._file.write(data)
+        return super().write(data)
+
+    def close(self):
+        self._file.close()
+
+
+class _Factory:
+    """py7zr writer factory handing out the writer prepared for each member"""
+    def __init__(self, writers: {str: _Digest}):
+        self.writers = writers
+
+    def create(self, filename):
+        return self.writers.get(filename) or _Digest()
+
+
+class Archive:
+    """A zip or 7z archive file listed as a folder of ArchiveMember files
+
+    A zip archive stays open once listed or read, until closed -- as on leaving a with block --
+    or until more than OPEN_ARCHIVES others were opened since.
+    """
+    def __init__(self, archive_path):
+        self.archive_path = os.path.abspath(archive_path)
+        self.ext = os.path.splitext(archive_path)[1].lower()
+        self.stats = os.stat(self.archive_path)
+        self._lock = threading.Lock()
+        self._members: {str: ArchiveMember} = {}
+        self._zip = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the zip archive, if open; it is opened again when next read"""
+        with self._lock, _open_lock:
+            self._close_zip()
+
+    def _close_zip(self):
+        """Called holding both the archive's lock and _open_lock"""
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+            _open_archives.pop(self, None)
+
+    def _zip_file(self):
+        """Return the open zip archive, opening it if needed; called holding the lock"""
+        if self._zip is None:
+            import zipfile
+            self._zip = zipfile.ZipFile(self.archive_path)
+        with _open_lock:
+            _open_archives.pop(self, None)
+            _open_archives[self] = None
+            for archive in list(_open_archives)[:-OPEN_ARCHIVES]:
+                # An archive being read by another thread is left open for now
+                if archive._lock.acquire(blocking=False):
+                    try:
+                        archive._close_zip()
+                    finally:
+                        archive._lock.release()
+        return self._zip
+
+    def members(self) -> ['ArchiveMember']:
+        """List the files held by the archive; an unreadable archive is reported and has none"""
+        if not self._members:
+            import zipfile
+            errors = (OSError, zipfile.BadZipFile)
+            try:
+                if self.ext == '.zip':
+                    with self._lock:
+                        listing = [(x.filename, x.file_size) for x in self._zip_file().infolist()
+                                   if not x.is_dir()]
+                else:
+                    import py7zr
+                    errors += (py7zr.Bad7zFile,)
+                    with py7zr.SevenZipFile(self.archive_path) as z:
+                        listing = [(x.filename, x.uncompressed) for x in z.list()
+                                   if not x.is_directory]
+            except errors as exc:
+                Error(f"Archive {self.archive_path} -- {exc}", exit=False)
+                return []
+            for name, size in listing:
+                self._members[name] = ArchiveMember(self, name, size)
+        return list(self._members.values())
+
+    def read(self, member: 'ArchiveMember'):
+        """Stream a member's content through the hasher
+
+        Zip members are read individually. A 7z archive is usually compressed as one solid
+        block, so reading any member decompresses those before it anyway: all members not yet
+        read are hashed in that same pass.
+        """
+        with self._lock:
+            if member._exif is not None:
+                return
+            if self.ext == '.zip':
+                digest = _Digest(member)
+                with self._zip_file().open(member.member_name) as f:
+                    while block := f.read(METADATA_BLOCK):
+                        digest.write(block)
+                digest.finish(member)
+                return
+            import py7zr
+            writers = {name: _Digest(x) for name, x in self._members.items() if x._exif is None}
+            with py7zr.SevenZipFile(self.archive_path) as z:
+                z.extract(targets=list(writers), factory=_Factory(writers))
+            for name, digest in writers.items():
+                digest.finish(self._members[name])
+
+    def extract(self, member: 'ArchiveMember', dst_path):
+        """Write a member's content to the file dst_path, hashing it on the way"""
+        with self._lock:
+            if self.ext == '.zip':
+                digest = _Digest(member)
+                with self._zip_file().open(member.member_name) as f, open(dst_path, 'wb') as dst:
+                    while block := f.read(METADATA_BLOCK):
+                        dst.write(block)
+                        digest.write(block)
+            else:
+                import py7zr
+                digest = _FileWriter(dst_path, member)
+                with py7zr.SevenZipFile(self.archive_path) as z:
+                    z.extract(targets=[member.member_name],
+                              factory=_Factory({member.member_name: digest}))
+            if member._exif is None:
+                digest.finish(member)
+
+
+class ArchiveMember(File):
+    """A file within an archive, identified by the path "archive_path!member_name"
+
+    Size and stats come from the archive listing; the device, inode and modification time are
+    those of the archive file itself, so a cached hash stays valid while the archive is unchanged.
+    """
+    __slots__ = ('archive', 'member_name')
+
+    def __init__(self, archive: Archive, member_name: str, size: int):
+        super().__init__(archive.archive_path)
+        self.archive = archive
+        self.member_name = member_name
+        dir_path, self.file_name = os.path.split(
+            f'{archive.archive_path}{MEMBER_SEP}{member_name}')
+        self.dir_path = sys.intern(dir_path)
+        self.ext = os.path.splitext(self.file_name)[1]
+        self._exists = True
+        self._is_file = True
+        self._is_dir = False
+        stats = archive.stats
+        self._stats = os.stat_result(
+            (stats.st_mode, stats.st_ino, stats.st_dev, 1, stats.st_uid, stats.st_gid, size,
+             stats.st_atime, stats.st_mtime, stats.st_ctime),
+            {'st_mtime_ns': stats.st_mtime_ns})
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            if self._cache is not None:
+                self._hash = self._cache.get(self)
+                if self._metrics is not None:
+                    self._metrics.count('cache_misses' if self._hash is None else 'cache_hits')
+            if self._hash is None:
+                self.archive.read(self)
+        return self._hash
+
+    @property
+    def partial_hash(self):
+        if self._partial_hash is None:
+            self.archive.read(self)
+        return self._partial_hash
+
+    def scan(self):
+        self.archive.read(self)
+
+    def extract(self, dst_dir) -> str:
+        """Extract the member under dst_dir, in a folder named for the archive; return its path
+
+        The folder name ends with a short hash of the archive path, so that archives of the same
+        name in different folders, such as Takeout exports, are not extracted over each other.
+        """
+        parts = self.member_name.replace('\\', '/').split('/')
+        parts = [x for x in parts if x not in ('', '.', '..')]
+        archive_path = self.archive.archive_path
+        key = hashlib.sha1(os.fsencode(archive_path)).hexdigest()[:8]
+        dst_path = os.path.join(dst_dir, f'{os.path.basename(archive_path)}-{key}', *parts)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        self.archive.extract(self, dst_path)
+        return dst_path
+
+    def copy_to(self, dst_path):
+        """Extract the member to a destination file path, or into a destination folder"""
+        if os.path.isdir(dst_path):
+            dst_path = os.path.join(dst_path, self.file_name)
+        try:
+            self.archive.extract(self, dst_path)
+        except PermissionError:
+            Error(f"Copy {self.file_name} to {dst_path} -- no permission")
+        except KeyboardInterrupt:
+            # Passed on for the run to end gracefully, as File.copy_to does
+            if os.path.isfile(dst_path):
+                os.remove(dst_path)
+            raise
+        except Exception as exc:
+            Error(f"Copy {self.file_name} to {dst_path} -- {exc}")
@@ -0,0 +1,157 @@
+"""
+"archive_engine.py" Parallel extraction of archives, nested archives included
+
+Archive members are usually read in place (see archive.py), but some work needs archives
+unpacked on disk, and Google Takeout exports hold zips inside zips, which are only reached by
+unpacking the outer ones. The ArchiveEngine unpacks many archives at once on a process pool,
+decompression being CPU bound, then looks for archives among the files unpacked and unpacks
+those in turn, down to a depth limit.
+
+Unpacked archives are kept in a cache folder, one folder per archive named by its content hash:
+    <cache_dir>/<hash algorithm>/<hash>/...
+so an archive unpacked on an earlier run, or found again under another name or in another
+archive, is never unpacked twice. An archive is unpacked into a temporary folder renamed into
+place once complete, so the cache never holds a partly unpacked archive.
+"""
+import os
+import shutil
+
+from archive import is_archive, MEMBER_SEP
+from hash_cache import HashCache
+from hash_pool import HashPool
+from hashers import Hasher, DEFAULT_ALGORITHM
+from tools import File, Error, unpack_archive
+
+# Levels of archives within archives unpacked below the archives given
+MAX_DEPTH = 4
+
+TEMP_DIR_NAME = '.tmp'
+
+
+def _unpack(archive_path, dst_dir) -> str | None:
+    """Unpack an archive into dst_dir, in a worker process; return an error message on failure"""
+    try:
+        unpack_archive(archive_path, dst_dir)
+    except Exception as exc:
+        shutil.rmtree(dst_dir, ignore_errors=True)
+        return str(exc) or type(exc).__name__
+    return None
+
+
+class ArchiveEngine:
+    """Unpacks archives, and the archives found in them, into a cache keyed by content hash
+
+    cache_dir   -- folder of the unpacked archives, kept between runs
+    jobs        -- number of archives unpacked at the same time, each by a process
+    max_depth   -- levels of nested archives unpacked below the archives given
+    hash_cache  -- HashCache, or the path of its database file, sparing hashing unchanged
+                   archives again on later runs
+    algorithm   -- hash algorithm naming the unpacked folders
+    """
+    def __init__(self, cache_dir: str, jobs: int = None, max_depth: int = MAX_DEPTH,
+                 hash_cache: str | HashCache = None, algorithm: str = DEFAULT_ALGORITHM):
+        self.hasher = Hasher(algorithm)
+        self.cache_dir = os.path.join(os.path.abspath(cache_dir), algorithm)
+        self.temp_dir = os.path.join(self.cache_dir, TEMP_DIR_NAME)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_depth = max_depth
+        if isinstance(hash_cache, str):
+            hash_cache = HashCache(hash_cache)
+        self.hash_cache = hash_cache
+        self.unpacked = 0       # Archives unpacked, rather than found in the cache
+        self._dirs: {str: str | None} = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.hash_cache is not None:
+            self.hash_cache.flush()
+
+    def unpack(self, archive_paths: [str]) -> {str: str | None}:
+        """Unpack archives, then the archives found in them down to max_depth levels; return the
+        folder holding the content of each archive, nested ones included, or None for those
+        that could not be unpacked"""
+        level = [os.path.abspath(x) for x in archive_paths]
+        for depth in range(self.max_depth + 1):
+            level = [x for x in dict.fromkeys(level) if x not in self._dirs]
+            if not level:
+                break
+            self._unpack_level(level)
+            if depth < self.max_depth:
+                level = [x for path in level if self._dirs[path] is not None
+                         for x in self._archives_in(self._dirs[path])]
+        return dict(self._dirs)
+
+    def _unpack_level(self, archive_paths: [str]):
+        """Hash archives, and unpack on the process pool those not in the cache, each content
+        once"""
+        files = []
+        for path in archive_paths:
+            file = File(path)
+            file._hasher = self.hasher
+            file._cache = self.hash_cache
+            files.append(file)
+        pending: {str: str} = {}
+        for file, digest in zip(files, HashPool(self.jobs).map(files)):
+            dst_dir = os.path.join(self.cache_dir, digest[:2], digest)
+            self._dirs[file.file_path] = dst_dir
+            if not os.path.isdir(dst_dir):
+                pending.setdefault(dst_dir, file.file_path)
+        if not pending:
+            return
+        from concurrent.futures import ProcessPoolExecutor
+        failed = set()
+        with ProcessPoolExecutor(min(self.jobs, len(pending))) as executor:
+            futures = {}
+            for dst_dir, path in pending.items():
+                temp_path = os.path.join(self.temp_dir,
+                                         f'{os.path.basename(dst_dir)}.{os.getpid()}')
+                shutil.rmtree(temp_path, ignore_errors=True)
+                futures[dst_dir] = (path, temp_path, executor.submit(_unpack, path, temp_path))
+            for dst_dir, (path, temp_path, future) in futures.items():
+                error = future.result()
+                if error is not None:
+                    Error(f"Archive {path} -- {error}", exit=False)
+                    failed.add(dst_dir)
+                    continue
+                os.makedirs(os.path.dirname(dst_dir), exist_ok=True)
+                try:
+                    os.rename(temp_path, dst_dir)
+                except OSError:
+                    # Unpacked meanwhile by another run
+                    shutil.rmtree(temp_path, ignore_errors=True)
+                else:
+                    self.unpacked += 1
+        for path, dst_dir in self._dirs.items():
+            if dst_dir in failed:
+                self._dirs[path] = None
+
+    @staticmethod
+    def _archives_in(dir_path) -> [str]:
+        return [os.path.join(parent, name) for parent, _, names in os.walk(dir_path)
+                for name in sorted(names) if is_archive(name)]
+
+    def files(self, archive_path: str, depth: int = 0):
+        """Generate the files held by an unpacked archive, as (virtual path, path on disk)
+        pairs; the virtual path of a file in an archive within archives chains the archive
+        names, as in "outer.zip!inner.zip!photo.jpg". Archives unpacked are replaced by their
+        files."""
+        archive_path = os.path.abspath(archive_path)
+        dir_path = self._dirs.get(archive_path)
+        if dir_path is None:
+            return
+        for parent, dirs, names in os.walk(dir_path):
+            dirs.sort()
+            for name in sorted(names):
+                real_path = os.path.join(parent, name)
+                virtual_path = archive_path + MEMBER_SEP + os.path.relpath(real_path, dir_path)
+                if depth < self.max_depth and self._dirs.get(real_path):
+                    for inner_path, inner_real in self.files(real_path, depth + 1):
+                        yield virtual_path + inner_path[len(real_path):], inner_real
+                else:
+                    yield virtual_path, real_path
@@ -0,0 +1,149 @@
+"""
+"async_collect.py" Asyncio front end of the collector
+
+Walking folders and reading files block, which would stall an event loop serving other work.
+AsyncCollect runs a lazy Collect with all blocking calls off the event loop:
+    * aiter_files() walks on a thread of its own that hands the files found to the event loop
+      in small batches through a bounded queue: when the consumer falls behind, the walker
+      waits for room instead of running ahead and filling memory
+    * astream() hashes the files found on a bounded executor, a bounded number at a time, and
+      generates them hashed in the order found
+    * File.ahash() hashes a single file the same way
+
+Cancelling a consumer, or closing the generator early, stops the walker before its next batch,
+and the pending hash reads are cancelled; a file already being read is read to the end.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from collect import Collect
+from dedup import Dedup
+from tools import File
+
+# Files handed from the walker thread to the event loop at a time, and the longest a batch is
+# held back before being handed over incomplete
+BATCH_SIZE = 64
+BATCH_DELAY = 0.05
+
+_DONE = object()
+
+
+class AsyncCollect:
+    """Collect for asyncio programs
+
+    paths, exts and the keyword arguments are those of Collect; nothing is collected until
+    files are asked for.
+
+    jobs        -- size of the executor, when none is given
+    executor    -- executor reading files, shared with other jobs for example; it is not shut
+                   down by close()
+    queue_size  -- most files found and not yet taken by the consumer
+    """
+    def __init__(self, paths: [str] = None, exts: [str] = None, *, jobs: int = 4,
+                 executor: ThreadPoolExecutor = None, queue_size: int = 1024, **kwargs):
+        self.collect = Collect(paths, exts, lazy=True, **kwargs)
+        self.jobs = jobs
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(jobs, thread_name_prefix='collect')
+        self.queue_size = queue_size
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Write back the hash cache and manifest, and shut down the executor if owned"""
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.collect.close)
+        if self._own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def aiter_files(self):
+        """Generate the files of all collection paths as they are found"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(max(1, self.queue_size // BATCH_SIZE))
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            # Wait for room in the queue, giving up once the consumer is gone
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=0.1)
+                    return True
+                except TimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return False
+
+        def walk():
+            batch = []
+            flushed = time.monotonic()
+            try:
+                for file in self.collect.iter_files():
+                    batch.append(file)
+                    if len(batch) >= BATCH_SIZE or time.monotonic() - flushed > BATCH_DELAY:
+                        if stop.is_set() or not put(batch):
+                            return
+                        batch = []
+                        flushed = time.monotonic()
+                if not batch or put(batch):
+                    put(_DONE)
+            except BaseException as exc:
+                if not stop.is_set():
+                    put(exc)
+
+        # The walker has a thread of its own, so that waiting for room in the queue never
+        # holds up a reader in the executor
+        walker = threading.Thread(target=walk, name='collect-walker', daemon=True)
+        walker.start()
+        try:
+            while (batch := await queue.get()) is not _DONE:
+                if isinstance(batch, BaseException):
+                    raise batch
+                for file in batch:
+                    yield file
+        finally:
+            stop.set()
+            # Make room for a walker waiting on a full queue, so that it sees the stop
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def ahash(self, file: File) -> str:
+        """Hash a file on the executor"""
+        return await file.ahash(self.executor)
+
+    async def astream(self, window: int = None):
+        """Generate the files of all collection paths, hashed, in the order found
+
+        Up to window files, by default twice the number of jobs, are hashed at the same time.
+        """
+        window = window or 2 * self.jobs
+        pending: deque = deque()
+        try:
+            async for file in self.aiter_files():
+                pending.append((file, asyncio.ensure_future(self.ahash(file))))
+                if len(pending) >= window:
+                    file, task = pending.popleft()
+                    await task
+                    yield file
+            while pending:
+                file, task = pending.popleft()
+                await task
+                yield file
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def files(self) -> [File]:
+        """Return all the files of the collection paths"""
+        return [file async for file in self.aiter_files()]
+
+    async def adedup(self) -> Dedup:
+        """Split the collection into unique files and duplicates, hashing on the executor"""
+        files = await self.files()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, Dedup, files)
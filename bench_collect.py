@@ -0,0 +1,517 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the photo collector library
+
+Run as a program to time the collector against a synthetic collection built in a temporary
+directory; nothing is left on disk. The collection is generated from a seed, so the same options
+always build the same folders, files and archives: a tree of configurable depth and width, files
+of a chosen size distribution, a share of them duplicating the content of others, and zip and 7z
+archives holding more files.
+
+The suite times each stage of a collection -- discovery, hashing, archive extraction and dedup --
+and reports files per second, MB per second and the peak memory of the process. Results can be
+saved as a JSON baseline and later runs compared against it, so that a regression shows up as a
+stage slowing down beyond a tolerance:
+
+    python bench_collect.py --save baseline.json
+    python bench_collect.py --baseline baseline.json
+
+A reference baseline of the default collection is kept in TestResults/bench_baseline.json, along
+with the Python version, platform and CPU count it was taken on. Timings only compare on the same
+machine: take a baseline there first with --save, from the commit to compare against.
+
+With --micro, the older comparisons are run instead: the scandir walker against glob, manifest
+rescans, time to the first streamed result, hash pool scaling and cold reads scheduled per
+device. With --imports, the time to import the library modules in a fresh interpreter is
+measured. With --hashes, each available hash algorithm is timed with each read strategy on a
+large file, in MB per second.
+"""
+import argparse
+from glob import glob
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import py7zr
+
+from tools import File
+
+from collect import Collect
+from hash_pool import HashPool
+
+try:
+    import resource
+except ImportError:                 # Windows
+    resource = None
+
+
+def make_tree(root, depth=3, width=4, files_per_dir=50):
+    """Build a folder tree of depth levels with width subfolders per folder and some small files
+    in every folder; half of the files are photos, the rest are sidecar text files"""
+    count = 0
+    dirs = [root]
+    for level in range(depth + 1):
+        next_dirs = []
+        for dir_path in dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            for n in range(files_per_dir):
+                ext = '.jpg' if n % 2 else '.txt'
+                with open(os.path.join(dir_path, f'file{n}{ext}'), 'wb') as f:
+                    f.write(b'x' * 64)
+                count += 1
+            if level < depth:
+                next_dirs += [os.path.join(dir_path, f'folder{w}') for w in range(width)]
+        dirs = next_dirs
+    return count
+
+
+def glob_collect(dir_path, exts=None, patterns=('*',)):
+    """The original collector: glob everything, then stat each item to discard non-files"""
+    globs = []
+    for patt in patterns:
+        globs += glob(f'{dir_path}{os.sep}**{os.sep}{patt}', recursive=True)
+    files = []
+    for item in globs:
+        file = File(item)
+        if file.is_file and (not exts or file.ext in exts):
+            files.append(file)
+    return files
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    """Return the best elapsed time of several calls, and the last result"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_discovery(root):
+    """Compare the scandir walker with the glob walker"""
+    print("Discovery: scandir walker vs glob")
+    for exts in (None, ('.jpg',)):
+        glob_time, glob_files = timed(glob_collect, root, exts)
+        scan_time, collection = timed(Collect, root, exts, recursive=True)
+        assert len(glob_files) == len(collection.files)
+        print(f"  exts={exts}: {len(collection.files)} files -- glob {glob_time:.3f}s, "
+              f"scandir {scan_time:.3f}s ({glob_time / scan_time:.1f}x)")
+
+
+def bench_first_result(root):
+    """Time to the first hashed file from the streaming pipeline, against the eager collector"""
+    start = time.perf_counter()
+    files = Collect(root, recursive=True, lazy=True).stream()
+    next(files)
+    first = time.perf_counter() - start
+    files.close()
+    eager, _ = timed(Collect, root, recursive=True, repeat=1)
+    print(f"Streaming: first hashed file after {first * 1000:.1f}ms; eager collection of the "
+          f"tree takes {eager * 1000:.1f}ms before any file is available")
+
+
+def age_tree(root, seconds=60):
+    """Set back the modification time of every folder, as for a tree that has been sitting still"""
+    past = time.time() - seconds
+    for dir_path, _, _ in os.walk(root):
+        os.utime(dir_path, (past, past))
+
+
+def bench_rescan(root):
+    """Compare a full walk with a rerun reusing the directory manifest"""
+    age_tree(root)
+    manifest_path = os.path.join(tempfile.mkdtemp(prefix='bench_manifest_'), 'manifest')
+    try:
+        first_time, first = timed(lambda: Collect(root, recursive=True, manifest=manifest_path),
+                                  repeat=1)
+        first.close()
+        rerun_time, rerun = timed(lambda: Collect(root, recursive=True, manifest=manifest_path))
+        assert len(first.files) == len(rerun.files)
+        print(f"Rescan: {rerun.manifest.reused} unchanged folders -- first walk {first_time:.3f}s, "
+              f"rerun {rerun_time:.3f}s ({first_time / rerun_time:.1f}x)")
+    finally:
+        shutil.rmtree(os.path.dirname(manifest_path), ignore_errors=True)
+
+
+def make_big_files(root, count=32, size=4 * 1024 * 1024):
+    """Create count files of random content of the given size"""
+    os.makedirs(root, exist_ok=True)
+    for n in range(count):
+        with open(os.path.join(root, f'video{n}.mp4'), 'wb') as f:
+            f.write(os.urandom(size))
+    return count * size
+
+
+def bench_hash_pool(root):
+    """Hash throughput by number of HashPool workers"""
+    total = make_big_files(os.path.join(root, 'big'))
+    paths = [file.file_path for file in Collect(os.path.join(root, 'big')).files]
+    print(f"Hashing: {len(paths)} files, {total / 2**20:.0f} MB (page-cached), "
+          f"{os.cpu_count()} CPUs")
+    for jobs in (1, 2, 4, 8):
+        pool = HashPool(jobs, per_device=jobs)
+        elapsed, _ = timed(lambda: pool.map([File(path) for path in paths]))
+        print(f"  jobs={jobs}: {elapsed:.3f}s, {total / 2**20 / elapsed:.0f} MB/s")
+
+
+def evict(paths):
+    """Drop files from the page cache, so that they are read from the disk again"""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def bench_scheduler(root, jobs=8):
+    """Cold hash throughput, files read in the order found by jobs streams against the device
+    policy of the I/O scheduler"""
+    from io_scheduler import IOScheduler, Policy, device_kind
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    paths = [file.file_path for file in Collect(os.path.join(root, 'big')).files]
+    random.Random(0).shuffle(paths)
+    total = sum(os.path.getsize(x) for x in paths)
+    kind = device_kind(os.stat(root).st_dev)
+    print(f"Scheduling: {len(paths)} files, {total / 2**20:.0f} MB (evicted), {kind} device")
+    schedulers = {'found': IOScheduler({kind: Policy(jobs, 'found')}),
+                  'policy': IOScheduler()}
+    for name, scheduler in schedulers.items():
+        evict(paths)
+        pool = HashPool(jobs, scheduler=scheduler)
+        elapsed, _ = timed(lambda: pool.map([File(path) for path in paths]), repeat=1)
+        print(f"  {name:6} {scheduler.policy(os.stat(root).st_dev)}: {elapsed:.3f}s, "
+              f"{total / 2**20 / elapsed:.0f} MB/s")
+
+
+# File size generators, each drawing a size in bytes from a random.Random
+SIZE_DISTRIBUTIONS = {
+    # Thumbnails and small images
+    'small': lambda rng: rng.randint(1024, 64 * 1024),
+    # Camera photos: a long tailed spread around 200 KB, up to 4 MB
+    'photo': lambda rng: min(int(rng.lognormvariate(math.log(200 * 1024), 0.6)), 4 * 2**20),
+    # Mostly photos, with one video in twenty of several MB
+    'mixed': lambda rng: (min(int(rng.lognormvariate(math.log(8 * 2**20), 0.5)), 32 * 2**20)
+                          if rng.random() < 0.05 else SIZE_DISTRIBUTIONS['photo'](rng)),
+}
+
+
+class Corpus:
+    """Deterministic synthetic collection, generated from a seed
+
+    depth, width     -- folder levels below the root, and subfolders per folder
+    files_per_dir    -- files written in every folder
+    sizes            -- name of the size distribution, a SIZE_DISTRIBUTIONS key
+    dup_ratio        -- share of files, and archive members, repeating the content of an earlier one
+    archives         -- number of archives added, alternately zip and 7z
+    archive_members  -- files held by each archive
+    """
+    def __init__(self, seed=0, depth=2, width=3, files_per_dir=10, sizes='photo',
+                 dup_ratio=0.2, archives=2, archive_members=10):
+        self.config = dict(seed=seed, depth=depth, width=width, files_per_dir=files_per_dir,
+                           sizes=sizes, dup_ratio=dup_ratio, archives=archives,
+                           archive_members=archive_members)
+        self._rng = random.Random(seed)
+        self._size = SIZE_DISTRIBUTIONS[sizes]
+        self._contents: [(int, int)] = []       # (content seed, size) of each distinct content
+        self.files = 0
+        self.bytes = 0
+
+    @property
+    def unique(self) -> int:
+        return len(self._contents)
+
+    def _content(self) -> bytes:
+        """Draw the content of the next file: repeated, or new"""
+        if self._contents and self._rng.random() < self.config['dup_ratio']:
+            content_seed, size = self._rng.choice(self._contents)
+        else:
+            content_seed, size = self._rng.getrandbits(64), self._size(self._rng)
+            self._contents.append((content_seed, size))
+        self.files += 1
+        self.bytes += size
+        return random.Random(content_seed).randbytes(size)
+
+    def _name(self, n, data) -> str:
+        return f'IMG_{n:05}.jpg' if len(data) < 4 * 2**20 else f'VID_{n:05}.mp4'
+
+    def build(self, root) -> 'Corpus':
+        """Write the collection under root"""
+        config = self.config
+        n = 0
+        dirs = [root]
+        all_dirs = []
+        for level in range(config['depth'] + 1):
+            next_dirs = []
+            for dir_path in dirs:
+                os.makedirs(dir_path, exist_ok=True)
+                all_dirs.append(dir_path)
+                for _ in range(config['files_per_dir']):
+                    data = self._content()
+                    with open(os.path.join(dir_path, self._name(n, data)), 'wb') as f:
+                        f.write(data)
+                    n += 1
+                if level < config['depth']:
+                    next_dirs += [os.path.join(dir_path, f'{2000 + level}_{w:02}')
+                                  for w in range(config['width'])]
+            dirs = next_dirs
+        for a in range(config['archives']):
+            dir_path = self._rng.choice(all_dirs)
+            members = []
+            for _ in range(config['archive_members']):
+                data = self._content()
+                members.append((f'Takeout/Photos/{self._name(n, data)}', data))
+                n += 1
+            if a % 2 == 0:
+                with zipfile.ZipFile(os.path.join(dir_path, f'takeout{a}.zip'), 'w') as z:
+                    for name, data in members:
+                        z.writestr(name, data)
+            else:
+                with py7zr.SevenZipFile(os.path.join(dir_path, f'takeout{a}.7z'), 'w') as z:
+                    for name, data in members:
+                        z.writestr(data, name)
+        return self
+
+
+def reset_peak_rss():
+    """Start a new peak memory measurement, where the system allows it (Linux)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float | None:
+    """Peak resident memory of the process, in MB, since reset_peak_rss() where the system
+    allows it and otherwise since the start; None where unknown"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in KB on Linux, in bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+def measure(func, files: int, size: int) -> (dict, object):
+    """Time one call of func processing files of size bytes in total; return the stage result
+    and func's result"""
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    stage = dict(seconds=round(elapsed, 4), files=files, bytes=size,
+                 files_per_s=round(files / elapsed, 1) if elapsed else None,
+                 mb_per_s=round(size / 2**20 / elapsed, 1) if elapsed and size else None,
+                 peak_rss_mb=peak_rss_mb())
+    return stage, result
+
+
+def run_suite(root, corpus: Corpus, jobs: int = None) -> {str: dict}:
+    """Time the stages of collecting root, where corpus was built"""
+    results = {}
+    results['discovery'], collection = measure(
+        lambda: Collect(root, recursive=True, archives=True), corpus.files, 0)
+    disk_files = [x.file_path for x in collection.files if os.path.isfile(x.file_path)]
+    disk_bytes = sum(os.path.getsize(x) for x in disk_files)
+    results['hash'], _ = measure(lambda: [File(x).hash for x in disk_files],
+                                 len(disk_files), disk_bytes)
+    results['hash_pool'], _ = measure(
+        lambda: HashPool(jobs).map([File(x) for x in disk_files]), len(disk_files), disk_bytes)
+
+    extract_dir = os.path.join(root, '.extracted')
+    collection = Collect(root, recursive=True, extract=extract_dir)
+    members = [x for x in collection.files if not os.path.isfile(x.file_path)]
+    results['extraction'], _ = measure(collection.extract_unique, len(members),
+                                       sum(x.size for x in members))
+    shutil.rmtree(extract_dir)
+
+    collection = Collect(root, recursive=True, archives=True)
+    results['dedup'], dedup = measure(lambda: collection.dedup(jobs), corpus.files, corpus.bytes)
+    assert len(dedup.unique) == corpus.unique, (len(dedup.unique), corpus.unique)
+
+    # Within a budget too small for the corpus, so that sorted runs are spilled
+    lists_dir = os.path.join(root, '.dedup_lists')
+    collection = Collect(root, recursive=True, archives=True, lazy=True)
+    results['dedup_ext'], (unique, _) = measure(
+        lambda: collection.dedup_to(lists_dir, memory=2**20, jobs=jobs), corpus.files,
+        corpus.bytes)
+    assert unique == corpus.unique, (unique, corpus.unique)
+    shutil.rmtree(lists_dir)
+    return results
+
+
+def report(results: {str: dict}, baseline: dict = None, tolerance=0.2) -> [str]:
+    """Print the stage results, against the baseline ones if given; return the stages found
+    slower than the baseline by more than the tolerance"""
+    slower = []
+    for name, stage in results.items():
+        rates = f"{stage['files_per_s'] or 0:9.0f} files/s"
+        if stage['mb_per_s'] is not None:
+            rates += f" {stage['mb_per_s']:8.1f} MB/s"
+        rss = f"peak {stage['peak_rss_mb']:.0f} MB" if stage['peak_rss_mb'] is not None else ''
+        line = f"  {name:<11} {stage['seconds']:8.3f}s {rates:<30} {rss}"
+        before = (baseline or {}).get(name)
+        if before:
+            change = stage['seconds'] / before['seconds'] - 1 if before['seconds'] else 0
+            line += f"  {change:+.0%} against baseline"
+            if change > tolerance:
+                line += '  SLOWER'
+                slower.append(name)
+        print(line)
+    return slower
+
+
+# Modules deferred until needed, which importing the library must not load
+DEFERRED_MODULES = ('py7zr', 'sqlite3', 'unittest', 'concurrent.futures', 'zipfile', 'argparse',
+                    'socket', 'pickle', 'json.decoder')
+
+
+def bench_imports(modules=('tools', 'collect'), repeat=5):
+    """Time the import of library modules in fresh interpreters, module synchronization off,
+    over the start-up time of an interpreter importing nothing"""
+    env = dict(os.environ, SYNC_MODULES='0')
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=package_dir, env=env, check=True)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    base = run('pass')
+    print(f"Imports: interpreter start-up {base * 1000:.1f}ms")
+    for module in modules:
+        elapsed = run(f'import {module}')
+        loaded = subprocess.run(
+            [sys.executable, '-c', f'import sys, {module}; print(*(x for x in '
+                                   f'{DEFERRED_MODULES!r} if x in sys.modules))'],
+            cwd=package_dir, env=env, check=True, capture_output=True, text=True).stdout.split()
+        print(f"  import {module}: {(elapsed - base) * 1000:.1f}ms"
+              + (f", loading deferred modules {', '.join(loaded)}" if loaded else ''))
+
+
+def bench_hashes(size_mb=256, repeat=3):
+    """Time each available hash algorithm with each read strategy on a file of size_mb MB,
+    read from the page cache after a first pass"""
+    from hashers import Hasher, READ_STRATEGIES, available
+    fd, file_path = tempfile.mkstemp(prefix='bench_hashes_')
+    try:
+        with open(fd, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(2**20))
+        print(f"Hashes: {size_mb} MB file, best of {repeat}")
+        for algorithm in available():
+            for strategy in READ_STRATEGIES:
+                try:
+                    hasher = Hasher(algorithm, strategy)
+                except ValueError:
+                    continue
+                hasher.hash_file(file_path)
+                best, _ = timed(hasher.hash_file, file_path, repeat=repeat)
+                print(f"  {algorithm:8} {strategy:8}: {size_mb / best:8.0f} MB/s")
+    finally:
+        os.remove(file_path)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the photo collector")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--width', type=int, default=3)
+    parser.add_argument('--files', type=int, default=10, help="files per folder")
+    parser.add_argument('--sizes', choices=sorted(SIZE_DISTRIBUTIONS), default='photo')
+    parser.add_argument('--dup-ratio', type=float, default=0.2)
+    parser.add_argument('--archives', type=int, default=2)
+    parser.add_argument('--archive-members', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=None, help="hash pool threads")
+    parser.add_argument('--save', metavar='JSON', help="write the results as a baseline")
+    parser.add_argument('--baseline', metavar='JSON', help="compare with a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="slowdown against the baseline reported as a regression")
+    parser.add_argument('--micro', action='store_true',
+                        help="run the walker, rescan, streaming and hash pool comparisons")
+    parser.add_argument('--imports', action='store_true', help="time the library imports")
+    parser.add_argument('--hashes', action='store_true',
+                        help="time the hash algorithms and read strategies")
+    return parser.parse_args(argv)
+
+
+def micro():
+    root = tempfile.mkdtemp(prefix='bench_collect_')
+    try:
+        count = make_tree(root)
+        print(f"Synthetic tree: {count} files under {root}")
+        bench_discovery(root)
+        bench_rescan(root)
+        bench_first_result(root)
+        bench_hash_pool(root)
+        bench_scheduler(root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.micro:
+        return micro()
+    if args.imports:
+        bench_imports()
+        return 0
+    if args.hashes:
+        bench_hashes()
+        return 0
+    corpus = Corpus(args.seed, args.depth, args.width, args.files, args.sizes, args.dup_ratio,
+                    args.archives, args.archive_members)
+    root = tempfile.mkdtemp(prefix='bench_collect_')
+    try:
+        corpus.build(root)
+        print(f"Synthetic collection: {corpus.files} files, {corpus.bytes / 2**20:.1f} MB, "
+              f"{corpus.unique} unique, {args.archives} archives")
+        results = run_suite(root, corpus, args.jobs)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved['corpus'] != corpus.config:
+            print("Baseline was taken on a different collection; stages are not compared")
+        else:
+            baseline = saved['results']
+    slower = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(corpus=corpus.config, files=corpus.files, bytes=corpus.bytes,
+                           python=platform.python_version(), platform=platform.platform(),
+                           cpus=os.cpu_count(), time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                           results=results), f, indent=2)
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
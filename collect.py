@@ -19,14 +19,35 @@ be found on many folders on several PCs.
 Another wrinkle in the scattering of photos is that many have been placed into folders named for
 a date and/or a activity.
 
+The modules of optional features -- hash cache, index, manifest, journal, store, dedup and the
+others -- are imported by the methods using them, so that importing the library stays fast.
 """
-from glob import glob
 import os
 import re
 import sys
+from typing import TYPE_CHECKING
 
+from archive import Archive, ArchiveMember, is_archive, MEMBER_SEP
+from file_filter import DEFAULT_EXCLUDE_DIRS, FileFilter
+from file_table import FileTable
+from hashers import Hasher, DEFAULT_ALGORITHM
+from metrics import Metrics, stage
 from tools import File
 
+if TYPE_CHECKING:
+    from collection_index import CollectionIndex
+    from dedup import Dedup
+    from dir_manifest import DirManifest
+    from hash_cache import HashCache
+    from io_scheduler import IOScheduler
+    from journal import Journal
+    from query_index import QueryIndex
+    from store import CollectionStore
+    from watch import Watcher
+
+# Files found recorded in the journal at a time
+JOURNAL_BATCH = 1000
+
 
 class List(list):
     def __init__(self, obj=None):
@@ -42,56 +63,535 @@ class Collect:
     def __init__(self, paths:[str] = None, exts:[str] = None, *,
                  not_exts: [str] = None,
                  patterns:[str] = None,
-                 recursive=False):
+                 recursive=False,
+                 hash_cache: 'str | HashCache' = None,
+                 archives=False,
+                 extract: str = None,
+                 manifest: 'str | DirManifest' = None,
+                 table=False,
+                 lazy=False,
+                 exclude_dirs: [str] = DEFAULT_EXCLUDE_DIRS,
+                 include_dirs: [str] = None,
+                 max_depth: int = None,
+                 min_size: int = None,
+                 max_size: int = None,
+                 file_filter: FileFilter = None,
+                 metrics: Metrics = None,
+                 index: 'str | CollectionIndex' = None,
+                 algorithm: str = DEFAULT_ALGORITHM,
+                 read_strategy: str = None,
+                 scheduler: 'IOScheduler' = None,
+                 journal: 'str | bool | Journal' = None,
+                 resume=False):
+        """The files collected are chosen by a FileFilter, built from exts, not_exts, patterns
+        and the arguments from exclude_dirs to max_size unless file_filter is given; see
+        FileFilter for their use. Without recursive, only the files directly in the collection
+        paths are collected.
+
+        hash_cache is a HashCache, or the path of its database file (or folder), used to keep
+        file hash values between runs
+
+        manifest is a DirManifest, or the path of its file (or folder), recording directory
+        listings so that a rerun skips listing the directories that have not changed.
+
+        With table, the collected files are recorded in the compact columns of self.table, a
+        FileTable, instead of being kept as File objects in self.files.
+
+        With lazy, nothing is collected on creation: files are taken as they are found through
+        iter_files() or stream().
+
+        With archives, zip and 7z files are treated as folders and their members collected as
+        ArchiveMember files, read in place. extract, which implies archives, is the folder into
+        which extract_unique() writes the members to be kept.
+
+        index is a CollectionIndex, or the path of its database file (or folder), into which the
+        files found are merged and in which files no longer found in the folders walked are
+        marked gone. dedup() and hash_all() record the hash values they obtain in it, dedup()
+        also telling apart the files sharing their size with files indexed earlier.
+
+        metrics is a Metrics object counting and timing the work done, down to each file
+        hashed, and reporting progress; see metrics.py.
+
+        algorithm and read_strategy choose how files are hashed: sha1, sha256, blake2b, xxh3 or
+        blake3, read as a whole or block by block; see hashers.py. Hash values of another
+        algorithm found in the hash cache or index are not used.
+
+        scheduler is an IOScheduler setting how many files are read at the same time from each
+        device, and in what order, when hashing and storing files; see io_scheduler.py.
+
+        journal is a Journal, or the path of its file, or True for a file named for the
+        collection paths in the user's cache folder, checkpointing the files found, hashed and
+        extracted so that an interrupted run can be resumed; see journal.py. With resume, which
+        implies journal, the run continues from the last checkpoint of the journal, if any,
+        without walking, hashing or extracting again what was done. An interrupted run should
+        be closed, as on leaving a with block, for its last records to be written. Only the
+        walks of collect(), as on creation, are journaled: iter_files(), stream() and watch()
+        walk from the start, though the hash values they obtain are journaled, and the copies of
+        store_unique() are not, the store skipping the content it already holds.
+        """
+        self.hasher = Hasher(algorithm, read_strategy)
         self.paths: [str] = List(paths)
 
-        self.recursive = recursive
-        if not patterns:
-            patterns = ['*']
-        self.patterns = patterns
+        self.extract_dir = extract
+        self.archives = archives or bool(extract)
 
-        if exts:
-            self.exts = tuple([x if x[0]=='.' else f'.{x}' for x in List(exts)])
-        else:
-            self.exts = None
+        if isinstance(manifest, str):
+            from dir_manifest import DirManifest
+            manifest = DirManifest(manifest)
+        self.manifest = manifest
 
-        if not_exts:
-            self.not_exts = tuple([x if x[0]=='.' else f'.{x}' for x in List(not_exts)])
-        else:
-            self.not_exts = None
+        # Stores opened from their path, closed with the collection; those given are only
+        # flushed, being the caller's to close
+        self._owned = []
+        if isinstance(hash_cache, str):
+            from hash_cache import HashCache
+            hash_cache = HashCache(hash_cache)
+            self._owned.append(hash_cache)
+        self.hash_cache = hash_cache
 
-        self.exts_not_used = not self.exts and not self.not_exts
+        if journal is True or resume and journal is None:
+            from journal import default_path
+            journal = default_path(self.paths)
+        if isinstance(journal, str):
+            from journal import Journal
+            journal = Journal(journal, self.paths, algorithm, resume, hash_cache)
+        self.journal = journal
+
+        if isinstance(index, str):
+            from collection_index import CollectionIndex
+            index = CollectionIndex(index, algorithm=algorithm)
+            self._owned.append(index)
+        elif index is not None and index.algorithm != algorithm:
+            raise ValueError(f"Index {index.db_path} holds {index.algorithm} hash values, "
+                             f"not {algorithm}")
+        self.index = index
+        # Database files never to be collected, should they sit under a collection path
+        self._own_files = frozenset(
+            os.path.abspath(x.db_path) + suffix for x in (index, hash_cache)
+            if x is not None for suffix in ('', '-wal', '-shm', '-journal'))
+
+        self.metrics = metrics
+        self.scheduler = scheduler
+        self.recursive = recursive
+        self.filter = file_filter or FileFilter(patterns, exts, not_exts,
+                                                exclude_dirs=exclude_dirs,
+                                                include_dirs=include_dirs,
+                                                max_depth=max_depth,
+                                                min_size=min_size,
+                                                max_size=max_size)
 
         self.files: [File] = []
+        # Called with each directory about to be listed by the walk, by a Watcher watching them
+        self._on_dir = None
+        # Folders listed and archives opened by the walk of a path, whose files not found are
+        # marked gone in the index
+        self._listed: {str} = None
+        self._opened: {str} = None
+        self.table = FileTable(self.hasher.digest_size) if table else None
+
+        if not lazy:
+            with stage(metrics, 'walk'):
+                for dir_path in self.paths:
+                    self.collect(dir_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Write back any hash values still pending in the hash cache, the index and the manifest,
+        and make the final metrics report; checkpoint the journal. The hash cache and index are
+        closed if opened by the collection from their path."""
+        if self.journal is not None:
+            self.journal.close()
+        for store in (self.hash_cache, self.index):
+            if store is None:
+                continue
+            if any(x is store for x in self._owned):
+                store.close()
+            else:
+                store.flush()
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.metrics is not None:
+            self.metrics.close()
+
+    def hash_all(self, jobs: int = None, per_device: int = None) -> [str]:
+        """Hash all collected files on a pool of jobs threads, reading files from each device as
+        the scheduler's policy says, or at most per_device at a time; hash values are returned in
+        the order of self.files, None for a file that could not be read, the error reported"""
+        from hash_pool import HashPool
+        with stage(self.metrics, 'hash'):
+            hashes = HashPool(jobs, per_device, self.scheduler).map(self.files, skip_errors=True)
+        if self.index is not None:
+            for file, hash_value in zip(self.files, hashes):
+                if hash_value is not None:
+                    self.index.set_hashes(file)
+        return hashes
+
+    def dedup(self, jobs: int = None, per_device: int = None) -> 'Dedup':
+        """Split the collected files into the unique and duplicate lists, reading files on a pool
+        of jobs threads; files that could not be read are reported and left out of both"""
+        from dedup import Dedup
+        from hash_pool import HashPool
+        with stage(self.metrics, 'dedup'):
+            pool = HashPool(jobs, per_device, self.scheduler)
+            dedup = Dedup(self.files, pool)
+            if self.index is not None:
+                for file in self.files:
+                    if file._partial_hash is not None or file._hash is not None:
+                        self.index.set_hashes(file)
+                self.index.resolve(pool, self.files)
+        return dedup
+
+    def dedup_to(self, dst_dir, memory: int = None, jobs: int = None) -> (int, int):
+        """Write the unique and duplicate lists of the collection into dst_dir, keeping about
+        memory bytes at most, by default external_dedup.MEMORY_BUDGET, whatever the number of
+        files; return their lengths
+
+        "unique.txt" lists the paths of the unique files, "duplicates.txt" the path of each
+        duplicate and of the unique file it duplicates, both in size order. A lazy collection
+        is walked as the lists are made, so that its files are never all held at once; see
+        external_dedup.py.
+        """
+        from external_dedup import ExternalDedup, MEMORY_BUDGET
+        from hash_pool import HashPool
+        files = self.iter_files() if not self.files else self.files
+        dedup = ExternalDedup(memory or MEMORY_BUDGET, HashPool(jobs, scheduler=self.scheduler),
+                              prepare=self._prepare)
+        os.makedirs(dst_dir, exist_ok=True)
+        unique = duplicates = 0
+        with stage(self.metrics, 'dedup'), \
+                open(os.path.join(dst_dir, 'unique.txt'), 'w', encoding='utf-8') as unique_file, \
+                open(os.path.join(dst_dir, 'duplicates.txt'), 'w', encoding='utf-8') as dup_file:
+            for path, original in dedup.run(files):
+                if original is None:
+                    unique_file.write(f'{path}\n')
+                    unique += 1
+                else:
+                    dup_file.write(f'{path}\t{original}\n')
+                    duplicates += 1
+        return unique, duplicates
+
+    def similar(self, max_distance: int = None, jobs: int = None) -> [[File]]:
+        """Group the unique images of the collection showing the same picture, as re-encoded at
+        another resolution or in another format, by perceptual hash, at most max_distance bits
+        apart, by default perceptual.MAX_DISTANCE; see perceptual.py. Needs Pillow and NumPy."""
+        from perceptual import Fingerprints, MAX_DISTANCE
+        if max_distance is None:
+            max_distance = MAX_DISTANCE
+        unique = self.dedup(jobs).unique
+        with stage(self.metrics, 'similar'):
+            return Fingerprints(unique, jobs).clusters(max_distance)
 
+    def extract_unique(self, dst_dir: str = None) -> [str]:
+        """Extract the archive members that are unique in the collection into dst_dir, by default
+        the extract folder; duplicated members are never written. Return the extracted paths."""
+        dst_dir = dst_dir or self.extract_dir
+        unique = self.dedup().unique
+        with stage(self.metrics, 'extract'):
+            return [self._extract(file, dst_dir) for file in unique
+                    if isinstance(file, ArchiveMember)]
+
+    def _extract(self, member: ArchiveMember, dst_dir) -> str:
+        """Extract a member, unless the journal records it extracted by the interrupted run"""
+        if self.journal is None:
+            return member.extract(dst_dir)
+        dst_path = self.journal.copied(member)
+        if dst_path is None:
+            dst_path = member.extract(dst_dir)
+            self.journal.copy(member, dst_path)
+        return dst_path
+
+    def store_unique(self, store: 'str | CollectionStore', jobs: int = None) -> [str]:
+        """Copy the unique files of the collection into a content-addressed store, or the root
+        folder of one; files whose content is already stored are not copied. Files unique by size
+        are never hashed by dedup: their hash is computed as they are copied. Return the stored
+        paths, in the order of the unique files."""
+        if isinstance(store, str):
+            from store import CollectionStore
+            store = CollectionStore(store, jobs or 4, algorithm=self.hasher.name,
+                                    scheduler=self.scheduler)
+        unique = self.dedup(jobs).unique
+        with stage(self.metrics, 'store'):
+            return [path for path, _ in store.add_all(unique)]
+
+    def query_index(self, exif=False, jobs: int = None) -> 'QueryIndex':
+        """Build the indexes answering queries by digest, size, date, folder and activity over
+        the collected files; see query_index.py. With exif, files are dated by their metadata,
+        read on a pool of jobs threads, rather than only by their folder names."""
+        from query_index import QueryIndex
+        with stage(self.metrics, 'query index'):
+            return QueryIndex(self.files, exif, jobs)
+
+    def watch(self, jobs: int = None, settle: float = None, poll_interval: float = None,
+              polling=False) -> 'Watcher':
+        """Return a Watcher walking the collection paths once, then collecting the files new or
+        changed as they settle, hashed on a pool of jobs threads and deduplicated against those
+        already known; see watch.py, which sets the default settle and poll_interval times. The
+        collection is best lazy."""
+        from watch import Watcher, SETTLE_TIME, POLL_INTERVAL
+        return Watcher(self, jobs, SETTLE_TIME if settle is None else settle,
+                       POLL_INTERVAL if poll_interval is None else poll_interval, polling)
+
+    def write_manifest(self, file_path: str, host: str = None, jobs: int = None) -> int:
+        """Hash all collected files and write their manifest, sorted by digest, to be merged with
+        those of other hosts; see shards.py. Return the number of files written."""
+        import shards
+        with stage(self.metrics, 'manifest'):
+            return shards.write_manifest(self.files, file_path, host, jobs)
+
+    def iter_files(self):
+        """Generate the files of all collection paths as they are found, without keeping them"""
         for dir_path in self.paths:
-            self.collect(dir_path)
+            yield from self._iter_path(dir_path)
+
+    def stream(self, jobs: int = None, per_device: int = None):
+        """Generate the files of all collection paths, hashed, in the order they are found
+
+        Discovery and hashing overlap: files are hashed on a pool of jobs threads while the
+        walker keeps looking a bounded distance ahead, and each file is handed on as soon as it
+        and those found before it are hashed. The result can be chained into dedup.stream_dedup()
+        and a copy stage.
+        """
+        from hash_pool import HashPool
+        return HashPool(jobs, per_device, self.scheduler).iter_hashed(self.iter_files())
 
     def collect(self, dir_path):
-        globs = []
-        # glob collect everything, including direcroties which need to be filtered.
-        for patt in self.patterns:
-            if self.recursive:
-                globs += glob(f'{dir_path}{os.sep}**{os.sep}{patt}', recursive=True)
+        """Walk dir_path and add every file passing the patterns/exts filters to the collection"""
+        if self.index is not None:
+            self._listed, self._opened = set(), set()
+        for file in self._journaled_path(dir_path):
+            if self.index is not None:
+                self.index.add(file)
+            if self.table is not None:
+                self.table.add(file)
+            else:
+                self.files.append(file)
+        if self.index is not None and os.path.isdir(dir_path):
+            self.index.mark_gone(dir_path, self._is_gone)
+            self._listed = self._opened = None
+
+    def _is_gone(self, path, member: bool, size: int) -> bool:
+        """Check whether an indexed file not found by the last walk was looked for: only files
+        in the folders it listed, or the archives it opened, and wanted by the filter are"""
+        if member:
+            # The archive path ends at one of the separators
+            end = -1
+            while (end := path.find(MEMBER_SEP, end + 1)) >= 0:
+                archive_path = path[:end]
+                if archive_path in self._opened:
+                    break
+                if os.path.dirname(archive_path) in self._listed and is_archive(archive_path):
+                    # Not opened although in a folder listed: the archive itself is gone
+                    return self.archives
             else:
-                globs += glob(f'{dir_path}{os.sep}{patt}', recursive=False)
+                return False
+            return self.filter.wants_name(os.path.basename(path)) and (
+                not self.filter.sized or self.filter.wants_size(size))
+        dir_path, name = os.path.split(path)
+        if dir_path not in self._listed or not self.filter.wants_name(name):
+            return False
+        # A file skipped for its size is still there
+        return not self.filter.sized or not os.path.exists(path)
+
+    def _journaled_path(self, dir_path):
+        """Generate the files of a collection path as _iter_path does, recording them in the
+        journal; those of a path walked to the end by a resumed run are taken from the journal"""
+        if self.journal is None:
+            yield from self._iter_path(dir_path)
+            return
+        files = self.journal.files(dir_path)
+        if files is not None:
+            for file in files:
+                yield self._attach(file)
+            return
+        self.journal.walking(dir_path)
+        batch = []
+        for file in self._iter_path(dir_path, journaled=True):
+            batch.append(file)
+            if len(batch) >= JOURNAL_BATCH:
+                self.journal.found(dir_path, batch)
+                batch = []
+            yield file
+        self.journal.found(dir_path, batch)
+        self.journal.walked(dir_path)
+
+    def _iter_path(self, dir_path, journaled=False):
+        """Generate the wanted files under dir_path; dir_path may also be a single file, or an
+        archive when archives are collected. With journaled, the folders walked are recorded in
+        the journal, see _walk()."""
+        dir_path = os.path.abspath(dir_path)
+        if os.path.isfile(dir_path):
+            if self.archives and is_archive(dir_path):
+                yield from self._iter_archive(dir_path)
+            elif self.filter.wants_name(os.path.basename(dir_path)):
+                yield self._attach(File(dir_path))
+            return
+        if self.manifest is not None and self.recursive:
+            self.manifest.add_root(dir_path)
+        for file in self._walk(dir_path, journaled=journaled):
+            if self.archives and is_archive(file.file_name):
+                yield from self._iter_archive(file.file_path)
+            else:
+                yield self._attach(file)
+
+    def _iter_archive(self, archive_path):
+        if self._opened is not None:
+            self._opened.add(archive_path)
+        for member in Archive(archive_path).members():
+            if self.filter.wants_name(member.file_name) and (
+                    not self.filter.sized or self.filter.wants_size(member.size)):
+                if self.metrics is not None:
+                    self.metrics.count('archive_members')
+                yield self._attach(member)
+
+    def _attach(self, file: File) -> File:
+        """Prepare a collected file, counting it in the metrics"""
+        if self.metrics is not None:
+            self.metrics.count('files_matched')
+        return self._prepare(file)
+
+    def _prepare(self, file: File) -> File:
+        """Attach the hasher, hash cache (through the journal, if any) and metrics to a file"""
+        file._hasher = self.hasher
+        file._cache = self.journal if self.journal is not None else self.hash_cache
+        file._metrics = self.metrics
+        return file
+
+    def _wanted(self, file_name):
+        """Check whether a file name is to be collected, or is an archive to be looked into"""
+        return self.filter.wants_name(file_name) or self.archives and is_archive(file_name)
+
+    def _walk(self, dir_path, rel_path='', depth=0, included: bool = None, journaled=False):
+        """Generate a File for each wanted file under dir_path
+
+        The filter is applied during the walk: excluded folders are pruned without being listed
+        and file names are filtered before any File is built. Like glob, hidden names are
+        skipped unless a pattern asks for them, and unreadable directories are silently passed
+        over. Archives are generated whatever the filters when archives are collected.
+
+        rel_path, depth and included are those of dir_path, when a subfolder of a collection
+        path, as given by the filter's dir_state().
+
+        With journaled, each folder is recorded in the journal once all its files were taken,
+        and a folder recorded by the interrupted run a resumed one continues, if unchanged
+        since, is not listed again: the walk picks up where it stopped.
+        """
+        file_filter = self.filter
+        if included is None:
+            included = not file_filter.includes
+        # Directories to walk, with their path relative to the collection path, depth, and
+        # whether their files are wanted
+        stack = [(dir_path, rel_path, depth, included)]
+        while stack:
+            path, rel_path, depth, included = stack.pop()
+            if self._on_dir is not None:
+                self._on_dir(path, rel_path, depth, included)
+            taken = None
+            if journaled:
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                listing = self.journal.listing(path, mtime_ns)
+                if listing is not None:
+                    # Taken by the interrupted run: filtered as a manifest listing is
+                    listing = listing[0], [(x, None) for x in listing[1]], False
+                else:
+                    taken = []
+            if not journaled or taken is not None:
+                listing = self._list_dir(path)
+            if listing is None:
+                continue
+            subdirs, files, filtered = listing
+            if included:
+                if self._listed is not None:
+                    self._listed.add(path)
+                for name, stats in files:
+                    if filtered:
+                        if stats is None:
+                            continue
+                    elif not self._wanted(name):
+                        continue
+                    else:
+                        # Recorded by the manifest: the file may have been rewritten in place
+                        # since, so it is stat'ed again before its size or hash is trusted
+                        stats = None
+                    file_path = os.path.join(path, name)
+                    if self._own_files and file_path in self._own_files:
+                        continue
+                    if file_filter.sized:
+                        try:
+                            if stats is None and self.metrics is not None:
+                                self.metrics.count('stat_calls')
+                            stats = stats or os.stat(file_path)
+                        except OSError:
+                            continue
+                        if not file_filter.wants_size(stats.st_size) and not (
+                                self.archives and is_archive(name)):
+                            continue
+                    yield File.from_stats(file_path, stats)
+                    if taken is not None:
+                        taken.append(name)
+            if taken is not None:
+                self.journal.listed(path, mtime_ns, subdirs, taken)
+            if not self.recursive:
+                continue
+            pending = []
+            for name in subdirs:
+                sub_rel_path = f'{rel_path}/{name}' if rel_path else name
+                state = file_filter.dir_state(name, sub_rel_path, depth + 1, included)
+                if state is not None:
+                    pending.append((os.path.join(path, name), sub_rel_path, depth + 1, state))
+            # Reverse so that subdirectories are walked in the order they were listed
+            stack += reversed(pending)
+
+    def _list_dir(self, dir_path) -> ([str], [(str, os.stat_result)], bool):
+        """Return the subdirectory names of a directory, its files with their stats, and whether
+        the files were filtered during this listing
 
-        # For each globbed item, a File object is created, then checked for "is_file", discarding
-        # anything that is not.
+        A single os.scandir() pass lists the directory: each entry already knows whether it is a
+        file or directory, and the file names are filtered so that only wanted files are
+        stat'ed (their stats are None otherwise). Symbolic links to directories are not followed
+        to avoid looping through link cycles. With a manifest, an unchanged directory is not
+        listed at all, its previous listing being reused.
+        """
+        mtime_ns = None
+        if self.manifest is not None:
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                return None
+            listing = self.manifest.get(dir_path, mtime_ns)
+            if self.metrics is not None:
+                self.metrics.count('stat_calls')
+            if listing is not None:
+                if self.metrics is not None:
+                    self.metrics.count('dirs_reused')
+                subdirs, file_names = listing
+                return subdirs, [(x, None) for x in file_names], False
+        subdirs = []
         files = []
-        for item in globs:
-            file = File(item)
-            if file.is_file:
-                files.append(file)
-
-        if self.exts_not_used:
-            self.files += files
-        else:
-            if self.exts:
-                for file in files:
-                    if file.ext in self.exts:
-                        self.files.append(file)
-            if self.not_exts:
-                for file in files:
-                    if file.ext not in self.not_exts:
-                        self.files.append(file)
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    name = entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(name)
+                        elif entry.is_file():
+                            files.append((name, entry.stat() if self._wanted(name) else None))
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        if self.metrics is not None:
+            self.metrics.count('dirs_listed')
+            # Only wanted files are stat'ed during the listing
+            self.metrics.count('stat_calls', sum(1 for _, x in files if x is not None))
+        if self.manifest is not None:
+            self.manifest.put(dir_path, mtime_ns, subdirs, [x for x, _ in files])
+        return subdirs, files, True
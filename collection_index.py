@@ -0,0 +1,251 @@
+"""
+"collection_index.py" Persistent index of the unique and duplicate files of a collection
+
+Dedup works on the files of one run, in memory. The index keeps every file found, run after run,
+in a SQLite database indexed by path, size and digest, so that the unique files and duplicates
+of a collection -- or of any folder in it -- are a query away and are kept up to date
+incrementally:
+    * Each run merges the files it finds; a file unchanged since the last run keeps its hash
+      values, a changed one loses them
+    * Files no longer found in a folder walked again are marked gone rather than deleted
+    * A file sharing its size with a file indexed on an earlier run, possibly in another
+      collection path, is hashed as far as needed to tell them apart, as Dedup does; files so
+      resolved are not looked at again until another file of their size is added or changes
+
+Rows are written in batches, each batch in a single transaction. The hash algorithm of the
+values is recorded: opening the index with another algorithm drops them.
+"""
+import os
+
+from archive import ArchiveMember, find_file
+from dedup import Dedup
+from hash_pool import HashPool
+from hashers import Hasher, DEFAULT_ALGORITHM
+from tools import File
+
+INDEX_FILE_NAME = '.photo_collection_index.sqlite'
+
+# Unique files are chosen among identical ones as Dedup does: a file on disk rather than an
+# archive member, then the first path. A file without a digest is unique by size or partial hash.
+_RANKED = ('SELECT path, digest, FIRST_VALUE(path) OVER win AS original, '
+           'ROW_NUMBER() OVER win AS rank FROM files WHERE gone=0 {where} '
+           'WINDOW win AS (PARTITION BY COALESCE(digest, path) ORDER BY member, path)')
+# Sizes shared by files not all hashed and not all resolved since the last one was added
+_UNRESOLVED = ('SELECT size FROM files WHERE gone=0 GROUP BY size HAVING COUNT(*) > 1 '
+               'AND COUNT(digest) < COUNT(*) AND MIN(resolved) = 0')
+
+
+def _prefix_range(dir_path) -> (str, str):
+    """Bounds of the paths under a folder, for a range search of the path index"""
+    prefix = os.path.join(os.path.abspath(dir_path), '')
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class CollectionIndex:
+    """SQLite index of collected files: path, size, modification time, partial hash and digest
+
+    Opening the index starts a new run; files added are recorded as seen in that run. With fresh,
+    everything previously indexed is dropped. Hash values are those of algorithm; values of any
+    other algorithm previously recorded are dropped.
+
+    The files sharing their size must be resolved, as Collect.dedup() does, before the unique
+    files and duplicates are queried.
+    """
+    def __init__(self, db_path, batch_size=10000, fresh=False,
+                 algorithm: str = DEFAULT_ALGORITHM):
+        """db_path is the database file, or a folder in which the default file name is used"""
+        if os.path.isdir(db_path):
+            db_path = os.path.join(db_path, INDEX_FILE_NAME)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.algorithm = algorithm
+        self._hasher = Hasher(algorithm)
+        self._added: [tuple] = []
+        self._hashed: [tuple] = []
+        import sqlite3     # Imported once an index is opened: slow to import
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # Room for the path, size and digest indexes of a few million files, and fewer
+        # checkpoints of the log while ingesting them
+        self._db.execute('PRAGMA cache_size=-262144')
+        self._db.execute('PRAGMA wal_autocheckpoint=16384')
+        with self._db:
+            if fresh:
+                self._db.execute('DROP TABLE IF EXISTS files')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                             'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                             'partial TEXT, digest TEXT, member INTEGER, run INTEGER, '
+                             'gone INTEGER DEFAULT 0, resolved INTEGER DEFAULT 0)')
+            # Indexes written before files were resolved once for all
+            if 'resolved' not in [x[1] for x in self._db.execute('PRAGMA table_info(files)')]:
+                self._db.execute('ALTER TABLE files ADD COLUMN resolved INTEGER DEFAULT 0')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_size ON files (size)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_digest ON files (digest)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            row = self._db.execute("SELECT value FROM meta WHERE key='run'").fetchone()
+            self.run = (row[0] if row and not fresh else 0) + 1
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (self.run,))
+            # Indexes written before the algorithm was recorded hold SHA-1 values
+            row = self._db.execute("SELECT value FROM meta WHERE key='algorithm'").fetchone()
+            if (row[0] if row else 'sha1') != algorithm:
+                self._db.execute('UPDATE files SET partial=NULL, digest=NULL, resolved=0')
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('algorithm', ?)", (algorithm,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        self.flush()
+        return self._db.execute('SELECT COUNT(*) FROM files WHERE gone=0').fetchone()[0]
+
+    def add(self, file: File):
+        """Merge a file found in this run, with its hash values if known"""
+        stats = file.stats
+        self._added.append((file.file_path, stats.st_size, stats.st_mtime_ns, file._partial_hash,
+                            file._hash, isinstance(file, ArchiveMember), self.run))
+        if len(self._added) >= self.batch_size:
+            self.flush()
+
+    def set_hashes(self, file: File):
+        """Record the hash values obtained for an indexed file, unless it changed meanwhile"""
+        stats = file.stats
+        self._hashed.append((file._partial_hash, file._hash, file.file_path, stats.st_size,
+                             stats.st_mtime_ns))
+        if len(self._hashed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write all pending rows in one transaction"""
+        if not self._added and not self._hashed:
+            return
+        with self._db:
+            # A file whose size or modification time changed loses the hash values recorded
+            self._db.executemany(
+                'INSERT INTO files (path, size, mtime_ns, partial, digest, member, run) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET '
+                'partial=CASE WHEN size=excluded.size AND mtime_ns=excluded.mtime_ns '
+                'THEN COALESCE(excluded.partial, partial) ELSE excluded.partial END, '
+                'digest=CASE WHEN size=excluded.size AND mtime_ns=excluded.mtime_ns '
+                'THEN COALESCE(excluded.digest, digest) ELSE excluded.digest END, '
+                'resolved=CASE WHEN size=excluded.size AND mtime_ns=excluded.mtime_ns '
+                'THEN resolved ELSE 0 END, '
+                'size=excluded.size, mtime_ns=excluded.mtime_ns, member=excluded.member, '
+                'run=excluded.run, gone=0', self._added)
+            self._db.executemany(
+                'UPDATE files SET partial=COALESCE(?, partial), digest=COALESCE(?, digest) '
+                'WHERE path=? AND size=? AND mtime_ns=?', self._hashed)
+        self._added = []
+        self._hashed = []
+
+    def mark_gone(self, dir_path, is_gone=None) -> int:
+        """Mark the files under a folder walked this run, but not found, as gone; return their
+        number
+
+        is_gone(path, member, size) tells whether a file not found was actually looked for, as
+        the walk may not have listed its folder or may not have wanted its name; without it,
+        every file not found is gone.
+        """
+        self.flush()
+        rows = self._db.execute('SELECT path, member, size FROM files WHERE path >= ? '
+                                'AND path < ? AND run < ? AND gone=0',
+                                (*_prefix_range(dir_path), self.run)).fetchall()
+        gone = [(path,) for path, member, size in rows
+                if is_gone is None or is_gone(path, member, size)]
+        with self._db:
+            self._db.executemany('UPDATE files SET gone=1 WHERE path=?', gone)
+        return len(gone)
+
+    def resolve(self, pool: HashPool = None, files: [File] = ()):
+        """Hash the files sharing their size with another indexed file, as far as needed to give
+        each distinct content a digest or make it unique by size or partial hash
+
+        files are those of the current run, reused to avoid hashing again; other indexed files
+        are looked up on disk, and marked gone when no longer found. Only the sizes to which a
+        file was added, or whose files changed, since they were last resolved are looked at.
+        """
+        self.flush()
+        known = {file.file_path: file for file in files}
+        rows = self._db.execute(
+            'SELECT path, size, mtime_ns, partial, digest FROM files WHERE gone=0 AND size IN '
+            f'({_UNRESOLVED})').fetchall()
+        archives: {str: {str: ArchiveMember}} = {}
+        candidates = []
+        gone = []
+        changed = []
+        for path, size, mtime_ns, partial, digest in rows:
+            file = known.get(path) or find_file(path, archives)
+            if file is None:
+                gone.append((path,))
+                continue
+            file._hasher = file._hasher or self._hasher
+            if file.size == size and file.stats.st_mtime_ns == mtime_ns:
+                file._partial_hash = file._partial_hash or partial
+                file._hash = file._hash or digest
+            else:
+                changed.append((file.size, file.stats.st_mtime_ns, path))
+            candidates.append(file)
+        with self._db:
+            self._db.executemany('UPDATE files SET gone=1 WHERE path=?', gone)
+            self._db.executemany('UPDATE files SET size=?, mtime_ns=?, partial=NULL, '
+                                 'digest=NULL WHERE path=?', changed)
+        # A file that cannot be read, reported by Dedup, is resolved as unique until it changes
+        Dedup(candidates, pool)
+        for file in candidates:
+            self.set_hashes(file)
+        self.flush()
+        with self._db:
+            self._db.executemany('UPDATE files SET resolved=1 WHERE path=?',
+                                 [(x.file_path,) for x in candidates])
+
+    def _where(self, dir_path) -> (str, tuple):
+        if self._db.execute(f'{_UNRESOLVED} LIMIT 1').fetchone() is not None:
+            raise ValueError(f"Index {self.db_path} holds files sharing their size not told "
+                             f"apart yet: resolve() them, or dedup() the collection, first")
+        if dir_path is None:
+            return '', ()
+        return 'AND path >= ? AND path < ?', _prefix_range(dir_path)
+
+    def copies(self, digest: str) -> [str]:
+        """Return the paths of the indexed files with a digest"""
+        self.flush()
+        return [x for x, in self._db.execute(
+            'SELECT path FROM files WHERE digest=? AND gone=0 ORDER BY path', (digest,))]
+
+    def find_size(self, size: int) -> [str]:
+        """Return the paths of the indexed files of a size"""
+        self.flush()
+        return [x for x, in self._db.execute(
+            'SELECT path FROM files WHERE size=? AND gone=0 ORDER BY path', (size,))]
+
+    def unique(self, dir_path: str = None) -> [str]:
+        """Return the paths of one file for each distinct content, among all indexed files or
+        those under dir_path"""
+        self.flush()
+        where, args = self._where(dir_path)
+        return [x for x, in self._db.execute(
+            f'SELECT path FROM ({_RANKED.format(where=where)}) WHERE rank=1 ORDER BY path',
+            args)]
+
+    def duplicates(self, dir_path: str = None) -> [(str, str)]:
+        """Return the paths of the duplicate files, among all indexed files or those under
+        dir_path, each with the path of the unique file it duplicates"""
+        self.flush()
+        where, args = self._where(dir_path)
+        return self._db.execute(
+            f'SELECT path, original FROM ({_RANKED.format(where=where)}) WHERE rank>1 '
+            f'ORDER BY path', args).fetchall()
+
+    def gone(self) -> [str]:
+        """Return the paths of the files no longer found"""
+        self.flush()
+        return [x for x, in self._db.execute('SELECT path FROM files WHERE gone=1 ORDER BY path')]
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
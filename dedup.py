@@ -0,0 +1,206 @@
+"""
+"dedup.py" Duplicate file detection
+
+Two files are duplicates when their content is identical, regardless of folder, name or
+timestamp. Reading whole files to compare them is the expensive part, so files are narrowed down
+in stages, each stage reading more of a file than the one before, and only for files still
+possibly duplicated:
+    1. Group by exact size -- no read needed; a file with a size of its own is unique.
+    2. Group by partial hash of the first and last few KB of the file.
+    3. Group by full hash, only for files whose partial hashes collide.
+A file that vanished or cannot be read since it was found is reported and left out, rather than
+stopping the dedup of a whole collection.
+"""
+from archive import ArchiveMember
+from hash_pool import HashPool, obtain
+from tools import File, PARTIAL_HASH_BLOCK
+
+
+def _group(files: [File], key) -> [[File]]:
+    groups: {object: [File]} = {}
+    for file in files:
+        groups.setdefault(key(file), []).append(file)
+    return list(groups.values())
+
+
+def _readable(files: [File], attr, pool: HashPool = None) -> {str}:
+    """Obtain the attr value of each file, on pool if given; return the paths of the files that
+    could not be read"""
+    values = pool.map(files, attr, skip_errors=True) if pool else [obtain(x, attr) for x in files]
+    return {file.file_path for file, value in zip(files, values) if value is None}
+
+
+class Dedup:
+    """Split a list of files into unique files and duplicates of those unique files
+
+    unique      -- one file for each distinct content, in the order the files were given; a file
+                   on disk is preferred over an archive member, which would need extracting
+    duplicates  -- every other file, in the order the files were given
+    original    -- maps the path of each duplicate to the unique File it duplicates
+    failed      -- files that could not be read, in neither list
+
+    partial_hashed and full_hashed count the files read at the partial and full hash stages.
+    """
+    def __init__(self, files: [File], pool: HashPool = None):
+        """pool, if given, reads the files of each stage concurrently"""
+        self.unique: [File] = []
+        self.duplicates: [File] = []
+        self.original: {str: File} = {}
+        self.failed: [File] = []
+
+        # The same path may be collected twice through overlapping collection paths
+        order: {str: int} = {}
+        for file in files:
+            order.setdefault(file.file_path, len(order))
+        files = {file.file_path: file for file in files}.values()
+
+        groups: [[File]] = []
+        size_groups = []
+        for size_group in _group(files, lambda x: x.size):
+            if len(size_group) == 1:
+                groups.append(size_group)
+            else:
+                size_groups.append(size_group)
+        candidates = [file for group in size_groups for file in group]
+        self.partial_hashed = len(candidates)
+        failed = _readable(candidates, 'partial_hash', pool)
+
+        partial_groups = []
+        for size_group in size_groups:
+            if failed:
+                self.failed += [x for x in size_group if x.file_path in failed]
+                size_group = [x for x in size_group if x.file_path not in failed]
+            for partial_group in _group(size_group, lambda x: x.partial_hash):
+                # The partial hash of a small file covers all of its content
+                if len(partial_group) == 1 or partial_group[0].size <= 2 * PARTIAL_HASH_BLOCK:
+                    groups.append(partial_group)
+                else:
+                    partial_groups.append(partial_group)
+        candidates = [file for group in partial_groups for file in group]
+        self.full_hashed = len(candidates)
+        failed = _readable(candidates, 'hash', pool)
+
+        for partial_group in partial_groups:
+            if failed:
+                self.failed += [x for x in partial_group if x.file_path in failed]
+                partial_group = [x for x in partial_group if x.file_path not in failed]
+            groups += _group(partial_group, lambda x: x.hash)
+
+        for group in groups:
+            group.sort(key=lambda x: (isinstance(x, ArchiveMember), order[x.file_path]))
+            self.unique.append(group[0])
+            for file in group[1:]:
+                self.duplicates.append(file)
+                self.original[file.file_path] = group[0]
+        self.unique.sort(key=lambda x: order[x.file_path])
+        self.duplicates.sort(key=lambda x: order[x.file_path])
+
+
+class IncrementalDedup:
+    """Dedup state kept up to date as files arrive, change and go, one file or batch at a time
+
+    As in Dedup, a file is only hashed once another file of the same size is known -- at which
+    point the earlier files of that size are hashed too, if not already. The file a new file
+    duplicates is the earliest one known with the same content. A file added again under a known
+    path replaces the earlier one, as a file changed since.
+
+    dedup, if given, is the Dedup of the files known to start with, whose hash values are reused.
+    """
+    def __init__(self, dedup: Dedup = None):
+        self._files: {str: File} = {}
+        self._counts: {int: int} = {}
+        # Files of each size not hashed yet, and files by hash value, earliest first
+        self._unhashed: {int: [File]} = {}
+        self._by_hash: {str: [File]} = {}
+        if dedup is not None:
+            groups = {file.file_path: [file] for file in dedup.unique}
+            for file in dedup.duplicates:
+                groups[dedup.original[file.file_path].file_path].append(file)
+            for group in groups.values():
+                for file in group:
+                    self._files[file.file_path] = file
+                    self._counts[file.size] = self._counts.get(file.size, 0) + 1
+                # Small duplicates are told apart by partial hash only: their hash is cheap
+                if len(group) > 1 or group[0]._hash is not None:
+                    self._by_hash.setdefault(group[0].hash, []).extend(group)
+                else:
+                    self._unhashed.setdefault(group[0].size, []).append(group[0])
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, file_path):
+        return file_path in self._files
+
+    def get(self, file_path) -> File:
+        """Return the known file of a path, or None"""
+        return self._files.get(file_path)
+
+    def add(self, file: File) -> File:
+        """Add a file; return the earlier file it duplicates, or None when unique so far"""
+        self.remove(file.file_path)
+        self._files[file.file_path] = file
+        count = self._counts.get(file.size, 0)
+        self._counts[file.size] = count + 1
+        if count == 0:
+            self._unhashed[file.size] = [file]
+            return None
+        for earlier in self._unhashed.pop(file.size, ()):
+            self._by_hash.setdefault(earlier.hash, []).append(earlier)
+        group = self._by_hash.setdefault(file.hash, [])
+        group.append(file)
+        return group[0] if group[0] is not file else None
+
+    def add_all(self, files: [File], pool: HashPool = None) -> [(File, File)]:
+        """Add files, returning each with the earlier file it duplicates, or None; pool, if
+        given, reads the files to be hashed concurrently"""
+        files = list({file.file_path: file for file in files}.values())
+        if pool:
+            sizes: {int: int} = {}
+            for file in files:
+                old = self._files.get(file.file_path)
+                sizes[file.size] = sizes.get(file.size, 0) + 1 - (
+                    old is not None and old.size == file.size)
+            hashed = [file for file in files
+                      if self._counts.get(file.size, 0) + sizes[file.size] > 1]
+            for size in {file.size for file in hashed}:
+                hashed += self._unhashed.get(size, ())
+            pool.map([file for file in hashed if file._hash is None])
+        return [(file, self.add(file)) for file in files]
+
+    def remove(self, file_path) -> File:
+        """Forget the file of a path; return it, or None if not known"""
+        file = self._files.pop(file_path, None)
+        if file is None:
+            return None
+        count = self._counts.pop(file.size) - 1
+        if count:
+            self._counts[file.size] = count
+        unhashed = self._unhashed.get(file.size, ())
+        if any(x is file for x in unhashed):
+            unhashed.remove(file)
+            if not unhashed:
+                del self._unhashed[file.size]
+        else:
+            group = self._by_hash[file._hash]
+            group.remove(file)
+            if not group:
+                del self._by_hash[file._hash]
+        return file
+
+    def paths(self) -> [str]:
+        """Return the paths of the known files"""
+        return list(self._files)
+
+
+def stream_dedup(files):
+    """Generate each file with the earlier file it duplicates, or None when unique so far
+
+    The files are taken one at a time, as from Collect.iter_files() or Collect.stream(), so a
+    file's fate is known as soon as it arrives. As in Dedup, a file is only hashed once another
+    file of the same size has been seen -- at which point the earlier files of that size are
+    hashed too, if not already. Each path is expected only once.
+    """
+    dedup = IncrementalDedup()
+    for file in files:
+        yield file, dedup.add(file)
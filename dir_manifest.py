@@ -0,0 +1,83 @@
+"""
+"dir_manifest.py" Folder listings kept between collection runs
+
+Adding, removing or renaming a file in a folder changes the folder's modification time. A
+manifest records the listing of each folder walked -- its modification time, subfolder names and
+file names -- so that a rerun needs no listing of an unchanged folder: a folder whose
+modification time is unchanged reuses its recorded listing instead of being listed again, and
+only changed folders are read.
+
+A file rewritten in place does not change its folder's modification time, so the stats of the
+files are not recorded: each wanted file of a reused listing is stat'ed again when its size or
+hash is needed, and a hash cached for its old size and modification time is not used.
+"""
+import os
+import pickle
+import time
+
+MANIFEST_FILE_NAME = '.photo_dir_manifest.pickle'
+
+# A folder modified this close to the time it was listed may have changed within the same tick of
+# a coarse file system clock (2 seconds on FAT), so its listing is not trusted on the next run.
+RACY_NS = 2_000_000_000
+
+
+class DirManifest:
+    """Recorded folder listings, saved to and loaded from a pickle file
+
+    Each folder maps to (mtime_ns, listed_ns, subfolder names, file names).
+    """
+    def __init__(self, file_path):
+        """file_path is the manifest file, or a folder in which the default file name is used"""
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, MANIFEST_FILE_NAME)
+        self.file_path = file_path
+        self._dirs: {str: tuple} = {}
+        self._seen: set = set()
+        self._roots: [str] = []
+        self.reused = 0
+        self.listed = 0
+        if os.path.isfile(file_path):
+            with open(file_path, 'rb') as f:
+                self._dirs = pickle.load(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
+
+    def add_root(self, dir_path):
+        """Note a collection path walked this run; on save, folders under it that were not seen
+        are dropped as removed"""
+        self._roots.append(os.path.join(dir_path, ''))
+
+    def get(self, dir_path, mtime_ns) -> ([str], [str]):
+        """Return the recorded listing of a folder if its current modification time, mtime_ns,
+        shows it unchanged; else None"""
+        entry = self._dirs.get(dir_path)
+        if entry is None:
+            return None
+        recorded_ns, listed_ns, subdirs, files = entry
+        if recorded_ns != mtime_ns or listed_ns - recorded_ns < RACY_NS:
+            return None
+        self._seen.add(dir_path)
+        self.reused += 1
+        return subdirs, files
+
+    def put(self, dir_path, mtime_ns, subdirs: [str], file_names: [str]):
+        """Record the listing of a folder taken when its modification time was mtime_ns"""
+        self._dirs[dir_path] = (mtime_ns, time.time_ns(), subdirs, file_names)
+        self._seen.add(dir_path)
+        self.listed += 1
+
+    def save(self):
+        """Write the manifest, replacing the previous file only once completely written"""
+        for dir_path in list(self._dirs):
+            if dir_path not in self._seen and any(
+                    os.path.join(dir_path, '').startswith(x) for x in self._roots):
+                del self._dirs[dir_path]
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(self._dirs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.file_path)
@@ -0,0 +1,261 @@
+"""
+"external_dedup.py" Dedup within a memory budget
+
+Dedup holds every File of the collection at once, which a volume of millions of files does not
+fit in the memory of a small machine. ExternalDedup takes the files one at a time, as the walker
+finds them, and keeps at most a set amount of memory however many there are:
+    1. A record of each file -- size, order found and path -- is buffered; whenever the buffer
+       reaches the budget, it is sorted by size and written to a temporary file as a sorted run.
+    2. The runs are merged, streaming, into a single sequence in size order. A file with a size
+       of its own is unique, as in Dedup, without being read.
+    3. Files sharing their size are gathered, whole size groups at a time up to the budget, and
+       told apart by Dedup -- partial, then full hash -- since duplicates always share their
+       size.
+    4. A size group too large for the budget on its own is spilled in turn: its files are
+       partially hashed a budget at a time into runs sorted by partial hash, merged, and those
+       sharing a partial hash fully hashed the same way into runs sorted by hash.
+Only the buffer or the batch of size groups in hand, and one record per run being merged, are
+held in memory.
+"""
+import heapq
+from itertools import chain, groupby
+from operator import itemgetter
+import os
+import shutil
+import tempfile
+
+from archive import ArchiveMember, find_file
+from dedup import Dedup
+from hash_pool import HashPool, obtain
+from tools import File, PARTIAL_HASH_BLOCK
+
+# Default memory budget, in bytes
+MEMORY_BUDGET = 64 * 2**20
+
+# Rough memory taken by a buffered record, and by a File being deduplicated, besides its path
+RECORD_COST = 150
+FILE_COST = 700
+
+# Archives whose members are kept listed while a batch is read
+ARCHIVES_LISTED = 16
+
+# Bytes of a run file read at a time
+RUN_BLOCK = 2**16
+
+
+def _encode(record: tuple) -> bytes:
+    """Encode a run record, a tuple ending with a path: tab-separated fields ending with a NUL,
+    the only character a path cannot hold"""
+    return os.fsencode('\t'.join(map(str, record))) + b'\0'
+
+
+def _records(run_path):
+    """Generate the fields of each record of a run file, as a string"""
+    with open(run_path, 'rb') as f:
+        rest = b''
+        while block := f.read(RUN_BLOCK):
+            records = (rest + block).split(b'\0')
+            rest = records.pop()
+            for record in records:
+                yield os.fsdecode(record)
+
+
+class ExternalDedup:
+    """Bounded-memory dedup of a stream of files
+
+    memory      -- bytes of records and files held at a time, roughly
+    pool        -- HashPool reading the files of each batch concurrently
+    temp_dir    -- folder of the sorted runs, by default the system's temporary folder
+    prepare     -- function called with each File rebuilt from its path, such as one attaching
+                   a hash cache, returning the File
+    runs and records count the sorted runs written and the files taken.
+    """
+    def __init__(self, memory: int = MEMORY_BUDGET, pool: HashPool = None, temp_dir=None,
+                 prepare=None):
+        self.memory = memory
+        self.pool = pool
+        self.temp_dir = temp_dir
+        self.prepare = prepare
+        self.runs = 0
+        self.records = 0
+        self._archives: {str: {str: File}} = {}
+
+    def run(self, files):
+        """Generate the path of each file with the path of the file it duplicates, or None when
+        unique; files may be any iterable of File, including a generator, and are generated in
+        size order. Files no longer found, or that cannot be read, are left out."""
+        run_dir = tempfile.mkdtemp(prefix='dedup_runs_', dir=self.temp_dir)
+        try:
+            runs = self._sorted_runs(files, run_dir)
+            yield from self._merge(heapq.merge(*runs), run_dir)
+        finally:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    def _sorted_runs(self, files, run_dir) -> list:
+        """Buffer the records of files, spilling them to sorted runs; return the runs, the last
+        one still in memory"""
+        runs = []
+        buffer = []
+        used = 0
+        for file in files:
+            path = file.file_path
+            buffer.append((file.size, self.records, path))
+            self.records += 1
+            used += RECORD_COST + len(path)
+            if used >= self.memory:
+                runs.append(self._spill(buffer, run_dir))
+                buffer = []
+                used = 0
+        buffer.sort()
+        runs.append(iter(buffer))
+        return runs
+
+    def _spill(self, buffer, run_dir):
+        """Write a buffer as a sorted run; return a generator reading it back"""
+        buffer.sort()
+        return self._read_run(self._write_run(buffer, run_dir))
+
+    def _write_run(self, records, run_dir) -> str:
+        """Write records, tuples ending with a path, to a new run file; return its path"""
+        run_path = os.path.join(run_dir, f'{self.runs}.run')
+        self.runs += 1
+        with open(run_path, 'wb') as f:
+            for record in records:
+                f.write(_encode(record))
+        return run_path
+
+    @staticmethod
+    def _read_run(run_path):
+        for record in _records(run_path):
+            size, order, path = record.split('\t', 2)
+            yield int(size), int(order), path
+
+    @staticmethod
+    def _read_hashed_run(run_path):
+        for record in _records(run_path):
+            value, member, order, path = record.split('\t', 3)
+            yield value, int(member), int(order), path
+
+    def _merge(self, records, run_dir):
+        """Generate the fate of each file from the merged records, in size order"""
+        batch = []
+        used = 0
+        for size, group in groupby(records, key=itemgetter(0)):
+            first = next(group)
+            held = [first]
+            held_used = FILE_COST + len(first[2])
+            for record in group:
+                held.append(record)
+                held_used += FILE_COST + len(record[2])
+                if held_used >= self.memory:
+                    # Too large a group to be held: the records still to come are streamed
+                    yield from self._resolve(batch)
+                    batch = []
+                    used = 0
+                    yield from self._spill_group(size, chain(held, group), run_dir)
+                    break
+            else:
+                if len(held) == 1:
+                    yield first[2], None
+                    continue
+                batch += held
+                used += held_used
+                if used >= self.memory:
+                    yield from self._resolve(batch)
+                    batch = []
+                    used = 0
+        yield from self._resolve(batch)
+
+    def _spill_group(self, size, records, run_dir):
+        """Tell apart the files of a size group too large to be held at once: by partial hash,
+        then those sharing one by full hash, each through sorted runs
+
+        Identical files are sorted next to each other, the unique one first: a file on disk
+        before an archive member, then the first found, as Dedup chooses it.
+        """
+        merged = heapq.merge(*self._hashed_runs(records, 'partial_hash', run_dir))
+        if size <= 2 * PARTIAL_HASH_BLOCK:
+            # The partial hash of a small file covers all of its content
+            yield from self._fates(merged)
+            return
+        with open(os.path.join(run_dir, f'{self.runs}.run'), 'wb') as shared:
+            self.runs += 1
+            for _, group in groupby(merged, key=itemgetter(0)):
+                first = next(group)
+                second = next(group, None)
+                if second is None:
+                    yield first[3], None
+                    continue
+                for _, _, order, path in chain((first, second), group):
+                    shared.write(_encode((size, order, path)))
+            shared.flush()
+            merged = heapq.merge(*self._hashed_runs(self._read_run(shared.name), 'hash',
+                                                    run_dir))
+            yield from self._fates(merged)
+
+    def _hashed_runs(self, records, attr, run_dir) -> list:
+        """Hash the files of records, as many as the budget holds at a time, to runs sorted by
+        their attr hash value; return generators reading back the runs"""
+        runs = []
+        files = []
+        used = 0
+        for _, order, path in records:
+            file = self._file(path)
+            if file is not None:
+                files.append((order, file))
+                used += FILE_COST + len(path)
+            if used >= self.memory:
+                runs.append(self._hashed_run(files, attr, run_dir))
+                files = []
+                used = 0
+        if files:
+            runs.append(self._hashed_run(files, attr, run_dir))
+        return runs
+
+    def _hashed_run(self, files: [(int, File)], attr, run_dir):
+        if self.pool:
+            values = self.pool.map([file for _, file in files], attr, skip_errors=True)
+        else:
+            values = [obtain(file, attr) for _, file in files]
+        # Files that could not be read are left out
+        run_path = self._write_run(sorted(
+            (value, int(isinstance(file, ArchiveMember)), order, file.file_path)
+            for (order, file), value in zip(files, values) if value is not None), run_dir)
+        if len(self._archives) > ARCHIVES_LISTED:
+            self._archives.clear()
+        return self._read_hashed_run(run_path)
+
+    @staticmethod
+    def _fates(merged):
+        """Generate the fate of each file from records sorted by hash value, the first of each
+        hash value being unique"""
+        for _, group in groupby(merged, key=itemgetter(0)):
+            original = next(group)[3]
+            yield original, None
+            for record in group:
+                yield record[3], original
+
+    def _resolve(self, batch):
+        """Tell apart the files of whole size groups, in the order found"""
+        files = []
+        batch.sort(key=itemgetter(1))
+        for _, _, path in batch:
+            file = self._file(path)
+            if file is not None:
+                files.append(file)
+        dedup = Dedup(files, self.pool)
+        failed = {x.file_path for x in dedup.failed}
+        for file in files:
+            if file.file_path in failed:
+                continue
+            original = dedup.original.get(file.file_path)
+            yield file.file_path, original.file_path if original is not None else None
+        if len(self._archives) > ARCHIVES_LISTED:
+            self._archives.clear()
+
+    def _file(self, path) -> File | None:
+        """Rebuild the File of a path; None if no longer found"""
+        file = find_file(path, self._archives)
+        if file is not None and self.prepare is not None:
+            file = self.prepare(file)
+        return file
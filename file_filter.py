@@ -0,0 +1,136 @@
+"""
+"file_filter.py" Compiled file and folder filter for the collection walker
+
+All the conditions on what to collect are compiled once into a FileFilter, which the walker asks
+about each folder before listing it and each file name before building anything for it:
+    * File name glob patterns, compiled into a single regular expression
+    * Extensions to keep or to skip, as case-insensitive sets
+    * Folders to leave out, such as version control, recycle bins and thumbnail caches, whose
+      whole subtree is pruned without ever being listed
+    * Folders to keep, so that only their subtrees are collected
+    * Maximum folder depth, and minimum and maximum file size
+"""
+from fnmatch import translate
+import os
+import re
+
+from tools import IS_WINDOWS
+
+# Folders never holding photos worth collecting: package and tool folders, recycle bins and NAS
+# thumbnail caches. Hidden folders (".git", ".Trash-1000", ".thumbnails", ...) are skipped anyway.
+DEFAULT_EXCLUDE_DIRS = ('node_modules', '__pycache__', '$RECYCLE.BIN', 'RECYCLER',
+                        'System Volume Information', '@eaDir', '@Recycle', '#recycle')
+
+
+def _compile(patterns, flags=0) -> re.Pattern | None:
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{translate(x)})' for x in patterns), flags)
+
+
+def _exts(exts) -> frozenset | None:
+    if not exts:
+        return None
+    if isinstance(exts, str):
+        exts = [exts]
+    return frozenset(x.lower() if x[0] == '.' else f'.{x.lower()}' for x in exts)
+
+
+class FileFilter:
+    """Decides which folders are walked and which files are collected
+
+    patterns      -- file name globs; by default all names. As with glob, a hidden name (starting
+                     with ".") only matches a pattern that also starts with "."
+    exts          -- extensions to collect, with or without the dot, in any case
+    not_exts      -- extensions never to collect
+    exclude_dirs  -- folder globs whose subtrees are skipped. A glob without "/" is matched
+                     against the folder name at any depth, one with "/" against the folder path
+                     relative to the collection path
+    include_dirs  -- folder globs, matched as for exclude_dirs; when given, files are only
+                     collected in matching folders and their subtrees, and a relative path glob
+                     also prunes folders that cannot lead to a match
+    max_depth     -- deepest folder level walked; 0 is the collection path itself
+    min_size, max_size -- file size limits, in bytes
+    """
+    def __init__(self, patterns: [str] = None, exts: [str] = None, not_exts: [str] = None, *,
+                 exclude_dirs: [str] = DEFAULT_EXCLUDE_DIRS,
+                 include_dirs: [str] = None,
+                 max_depth: int = None,
+                 min_size: int = None,
+                 max_size: int = None):
+        # Names are matched the way the file system compares them
+        flags = re.IGNORECASE if IS_WINDOWS else 0
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        patterns = patterns or []
+        self._names = None if not patterns or '*' in patterns else _compile(patterns, flags)
+        self._hidden_names = _compile([x for x in patterns if x[0] == '.'], flags)
+        self.exts = _exts(exts)
+        self.not_exts = _exts(not_exts)
+        self.max_depth = max_depth
+        self.min_size = min_size
+        self.max_size = max_size
+        self.sized = min_size is not None or max_size is not None
+
+        # Folder names are compared ignoring case: excluded system folders vary in case
+        flags = re.IGNORECASE
+        exclude_dirs = list(exclude_dirs or [])
+        self._exclude_names = _compile([x for x in exclude_dirs if '/' not in x], flags)
+        self._exclude_paths = _compile([x for x in exclude_dirs if '/' in x], flags)
+        include_dirs = list(include_dirs or [])
+        self.includes = bool(include_dirs)
+        self._include_names = _compile([x for x in include_dirs if '/' not in x], flags)
+        self._include_paths = _compile([x for x in include_dirs if '/' in x], flags)
+        # Leading parts of the relative path globs, to tell which folders may lead to a match
+        self._include_prefixes = [None if '**' in x else
+                                  [re.compile(translate(part), flags) for part in x.split('/')]
+                                  for x in include_dirs if '/' in x]
+
+    def wants_name(self, file_name: str) -> bool:
+        """Check a file name against the patterns and extensions"""
+        if file_name[0] == '.':
+            if self._hidden_names is None or not self._hidden_names.match(file_name):
+                return False
+        elif self._names is not None and not self._names.match(file_name):
+            return False
+        if self.exts is None and self.not_exts is None:
+            return True
+        ext = os.path.splitext(file_name)[1].lower()
+        if self.exts is not None and ext not in self.exts:
+            return False
+        return self.not_exts is None or ext not in self.not_exts
+
+    def wants_size(self, size: int) -> bool:
+        if self.min_size is not None and size < self.min_size:
+            return False
+        return self.max_size is None or size <= self.max_size
+
+    def dir_state(self, name: str, rel_path: str, depth: int, parent_included: bool):
+        """Decide on a subfolder before it is listed: None to prune its subtree, otherwise
+        whether its own files are collected
+
+        rel_path is the folder path relative to the collection path, with "/" separators.
+        """
+        if name[0] == '.' or self.max_depth is not None and depth > self.max_depth:
+            return None
+        if self._exclude_names is not None and self._exclude_names.match(name):
+            return None
+        if self._exclude_paths is not None and self._exclude_paths.match(rel_path):
+            return None
+        if parent_included:
+            return True
+        if self._include_names is not None and self._include_names.match(name):
+            return True
+        if self._include_paths is not None and self._include_paths.match(rel_path):
+            return True
+        if self._include_names is not None:
+            # A matching name may be found at any depth below
+            return False
+        parts = rel_path.split('/')
+        for prefix in self._include_prefixes:
+            if prefix is None:
+                # A "**" glob may match at any depth below
+                return False
+            if len(parts) < len(prefix) and all(x.match(y) for x, y in zip(prefix, parts)):
+                return False
+        return None
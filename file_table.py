@@ -0,0 +1,142 @@
+"""
+"file_table.py" Columnar store of collected file records
+
+A list of File objects costs a few hundred bytes per file, which adds up to gigabytes for a
+collection of millions of files. A FileTable keeps the same records in columns instead: folder
+paths are stored once and referenced by number, and sizes, modification times and binary
+digests are packed in arrays. Lookups by size or digest use sorted indexes over the arrays, so
+no per-file object is created unless asked for.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+import os
+
+from archive import find_file, MEMBER_SEP
+from tools import File
+
+
+class FileTable:
+    """Columnar file records: folder, name, size, modification time and digest
+
+    Rows are numbered in the order added. A row's digest is all zero bytes until known.
+    """
+    def __init__(self, digest_size=20):
+        self.digest_size = digest_size
+        self.dirs: [str] = []
+        self._dir_ids: {str: int} = {}
+        self.dir_ids = array('I')
+        self.names: [str] = []
+        self.sizes = array('Q')
+        self.mtimes = array('q')
+        self.digests = bytearray()
+        self._by_size: array = None
+        self._by_digest: array = None
+        self._none = bytes(digest_size)
+        # Members of the archives whose member rows were materialized
+        self._archives: {str: {str: File}} = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, dir_path: str, file_name: str, size: int, mtime_ns: int,
+               digest: bytes = None) -> int:
+        """Add a record; return its row number"""
+        dir_id = self._dir_ids.get(dir_path)
+        if dir_id is None:
+            dir_id = self._dir_ids[dir_path] = len(self.dirs)
+            self.dirs.append(dir_path)
+        self.dir_ids.append(dir_id)
+        self.names.append(file_name)
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+        self.digests += digest or self._none
+        self._by_size = None
+        self._by_digest = None
+        return len(self.names) - 1
+
+    def add(self, file: File) -> int:
+        """Add the record of a File, including its hash if already known"""
+        stats = file.stats
+        digest = bytes.fromhex(file._hash) if file._hash is not None else None
+        return self.append(file.dir_path, file.file_name, stats.st_size, stats.st_mtime_ns,
+                           digest)
+
+    def path(self, row: int) -> str:
+        return os.path.join(self.dirs[self.dir_ids[row]], self.names[row])
+
+    def digest(self, row: int) -> bytes | None:
+        digest = bytes(self.digests[row * self.digest_size:(row + 1) * self.digest_size])
+        return None if digest == self._none else digest
+
+    def set_digest(self, row: int, digest: bytes | str):
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest)
+        self.digests[row * self.digest_size:(row + 1) * self.digest_size] = digest
+        self._by_digest = None
+
+    def file(self, row: int) -> File | None:
+        """Materialize a File for a row: an ArchiveMember for a member of an archive, or None if
+        no longer found in its archive"""
+        path = self.path(row)
+        if MEMBER_SEP in path:
+            file = find_file(path, self._archives)
+            if file is None:
+                return None
+        else:
+            file = File(path)
+        digest = self.digest(row)
+        if digest is not None:
+            file._hash = digest.hex()
+        return file
+
+    def _digest_key(self, row):
+        return self.digests[row * self.digest_size:(row + 1) * self.digest_size]
+
+    def _size_order(self) -> array:
+        if self._by_size is None:
+            self._by_size = array('I', sorted(range(len(self)), key=self.sizes.__getitem__))
+        return self._by_size
+
+    def _digest_order(self) -> array:
+        if self._by_digest is None:
+            self._by_digest = array('I', sorted(range(len(self)), key=self._digest_key))
+        return self._by_digest
+
+    def find_size(self, size: int) -> [int]:
+        """Return the rows of files of a given size"""
+        order = self._size_order()
+        key = self.sizes.__getitem__
+        return list(order[bisect_left(order, size, key=key):bisect_right(order, size, key=key)])
+
+    def find_digest(self, digest: bytes | str) -> [int]:
+        """Return the rows of files with a given digest"""
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest)
+        order = self._digest_order()
+        key = self._digest_key
+        return list(order[bisect_left(order, digest, key=key):
+                          bisect_right(order, digest, key=key)])
+
+    def same_size(self):
+        """Generate the lists of rows sharing a size with at least one other row"""
+        yield from self._runs(self._size_order(), self.sizes.__getitem__)
+
+    def same_digest(self):
+        """Generate the lists of rows of identical hashed content, two or more rows each"""
+        yield from self._runs(self._digest_order(), self._digest_key, skip=self._none)
+
+    @staticmethod
+    def _runs(order, key, skip=None):
+        run = []
+        run_key = None
+        for row in order:
+            row_key = key(row)
+            if run and row_key == run_key:
+                run.append(row)
+                continue
+            if len(run) > 1 and run_key != skip:
+                yield run
+            run = [row]
+            run_key = row_key
+        if len(run) > 1 and run_key != skip:
+            yield run
@@ -0,0 +1,92 @@
+"""
+"hash_cache.py" Persistent file hash cache
+
+Hashing reads every byte of a file, which for a large photo library takes hours. The hash of a
+file is kept in a small SQLite database so that a rerun only needs to read files that are new or
+have changed since the hash was taken. An entry is only trusted while the file's path, device,
+inode, size and modification time all match what was recorded with it, and was taken with the
+hash algorithm of the file asking.
+"""
+import os
+import threading
+
+CACHE_FILE_NAME = '.photo_hash_cache.sqlite'
+
+
+class HashCache:
+    """SQLite store of file hash values
+
+    New hash values are held in memory and written in batches of batch_size, each batch as a
+    single transaction; call flush (or close) to write any remainder. A cache may be shared by
+    threads hashing files concurrently.
+    """
+    def __init__(self, db_path, batch_size=1000):
+        """db_path is the database file, or a folder in which the default file name is used"""
+        if os.path.isdir(db_path):
+            db_path = os.path.join(db_path, CACHE_FILE_NAME)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._pending: [tuple] = []
+        self._lock = threading.Lock()
+        import sqlite3     # Imported once a cache is opened: slow to import
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                         'path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, size INTEGER, '
+                         'mtime_ns INTEGER, hash TEXT, algorithm TEXT)')
+        columns = [x[1] for x in self._db.execute('PRAGMA table_info(hashes)')]
+        if 'algorithm' not in columns:
+            # Caches written before the algorithm was recorded only hold SHA-1 values
+            self._db.execute("ALTER TABLE hashes ADD COLUMN algorithm TEXT DEFAULT 'sha1'")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _key(file):
+        stats = file.stats
+        return (file.file_path, stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime_ns,
+                file.hasher.name)
+
+    def get(self, file):
+        """Return the cached hash of a File, or None if unknown or the file has changed"""
+        path, *key = self._key(file)
+        with self._lock:
+            row = self._db.execute('SELECT dev, ino, size, mtime_ns, algorithm, hash FROM hashes '
+                                   'WHERE path=?', (path,)).fetchone()
+        if row is None or list(row[:5]) != key:
+            return None
+        return row[5]
+
+    def put(self, file, hash_value):
+        """Record the hash of a File; written to the database with the next batch"""
+        with self._lock:
+            path, dev, ino, size, mtime_ns, algorithm = self._key(file)
+            self._pending.append((path, dev, ino, size, mtime_ns, hash_value, algorithm))
+            if len(self._pending) >= self.batch_size:
+                self._write()
+
+    def flush(self):
+        """Write all pending hash values in one transaction"""
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if not self._pending:
+            return
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO hashes '
+                                 '(path, dev, ino, size, mtime_ns, hash, algorithm) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)', self._pending)
+        self._pending = []
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
@@ -0,0 +1,175 @@
+"""
+"hash_pool.py" Concurrent file hashing
+
+hashlib releases the GIL while digesting large buffers, so hashing files on a pool of threads
+keeps several cores and the disk queue busy. Reads are scheduled per device (st_dev) by an
+IOScheduler, see io_scheduler.py: a slow disk, such as a spinning USB drive, is read by a single
+stream in on-disk order rather than thrashed by many concurrent readers, while files on other
+devices keep the remaining workers busy.
+"""
+import heapq
+from functools import partial
+from operator import attrgetter
+import os
+import threading
+
+from io_scheduler import IOScheduler, DEFAULT_SCHEDULER
+from tools import Error, File
+
+
+def obtain(file: File, attr='hash'):
+    """Return the attr value of a file, or None when the file vanished or cannot be read since
+    it was found, the error being reported"""
+    try:
+        return getattr(file, attr)
+    except OSError as exc:
+        Error(f"Read {file.file_path} -- {exc}", exit=False)
+        return None
+
+
+class HashPool:
+    """Bounded thread pool for File hash values
+
+    jobs        -- number of worker threads
+    per_device  -- if given, the number of files read at the same time from any one device,
+                   instead of the number set by the scheduler's policy for the device
+    scheduler   -- IOScheduler setting the number of reads at the same time from each device
+                   and their order
+    """
+    def __init__(self, jobs: int = None, per_device: int = None, scheduler: IOScheduler = None):
+        self.jobs = jobs or min(32, (os.cpu_count() or 1) + 4)
+        self.per_device = per_device
+        self.scheduler = scheduler or DEFAULT_SCHEDULER
+
+    def map(self, files: [File], attr='hash', skip_errors=False) -> list:
+        """Return the attr ('hash' or 'partial_hash') value of each file, in the order given
+
+        All files are known in advance, so the reads of each device are ordered over the whole
+        list. With skip_errors, a file that cannot be read has the value None, the error being
+        reported, rather than the error being raised.
+        """
+        return self.apply(partial(obtain, attr=attr) if skip_errors else attrgetter(attr), files)
+
+    def apply(self, func, files: [File]) -> list:
+        """Return func(file) for each file, in the order given, calls scheduled as reads"""
+        files = list(files)
+        return [value for _, value in self._run(files, func, len(files))]
+
+    def imap(self, files, attr='hash'):
+        """Generate the attr value of each file, in the order given
+
+        files may be any iterable, including a generator; it is consumed only a window ahead of
+        the results taken, so memory stays bounded. An exception raised getting a value is
+        raised again when that value's turn comes.
+        """
+        for _, value in self._run(files, attrgetter(attr)):
+            yield value
+
+    def iter_hashed(self, files, attr='hash'):
+        """Generate each file once its attr value is obtained, in the order given, as for imap"""
+        for file, _ in self._run(files, attrgetter(attr)):
+            yield file
+
+    def _run(self, files, func, window: int = None):
+        """Generate each file and its func value, in the order given, taking at most window
+        files ahead of those generated; the files taken are queued by device, in the order of
+        the device's policy
+
+        A file not stat'ed yet is stat'ed on the pool; one that cannot be is not queued, func
+        being called at once for the error, if any, to be that file's result.
+        """
+        files = iter(files)
+        window = window or self.jobs * 4
+        queued: {int: list} = {}
+        streams: {int: int} = {}
+        in_flight: {int: int} = {}
+        # Files whose position in the reads of their device is being looked up
+        placing: {int: int} = {}
+        done: {int: tuple} = {}
+        cond = threading.Condition()
+        taken = 0
+        next_index = 0
+        exhausted = False
+
+        def run(index, file, dev=None):
+            try:
+                result = (True, file, func(file))
+            except BaseException as exc:
+                result = (False, file, exc)
+            with cond:
+                done[index] = result
+                if dev is not None:
+                    in_flight[dev] -= 1
+                cond.notify()
+
+        def locate(index, file):
+            try:
+                dev = file.stats.st_dev
+            except OSError:
+                run(index, file)
+                return
+            queue(index, file, dev)
+
+        def queue(index, file, dev):
+            policy = self.scheduler.policy(dev)
+            with cond:
+                if dev not in queued:
+                    queued[dev] = []
+                    streams[dev] = self.per_device or policy.streams or self.jobs
+                    in_flight[dev] = 0
+                    placing[dev] = 0
+                if policy.order == 'extent':
+                    # Looking up the extent opens the file: done on the pool
+                    placing[dev] += 1
+                    executor.submit(place, index, file, dev, policy)
+                else:
+                    heapq.heappush(queued[dev], (self.scheduler.sort_key(file, policy),
+                                                 index, file))
+                cond.notify()
+
+        def place(index, file, dev, policy):
+            # Queue a file once its position is known
+            try:
+                key = self.scheduler.sort_key(file, policy)
+            except BaseException:
+                key = 0
+            with cond:
+                heapq.heappush(queued[dev], (key, index, file))
+                placing[dev] -= 1
+                cond.notify()
+
+        def dispatch():
+            for dev, queue in queued.items():
+                # Reads of a device wait for the positions of all the files taken
+                while queue and in_flight[dev] < streams[dev] and not placing[dev]:
+                    in_flight[dev] += 1
+                    _, index, file = heapq.heappop(queue)
+                    executor.submit(run, index, file, dev)
+
+        # Imported on first use: concurrent.futures pulls in logging, slow to import
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.jobs) as executor:
+            while True:
+                while not exhausted and taken - next_index < window:
+                    try:
+                        file = next(files)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if file._stats is None:
+                        executor.submit(locate, taken, file)
+                    else:
+                        queue(taken, file, file._stats.st_dev)
+                    taken += 1
+                if exhausted and next_index == taken:
+                    return
+                with cond:
+                    dispatch()
+                    while next_index not in done:
+                        cond.wait()
+                        dispatch()
+                    ok, file, value = done.pop(next_index)
+                next_index += 1
+                if not ok:
+                    raise value
+                yield file, value
@@ -0,0 +1,128 @@
+"""
+"hashers.py" Hash algorithms and file read strategies
+
+Hashing multi-GB videos is CPU bound, and the fastest algorithm and way of reading a file depend
+on the machine. A Hasher pairs an algorithm with a read strategy; a collection gives its Hasher
+to each of its files.
+
+Algorithms: sha1 (the default), sha256, blake2b and, when their packages are installed, xxh3
+(xxhash, not cryptographic but several times faster) and blake3.
+
+Read strategies:
+    file     -- hashlib.file_digest(), reading with its own buffering (hashlib algorithms only)
+    mmap     -- memory-map the whole file and hash it in one call, without copying it
+    readinto -- read into a reused buffer, avoiding an allocation per block
+    aligned  -- as readinto, into a larger page-aligned buffer
+
+Hash values of different algorithms are not comparable, so the algorithm is recorded with every
+persisted hash value: the hash cache, the collection index, host manifests and the store.
+"""
+import hashlib
+import mmap
+import threading
+
+DEFAULT_ALGORITHM = 'sha1'
+READ_STRATEGIES = ('file', 'mmap', 'readinto', 'aligned')
+
+READ_BLOCK = 1024 * 1024
+ALIGNED_BLOCK = 8 * 1024 * 1024
+
+
+def _xxh3():
+    import xxhash
+    return xxhash.xxh3_128()
+
+
+def _blake3():
+    import blake3
+    return blake3.blake3(max_threads=1)
+
+
+# Constructors of new hash objects, by algorithm name
+ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'xxh3': _xxh3,
+    'blake3': _blake3,
+}
+
+
+def available() -> [str]:
+    """Return the names of the algorithms usable here"""
+    names = []
+    for name, new in ALGORITHMS.items():
+        try:
+            new()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+class Hasher:
+    """Hash algorithm and read strategy for the files of a collection
+
+    The strategy defaults to "file" for the hashlib algorithms and to "readinto" for others.
+    """
+    def __init__(self, algorithm: str = DEFAULT_ALGORITHM, strategy: str = None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {algorithm!r}")
+        self.name = algorithm
+        self._new = ALGORITHMS[algorithm]
+        # Fails early when an optional package is missing
+        self.digest_size = self._new().digest_size
+        self._hashlib = algorithm in hashlib.algorithms_available
+        strategy = strategy or ('file' if self._hashlib else 'readinto')
+        if strategy not in READ_STRATEGIES:
+            raise ValueError(f"Unknown read strategy {strategy!r}")
+        if strategy == 'file' and not self._hashlib:
+            raise ValueError(f"Read strategy 'file' needs a hashlib algorithm, not {algorithm!r}")
+        self.strategy = strategy
+        self._buffers = threading.local()
+
+    def __repr__(self):
+        return f"Hasher({self.name!r}, {self.strategy!r})"
+
+    def new(self, data=b''):
+        """Return a new hash object, fed data"""
+        digest = self._new()
+        if data:
+            digest.update(data)
+        return digest
+
+    def hash_file(self, file_path) -> str:
+        """Return the hex digest of a file's content"""
+        with open(file_path, 'rb', buffering=0) as f:
+            if self.strategy == 'file':
+                return hashlib.file_digest(f, self._new).hexdigest()
+            digest = self._new()
+            if self.strategy == 'mmap':
+                try:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    # Empty, or on a file system without mmap support
+                    data = None
+                if data is not None:
+                    with data:
+                        digest.update(data)
+                    return digest.hexdigest()
+            view = self._buffer()
+            while size := f.readinto(view):
+                digest.update(view[:size])
+            return digest.hexdigest()
+
+    def _buffer(self) -> memoryview:
+        """The read buffer of the calling thread, reused from file to file"""
+        view = getattr(self._buffers, 'view', None)
+        if view is None:
+            if self.strategy == 'aligned':
+                # An anonymous mapping starts on a page boundary
+                view = memoryview(mmap.mmap(-1, ALIGNED_BLOCK))
+            else:
+                view = memoryview(bytearray(READ_BLOCK))
+            self._buffers.view = view
+        return view
+
+
+DEFAULT_HASHER = Hasher()
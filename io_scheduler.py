@@ -0,0 +1,171 @@
+"""
+"io_scheduler.py" Per-device scheduling of file reads
+
+A collection spanning several disks is read fastest when each disk is read its own best way: a
+spinning disk, whether local, on USB or behind a NAS, one file at a time in on-disk order so that
+its head sweeps across the platter instead of seeking back and forth; an SSD many files at a
+time in any order. The IOScheduler tells, for each device (st_dev), how many files may be read
+from it at the same time and in what order, from the kind of device:
+    hdd      -- a rotational block device, per /sys/dev/block/<major>:<minor>/queue/rotational
+    ssd      -- a non-rotational block device, or a file system held in memory
+    network  -- NFS, SMB and other network file systems
+    unknown  -- anything else, including any device on systems without /sys
+and orders the reads of a device by one of:
+    found    -- the order the files were given in
+    inode    -- inode number, which most file systems allocate along the disk
+    extent   -- the physical position of the file's first block, from the FIEMAP ioctl; files
+                for which it is not available are ordered by inode
+
+The policy of each kind, and of particular devices, can be set; HashPool uses the scheduler for
+hashing and the collection store for copying.
+"""
+from collections import namedtuple
+import os
+import struct
+import threading
+
+# Reads at the same time from one device, None for as many as the reading pool has threads, and
+# their order
+Policy = namedtuple('Policy', 'streams order')
+
+ORDERS = ('found', 'inode', 'extent')
+
+DEFAULT_POLICIES = {
+    'hdd': Policy(1, 'extent'),
+    'ssd': Policy(8, 'found'),
+    # A remote disk answers after a network round trip: a second stream hides that latency
+    'network': Policy(2, 'inode'),
+    # Nothing is known of the device: it is not held back
+    'unknown': Policy(None, 'inode'),
+}
+
+NETWORK_FS_TYPES = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'ceph',
+                    'glusterfs', 'fuse.sshfs', 'fuse.rclone')
+MEMORY_FS_TYPES = ('tmpfs', 'ramfs')
+
+# Linux ioctl mapping the extents of a file, and the sizes of its header and of one extent
+FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')
+_FIEMAP_EXTENT_SIZE = 56
+
+
+def _read(file_path) -> str | None:
+    try:
+        with open(file_path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _fs_types() -> {str: str}:
+    """File system type of each mounted device, by "major:minor", from /proc/self/mountinfo"""
+    types = {}
+    for line in (_read('/proc/self/mountinfo') or '').splitlines():
+        fields = line.split()
+        if ' - ' in line and len(fields) > 2:
+            types.setdefault(fields[2], line.split(' - ', 1)[1].split()[0])
+    return types
+
+
+def device_kind(dev: int) -> str:
+    """Kind of the device with st_dev dev: hdd, ssd, network or unknown"""
+    major, minor = os.major(dev), os.minor(dev)
+    fs_type = _fs_types().get(f'{major}:{minor}')
+    if fs_type in NETWORK_FS_TYPES:
+        return 'network'
+    if fs_type in MEMORY_FS_TYPES:
+        return 'ssd'
+    sys_path = os.path.realpath(f'/sys/dev/block/{major}:{minor}')
+    # A partition has no queue of its own: it is that of the disk above it
+    for dir_path in (sys_path, os.path.dirname(sys_path)):
+        rotational = _read(os.path.join(dir_path, 'queue', 'rotational'))
+        if rotational is not None:
+            return 'hdd' if rotational == '1' else 'ssd'
+    return 'unknown'
+
+
+def first_extent(file_path) -> int | None:
+    """Physical byte offset of the first block of a file, or None where FIEMAP is not
+    supported; OSError is raised when the file cannot be opened"""
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    request = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT_SIZE)
+    # Map from offset 0 over the whole file, returning one extent
+    _FIEMAP_HEADER.pack_into(request, 0, 0, 2**64 - 1, 0, 0, 1, 0)
+    with open(file_path, 'rb') as f:
+        try:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+        except OSError:
+            return None
+    if _FIEMAP_HEADER.unpack_from(request)[3] == 0:
+        # Empty, or held inline in the file system's metadata
+        return None
+    return struct.unpack_from('=Q', request, _FIEMAP_HEADER.size + 8)[0]
+
+
+class IOScheduler:
+    """Read policy of each device
+
+    policies -- Policy, or number of streams, by device kind, replacing those of DEFAULT_POLICIES
+    devices  -- Policy, number of streams or device kind, by device: an st_dev number or the
+                path of any file or folder on the device
+    streams  -- if given, the number of streams of every device, whatever its policy
+    """
+    def __init__(self, policies: {str: Policy | int} = None,
+                 devices: {int | str: Policy | int | str} = None, streams: int = None):
+        self.policies = dict(DEFAULT_POLICIES)
+        for kind, policy in (policies or {}).items():
+            self.policies[kind] = self._policy(policy, DEFAULT_POLICIES.get(kind))
+        self.streams = streams
+        self._devices: {int: Policy} = {}
+        self._no_extents: set = set()
+        self._lock = threading.Lock()
+        for device, policy in (devices or {}).items():
+            dev = os.stat(device).st_dev if isinstance(device, str) else device
+            if isinstance(policy, str):
+                policy = self.policies[policy]
+            self._devices[dev] = self._fixed(self._policy(policy, self.policies['unknown']))
+
+    @staticmethod
+    def _policy(policy: Policy | int, default: Policy) -> Policy:
+        if isinstance(policy, int):
+            policy = Policy(policy, (default or DEFAULT_POLICIES['unknown']).order)
+        if policy.order not in ORDERS:
+            raise ValueError(f"Unknown read order {policy.order!r}")
+        return policy
+
+    def _fixed(self, policy: Policy) -> Policy:
+        return policy._replace(streams=self.streams) if self.streams else policy
+
+    def policy(self, dev: int) -> Policy:
+        """Return the policy of the device with st_dev dev, telling its kind on first use"""
+        policy = self._devices.get(dev)
+        if policy is None:
+            policy = self._fixed(self.policies[device_kind(dev)])
+            with self._lock:
+                policy = self._devices.setdefault(dev, policy)
+        return policy
+
+    def sort_key(self, file, policy: Policy) -> int:
+        """Position of a file in the reads of its device; with the extent order, the file is
+        opened, so that the key is best obtained on a worker thread"""
+        if policy.order == 'found':
+            return 0
+        stats = file.stats
+        if policy.order == 'extent' and stats.st_dev not in self._no_extents:
+            try:
+                offset = first_extent(file.file_path)
+            except OSError:
+                # Not a file on disk, such as an archive member
+                return stats.st_ino
+            if offset is not None:
+                return offset
+            if stats.st_size:
+                # Not supported by this file system: inodes for the rest of the device
+                self._no_extents.add(stats.st_dev)
+        return stats.st_ino
+
+
+DEFAULT_SCHEDULER = IOScheduler()
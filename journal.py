@@ -0,0 +1,223 @@
+"""
+"journal.py" Checkpoint journal of a collection run
+
+Collecting a large NAS takes hours; a reboot, a dropped network share or Ctrl-C should not send
+the next run back to the start. The journal is a local file into which a run appends, as it
+goes, what it would otherwise have to do again:
+    * the files found under each collection path, and which paths were walked to the end
+    * each folder walked, with its subfolders and the files taken from it
+    * the hash of each file read
+    * the destination of each file copied
+Records are buffered and written at checkpoints, every few seconds and when the run ends or is
+interrupted, each checkpoint being synced to disk. A run resuming from the journal takes the
+files of the paths walked to the end from it instead of walking them again, and reuses the hash
+values and copies of files unchanged since -- same size and modification time. A path left
+partly walked is walked again without listing the folders recorded and unchanged since -- same
+modification time -- so the walk picks up where it stopped.
+
+Only the walks of Collect.collect() are journaled, not those of Collect.iter_files(), and a run
+resumes with the filter of the interrupted one: folder records only name the files it took.
+
+The journal is a text file of JSON records, one per line, after a header naming the collection
+paths and hash algorithm of the run; a record cut short by a crash is ignored. A run only
+resumes the journal of the same paths and algorithm.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from archive import find_file
+from hash_cache import HashCache
+from tools import File
+
+FORMAT = 'photo-journal 1'
+
+# Longest time between checkpoints, in seconds
+CHECKPOINT_INTERVAL = 10.0
+
+
+def default_path(paths: [str]) -> str:
+    """Journal file of a run over the given collection paths, in the user's cache folder"""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),
+                                                                 '.cache')
+    key = hashlib.sha1(json.dumps(sorted(os.path.abspath(x) for x in paths)).encode())
+    return os.path.join(cache_dir, 'photo_collect', f'journal-{key.hexdigest()[:16]}.jsonl')
+
+
+class Journal:
+    """Checkpointed record of a collection run
+
+    Also the hash cache of the run's files: hash values are looked up in the journal, then in
+    cache, a HashCache, and recorded in both.
+
+    file_path   -- journal file
+    paths       -- collection paths of the run
+    algorithm   -- hash algorithm of the run
+    resume      -- continue the journal of an interrupted run of the same paths and algorithm,
+                   rather than starting a new one
+    interval    -- longest time between checkpoints, in seconds
+    """
+    def __init__(self, file_path, paths: [str] = (), algorithm: str = 'sha1', resume=False,
+                 cache: HashCache = None, interval: float = CHECKPOINT_INTERVAL):
+        self.file_path = file_path
+        self.cache = cache
+        self.interval = interval
+        self.header = {'format': FORMAT, 'paths': [os.path.abspath(x) for x in paths],
+                       'algorithm': algorithm}
+        self._found: {str: [str]} = {}
+        self._walked: set = set()
+        self._dirs: {str: dict} = {}
+        self._hashes: {str: list} = {}
+        self._copies: {str: list} = {}
+        self._pending: [str] = []
+        self._lock = threading.Lock()
+        self.resumed = resume and self._load()
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        self._file = open(file_path, 'a' if self.resumed else 'w', encoding='utf-8')
+        if not self.resumed:
+            self._file.write(json.dumps(self.header) + '\n')
+        self._checkpointed = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _load(self) -> bool:
+        """Read the records of the journal of an earlier run, if of the same paths and
+        algorithm"""
+        try:
+            f = open(self.file_path, encoding='utf-8')
+        except OSError:
+            return False
+        with f:
+            try:
+                if json.loads(f.readline()) != self.header:
+                    return False
+            except ValueError:
+                return False
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Cut short when the run was killed
+                    continue
+                if 'walking' in record:
+                    # Walked again from the start: what was found before is found again
+                    self._found[record['walking']] = []
+                elif 'found' in record:
+                    self._found.setdefault(record['found'], []).extend(record['files'])
+                elif 'walked' in record:
+                    self._walked.add(record['walked'])
+                elif 'dir' in record:
+                    self._dirs[record['dir']] = record
+                elif 'hash' in record:
+                    self._hashes[record['hash'][0]] = record['hash'][1:]
+                elif 'copied' in record:
+                    self._copies[record['copied'][0]] = record['copied'][1:]
+        return True
+
+    def _append(self, record: dict):
+        with self._lock:
+            self._pending.append(json.dumps(record))
+            if time.monotonic() - self._checkpointed >= self.interval:
+                self._write()
+
+    def _write(self):
+        if self._pending:
+            self._file.write('\n'.join(self._pending) + '\n')
+            self._pending = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._checkpointed = time.monotonic()
+
+    def checkpoint(self):
+        """Write all pending records to disk"""
+        with self._lock:
+            if self._file is not None:
+                self._write()
+
+    @staticmethod
+    def _unchanged(file: File, record: list) -> bool:
+        return record[0] == file.size and record[1] == file.stats.st_mtime_ns
+
+    def files(self, dir_path) -> [File]:
+        """Return the files found under a collection path walked to the end by the interrupted
+        run and still there, or None if it was not"""
+        dir_path = os.path.abspath(dir_path)
+        if dir_path not in self._walked:
+            return None
+        archives = {}
+        files = []
+        for path in self._found.get(dir_path, ()):
+            file = find_file(path, archives)
+            if file is not None:
+                files.append(file)
+        return files
+
+    def walking(self, dir_path):
+        """Record that a collection path is walked from the start"""
+        self._append({'walking': os.path.abspath(dir_path)})
+
+    def found(self, dir_path, files: [File]):
+        """Record files found under a collection path"""
+        self._append({'found': os.path.abspath(dir_path),
+                      'files': [file.file_path for file in files]})
+
+    def walked(self, dir_path):
+        """Record that a collection path was walked to the end"""
+        self._append({'walked': os.path.abspath(dir_path)})
+
+    def listing(self, dir_path, mtime_ns: int) -> ([str], [str]):
+        """Return the subfolder names of a folder walked by the interrupted run and the names of
+        the files taken from it, if unchanged since, or None"""
+        record = self._dirs.get(dir_path)
+        if record is None or record['mtime_ns'] != mtime_ns:
+            return None
+        return record['subdirs'], record['files']
+
+    def listed(self, dir_path, mtime_ns: int, subdirs: [str], file_names: [str]):
+        """Record a folder walked, with its subfolder names, once all its files were taken"""
+        self._append({'dir': dir_path, 'mtime_ns': mtime_ns, 'subdirs': subdirs,
+                      'files': file_names})
+
+    def get(self, file: File) -> str | None:
+        """Return the hash of a file recorded in the journal, or the cache, if unchanged since"""
+        record = self._hashes.get(file.file_path)
+        if record is not None and self._unchanged(file, record):
+            return record[2]
+        return self.cache.get(file) if self.cache is not None else None
+
+    def put(self, file: File, hash_value):
+        """Record the hash of a file, in the journal and the cache"""
+        stats = file.stats
+        self._append({'hash': [file.file_path, stats.st_size, stats.st_mtime_ns, hash_value]})
+        if self.cache is not None:
+            self.cache.put(file, hash_value)
+
+    def copied(self, file: File) -> str | None:
+        """Return where a file was copied to, if unchanged since and the copy is still there"""
+        record = self._copies.get(file.file_path)
+        if record is not None and self._unchanged(file, record) and os.path.isfile(record[2]):
+            return record[2]
+        return None
+
+    def copy(self, file: File, dst_path):
+        """Record the copy of a file"""
+        stats = file.stats
+        self._append({'copied': [file.file_path, stats.st_size, stats.st_mtime_ns, dst_path]})
+
+    def flush(self):
+        self.checkpoint()
+        if self.cache is not None:
+            self.cache.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._write()
+                self._file.close()
+                self._file = None
@@ -0,0 +1,156 @@
+"""
+"metadata.py" Photo and video metadata parsing
+
+Only the few facts the Photo Manager needs are extracted -- mainly when a picture was taken -- from
+the data already read to hash a file:
+    * JPEG: the EXIF (APP1) segment near the start of the file
+    * MP4/MOV: the creation time of the movie header ("mvhd" atom inside "moov")
+
+The parsers accept any buffer supporting slicing and struct.unpack_from, such as bytes or an
+mmap of the file, and never raise on malformed data; what cannot be read is simply left out.
+"""
+from datetime import datetime, timedelta
+import struct
+
+EXIF_TAGS = {
+    0x010F: 'Make',
+    0x0110: 'Model',
+    0x0112: 'Orientation',
+    0x0132: 'DateTime',
+    0x9003: 'DateTimeOriginal',
+    0x9004: 'DateTimeDigitized',
+    0xA002: 'PixelXDimension',
+    0xA003: 'PixelYDimension',
+}
+EXIF_IFD_POINTER = 0x8769
+
+# Tags holding a date, in order of preference for the time a picture was taken
+DATE_TAGS = ('DateTimeOriginal', 'DateTimeDigitized', 'DateTime', 'CreationTime')
+
+QT_EPOCH = datetime(1904, 1, 1)
+QT_ATOMS = (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot')
+
+
+def parse(data) -> dict:
+    """Return the metadata found in the leading data of a JPEG, MP4 or MOV file"""
+    try:
+        if data[:2] == b'\xff\xd8':
+            return jpeg_exif(data)
+        if data[4:8] in QT_ATOMS:
+            return quicktime_meta(data)
+    except (struct.error, IndexError, ValueError, OverflowError):
+        pass
+    return {}
+
+
+def taken_at(meta: dict) -> datetime | None:
+    """Return the date and time a photo or video was taken from its metadata, if known
+
+    EXIF dates are local time; the MP4/MOV creation time is UTC. Both are returned as naive
+    datetime values.
+    """
+    for tag in DATE_TAGS:
+        value = meta.get(tag)
+        if isinstance(value, datetime):
+            return value
+        if isinstance(value, str):
+            try:
+                return datetime.strptime(value.strip('\0 '), '%Y:%m:%d %H:%M:%S')
+            except ValueError:
+                continue
+    return None
+
+
+def jpeg_exif(data) -> dict:
+    """Return the EXIF tags of EXIF_TAGS found in the APP1 segment of JPEG data"""
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            break
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in (0xD9, 0xDA):
+            # End of image, or start of the compressed image data: no more segment headers
+            break
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+            pos += 2
+            continue
+        length = struct.unpack_from('>H', data, pos + 2)[0]
+        if marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\0\0':
+            return _tiff_tags(data[pos + 10:pos + 2 + length])
+        pos += 2 + length
+    return {}
+
+
+def _tiff_tags(tiff) -> dict:
+    order = {b'II': '<', b'MM': '>'}.get(bytes(tiff[:2]))
+    if order is None:
+        return {}
+    tags = {}
+    pointers = _read_ifd(tiff, order, struct.unpack_from(order + 'I', tiff, 4)[0], tags)
+    if EXIF_IFD_POINTER in pointers:
+        _read_ifd(tiff, order, pointers[EXIF_IFD_POINTER], tags)
+    return tags
+
+
+def _read_ifd(tiff, order, offset, tags) -> {int: int}:
+    """Add the wanted tags of the image file directory at offset; return its IFD pointers"""
+    pointers = {}
+    count = struct.unpack_from(order + 'H', tiff, offset)[0]
+    for n in range(count):
+        entry = offset + 2 + 12 * n
+        tag, kind, items = struct.unpack_from(order + 'HHI', tiff, entry)
+        if tag == EXIF_IFD_POINTER:
+            pointers[tag] = struct.unpack_from(order + 'I', tiff, entry + 8)[0]
+        elif tag in EXIF_TAGS:
+            if kind == 2:
+                # ASCII, stored in place when 4 bytes or less
+                start = entry + 8 if items <= 4 else struct.unpack_from(order + 'I', tiff,
+                                                                        entry + 8)[0]
+                value = bytes(tiff[start:start + items]).rstrip(b'\0').decode('ascii', 'replace')
+            elif kind == 3:
+                value = struct.unpack_from(order + 'H', tiff, entry + 8)[0]
+            elif kind == 4:
+                value = struct.unpack_from(order + 'I', tiff, entry + 8)[0]
+            else:
+                continue
+            tags[EXIF_TAGS[tag]] = value
+    return pointers
+
+
+def _atoms(data, start, end):
+    """Generate (type, body start, end) of each QuickTime atom between start and end"""
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield kind, pos + header, min(pos + size, end)
+        pos += size
+
+
+def quicktime_meta(data) -> dict:
+    """Return the creation time of MP4/MOV data from its movie header"""
+    for kind, start, end in _atoms(data, 0, len(data)):
+        if kind != b'moov':
+            continue
+        for sub_kind, sub_start, _ in _atoms(data, start, end):
+            if sub_kind != b'mvhd':
+                continue
+            if data[sub_start] == 1:
+                seconds = struct.unpack_from('>Q', data, sub_start + 4)[0]
+            else:
+                seconds = struct.unpack_from('>I', data, sub_start + 4)[0]
+            if seconds:
+                return {'CreationTime': QT_EPOCH + timedelta(seconds=seconds)}
+            return {}
+    return {}
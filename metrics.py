@@ -0,0 +1,109 @@
+"""
+"metrics.py" Counters, stage timers and progress reports for a collection run
+
+A long collection run is otherwise silent. A Metrics object, given to Collect, counts what the
+run does -- directories listed or reused, stat calls, files matched, bytes hashed, hash cache hits
+and misses, archive members -- and times each stage (walk, hash, dedup, extract, store). Progress
+is reported to a callback at most once per interval, and optionally appended as JSON lines to a
+file for later analysis.
+
+Instrumentation is opt-in: without a Metrics object, the code being measured only pays for a
+test of an attribute against None.
+"""
+import contextlib
+import threading
+import time
+
+COUNTERS = ('dirs_listed', 'dirs_reused', 'stat_calls', 'files_matched', 'files_hashed',
+            'bytes_hashed', 'cache_hits', 'cache_misses', 'archive_members')
+
+
+class Metrics:
+    """Counters and stage timers, safe to update from several threads
+
+    progress  -- callback called with this Metrics object at most once every interval seconds
+                 while counters change, and once more on close()
+    sink      -- path of a file, or an open text file, to which a JSON line is appended with each
+                 progress report
+    """
+    def __init__(self, progress=None, interval: float = 1.0, sink=None):
+        self.counters: {str: int} = dict.fromkeys(COUNTERS, 0)
+        self.stages: {str: float} = {}
+        self.progress = progress
+        self.interval = interval
+        self._own_sink = isinstance(sink, str)
+        self._sink = open(sink, 'a') if self._own_sink else sink
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._next_report = self._start + interval
+        self._stage_stack: [str] = []
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        if (self.progress is not None or self._sink is not None) and \
+                time.monotonic() >= self._next_report:
+            self.report()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Time a stage of the run; time spent in a nested stage is also counted in its parent"""
+        self._stage_stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            self._stage_stack.pop()
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    @property
+    def current_stage(self) -> str | None:
+        return self._stage_stack[-1] if self._stage_stack else None
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'elapsed': round(self.elapsed, 3), 'stage': self.current_stage,
+                    'counters': dict(self.counters),
+                    'stages': {x: round(y, 4) for x, y in self.stages.items()}}
+
+    def report(self, final=False):
+        """Report progress now, to the callback and the sink"""
+        self._next_report = time.monotonic() + self.interval
+        if self.progress is not None:
+            self.progress(self)
+        if self._sink is not None:
+            import json     # Imported once reports are written: slow to import
+            record = self.snapshot()
+            if final:
+                record['final'] = True
+            with self._lock:
+                self._sink.write(json.dumps(record) + '\n')
+                self._sink.flush()
+
+    def close(self):
+        """Make the final report and close the sink if opened here"""
+        self.report(final=True)
+        if self._own_sink:
+            self._sink.close()
+        self._sink = None
+
+    def __str__(self):
+        counters = self.counters
+        text = (f"{counters['files_matched']} files in {counters['dirs_listed']} folders "
+                f"({counters['dirs_reused']} reused), "
+                f"{counters['bytes_hashed'] / 2**20:.1f} MB hashed, "
+                f"{counters['cache_hits']} cache hits")
+        if self.stages:
+            text += ' -- ' + ', '.join(f'{x} {y:.2f}s' for x, y in self.stages.items())
+        return text
+
+
+def stage(metrics: Metrics | None, name: str):
+    """Context manager timing a stage on metrics, doing nothing when metrics is None"""
+    return metrics.stage(name) if metrics is not None else contextlib.nullcontext()
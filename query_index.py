@@ -0,0 +1,177 @@
+"""
+"query_index.py" In-memory indexes answering queries over the collected files
+
+The later stages of the Photo Manager ask questions such as "all the files from July 2019", "all
+the copies of this content" or "the files under folders named for a trip". A QueryIndex is built
+once from the files of a collection and answers each without scanning them all:
+    * digest and size  -- hash maps to the files
+    * date             -- files sorted by date, searched by bisection
+    * folder           -- folder paths sorted, so that those under a folder are a contiguous
+                          range, found by bisection
+    * activity         -- hash map from the words of folder names to the files under them
+
+A file's date is when it was taken, per its metadata, or else the date its folder is named for.
+A folder named for a year or a month dates its files to that whole period, found by a query of
+that period or a longer one. Folder names such as "2019-07-14 Hillsboro", "201907_" or
+"Pix/2019" are understood; each folder is parsed once.
+"""
+from bisect import bisect_left
+from datetime import datetime
+import os
+import re
+
+from archive import MEMBER_SEP
+from hash_pool import HashPool
+from tools import File
+
+# Dates in folder names, most precise first: year, then month, then day, separated or not
+_DATE_PATTERNS = [re.compile(x) for x in (
+    r'(?<!\d)((?:19|20)\d\d)[-_. ]?(0[1-9]|1[0-2])[-_. ]?(0[1-9]|[12]\d|3[01])(?!\d)',
+    r'(?<!\d)((?:19|20)\d\d)[-_. ]?(0[1-9]|1[0-2])(?!\d)',
+    r'(?<!\d)((?:19|20)\d\d)(?!\d)',
+)]
+
+# Words of folder names: letters only, three or more
+_WORD = re.compile(r'[^\W\d_]{3,}')
+
+_PATH_SPLIT = re.compile('[' + re.escape(os.sep + (os.altsep or '') + MEMBER_SEP) + ']')
+
+
+def period(text: str) -> (datetime, datetime):
+    """Return the start and end of the day, month or year a text is named for, if any"""
+    for pattern in _DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            parts = [int(x) for x in match.groups()]
+            try:
+                start = datetime(*parts, *[1] * (3 - len(parts)))
+            except ValueError:
+                # Such as February 30
+                continue
+            return start, _next(start, len(parts))
+    return None
+
+
+def _next(start: datetime, precision: int) -> datetime:
+    """Start of the year (precision 1), month (2) or day (3) after the one starting at start"""
+    if precision == 1:
+        return start.replace(year=start.year + 1)
+    if precision == 2:
+        return (start.replace(year=start.year + 1, month=1) if start.month == 12
+                else start.replace(month=start.month + 1))
+    return datetime.fromordinal(start.toordinal() + 1)
+
+
+class QueryIndex:
+    """Indexes over a set of files, built once
+
+    Files whose hash is not yet known are left out of the digest index: hash them first, as
+    dedup() or hash_all() do, for it to be complete. With exif, the metadata of files not yet
+    read are read, on a pool of jobs threads, to date them by when they were taken; otherwise
+    only the metadata already at hand are used, and other files are dated by their folder.
+    """
+    def __init__(self, files: [File], exif=False, jobs: int = None):
+        files = list(files)
+        if exif:
+            HashPool(jobs).map([x for x in files if x._exif is None], 'exif')
+        self.files = files
+        self._by_digest: {str: [File]} = {}
+        self._by_size: {int: [File]} = {}
+        self._by_dir: {str: [File]} = {}
+        self._by_word: {str: [File]} = {}
+        self._dir_periods: {str: (datetime, datetime)} = {}
+        self._dir_words: {str: set} = {}
+        dated = []
+        for file in files:
+            if file._hash is not None:
+                self._by_digest.setdefault(file._hash, []).append(file)
+            self._by_size.setdefault(file.size, []).append(file)
+            self._by_dir.setdefault(file.dir_path, []).append(file)
+            dates = self._file_period(file)
+            if dates is not None:
+                dated.append((*dates, file))
+        dated.sort(key=lambda x: x[0])
+        self._starts = [x[0] for x in dated]
+        self._ends = [x[1] for x in dated]
+        self._dated = [x[2] for x in dated]
+        # Folders with a separator appended, so that a folder sorts right before those under it
+        self._dirs = {os.path.join(x, ''): x for x in self._by_dir}
+        self._dir_keys = sorted(self._dirs)
+        for dir_path, dir_files in self._by_dir.items():
+            for word in self._words(dir_path):
+                self._by_word.setdefault(word, []).extend(dir_files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def _file_period(self, file: File) -> (datetime, datetime):
+        """Start and end of the period a file is dated to, or None"""
+        if file._exif:
+            taken = file.taken_at
+            if taken is not None:
+                return taken, taken
+        return self._dir_period(file.dir_path)
+
+    def _dir_period(self, dir_path) -> (datetime, datetime):
+        """Period a folder is named for, or else its nearest parent folder, or None"""
+        if dir_path not in self._dir_periods:
+            parent, name = os.path.split(dir_path)
+            if MEMBER_SEP in name:
+                name = name.rpartition(MEMBER_SEP)[2]
+            dates = period(name) if name else None
+            if dates is None and parent != dir_path:
+                dates = self._dir_period(parent)
+            self._dir_periods[dir_path] = dates
+        return self._dir_periods[dir_path]
+
+    def _words(self, dir_path) -> set:
+        """Lowercase words of all the folder names of a path"""
+        if dir_path not in self._dir_words:
+            parent, name = os.path.split(dir_path)
+            words = set(self._words(parent)) if parent != dir_path else set()
+            for part in _PATH_SPLIT.split(name):
+                words.update(x.lower() for x in _WORD.findall(part))
+            self._dir_words[dir_path] = words
+        return self._dir_words[dir_path]
+
+    def copies(self, digest: str) -> [File]:
+        """Return the files with a digest"""
+        return list(self._by_digest.get(digest, ()))
+
+    def sized(self, size: int) -> [File]:
+        """Return the files of a size"""
+        return list(self._by_size.get(size, ()))
+
+    def between(self, start: datetime, end: datetime) -> [File]:
+        """Return the files dated from start to before end, in date order; a file dated by its
+        folder to a period is returned if the whole period is"""
+        files = []
+        for x in range(bisect_left(self._starts, start), bisect_left(self._starts, end)):
+            if self._ends[x] <= end:
+                files.append(self._dated[x])
+        return files
+
+    def dated(self, when: str) -> [File]:
+        """Return the files of a year, month or day given as "2019", "2019-07" or "2019-07-14",
+        in date order"""
+        dates = period(when)
+        if dates is None:
+            raise ValueError(f"Not a date: {when!r}")
+        return self.between(*dates)
+
+    def under(self, dir_path: str) -> [File]:
+        """Return the files in a folder and its subfolders"""
+        prefix = os.path.join(os.path.abspath(dir_path), '')
+        files = []
+        for x in range(bisect_left(self._dir_keys, prefix), len(self._dir_keys)):
+            if not self._dir_keys[x].startswith(prefix):
+                break
+            files += self._by_dir[self._dirs[self._dir_keys[x]]]
+        return files
+
+    def activity(self, word: str) -> [File]:
+        """Return the files under folders whose names hold a word, in any case"""
+        return list(self._by_word.get(word.lower(), ()))
+
+    def activities(self) -> [str]:
+        """Return the words of the folder names, most files first"""
+        return sorted(self._by_word, key=lambda x: (-len(self._by_word[x]), x))
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+"""
+"shards.py" Per-host manifests and their streaming merge
+
+Photos are scattered over several PCs and NAS boxes. Rather than reading every file over the
+network from one place, the collector runs on each host against its local folders and writes a
+manifest: one line per file with its digest, size, modification time and path, sorted by digest.
+A coordinator then merges the manifests of all hosts in a single pass: being sorted the same way,
+they are read side by side, k-way, so that the copies of each content come together one digest at
+a time and only those are held in memory, however many files the hosts have.
+
+A manifest is a text file, gzip compressed when its name ends with ".gz":
+    # photo-manifest 1 host=<host name> algorithm=<hash algorithm>
+    <digest> TAB <size> TAB <mtime_ns> TAB <path>
+    ...
+
+As a program:
+    shards.py write -o HOST.manifest.gz [--host NAME] [--archives] PATH...
+    shards.py merge -o OUTPUT_DIR MANIFEST...
+merge writes "unique.txt", the host and path of one copy of each content, and "duplicates.txt",
+the host and path of every other copy followed by those of the copy kept. Manifests given first
+have priority for the copy kept. Only manifests of the same hash algorithm can be merged.
+"""
+from collections import namedtuple
+import heapq
+from itertools import groupby
+import os
+import sys
+
+from hash_pool import HashPool
+from hashers import DEFAULT_HASHER
+from tools import File
+
+FORMAT = 'photo-manifest 1'
+
+Record = namedtuple('Record', 'digest size mtime_ns path host')
+
+
+def _open(file_path, mode, name=None):
+    """Open a manifest, gzip compressed when its name, by default its path, ends with .gz"""
+    if (name or file_path).endswith('.gz'):
+        import gzip
+        return gzip.open(file_path, mode + 't', encoding='utf-8', newline='\n')
+    return open(file_path, mode, encoding='utf-8', newline='\n')
+
+
+def write_manifest(files: [File], file_path, host: str = None, jobs: int = None) -> int:
+    """Hash files on a pool of jobs threads and write their manifest, sorted by digest, for the
+    host by default named after this machine; return the number of files written"""
+    import socket
+    host = host or socket.gethostname()
+    algorithm = files[0].hasher.name if files else DEFAULT_HASHER.name
+    if any(file.hasher.name != algorithm for file in files):
+        raise ValueError("Files of a manifest must be hashed with the same algorithm")
+    HashPool(jobs).map(files)
+    records = sorted((file.hash, file.file_path, file.size, file.stats.st_mtime_ns)
+                     for file in files)
+    temp_path = file_path + '.tmp'
+    with _open(temp_path, 'w', file_path) as f:
+        f.write(f'# {FORMAT} host={host} algorithm={algorithm}\n')
+        for digest, path, size, mtime_ns in records:
+            f.write(f'{digest}\t{size}\t{mtime_ns}\t{path}\n')
+    os.replace(temp_path, file_path)
+    return len(records)
+
+
+def _header(f, file_path) -> {str: str}:
+    header = f.readline().rstrip('\n')
+    if not header.startswith(f'# {FORMAT} '):
+        raise ValueError(f"{file_path} is not a manifest")
+    # Manifests written before the algorithm was recorded hold SHA-1 values
+    fields = {'algorithm': 'sha1'}
+    fields.update(x.split('=', 1) for x in header[len(FORMAT) + 3:].split() if '=' in x)
+    return fields
+
+
+def read_header(file_path) -> {str: str}:
+    """Return the fields of a manifest header: host and algorithm"""
+    with _open(file_path, 'r') as f:
+        return _header(f, file_path)
+
+
+def read_manifest(file_path):
+    """Generate the records of a manifest, in digest order"""
+    with _open(file_path, 'r') as f:
+        host = _header(f, file_path)['host']
+        for line in f:
+            digest, size, mtime_ns, path = line.rstrip('\n').split('\t', 3)
+            yield Record(digest, int(size), int(mtime_ns), path, host)
+
+
+def merge(file_paths: [str]):
+    """Generate, for each distinct content of all the manifests, its digest and records
+
+    The manifests are read side by side, holding one record of each and the records of one
+    digest at a time. Records of a digest are in the order of the manifests, then by path.
+    """
+    algorithms = {read_header(x)['algorithm'] for x in file_paths}
+    if len(algorithms) > 1:
+        raise ValueError(f"Manifests of different hash algorithms: {', '.join(sorted(algorithms))}")
+    streams = [_ranked(file_path, rank) for rank, file_path in enumerate(file_paths)]
+    records = heapq.merge(*streams)
+    for digest, group in groupby(records, key=lambda x: x[0]):
+        yield digest, [record for *_, record in group]
+
+
+def _ranked(file_path, rank):
+    """Generate the records of a manifest with their merge order: digest, manifest, path"""
+    for record in read_manifest(file_path):
+        yield record.digest, rank, record.path, record
+
+
+def merge_to(file_paths: [str], dst_dir) -> (int, int):
+    """Merge manifests into the unique and duplicate lists in dst_dir; return their lengths"""
+    os.makedirs(dst_dir, exist_ok=True)
+    unique = duplicates = 0
+    with open(os.path.join(dst_dir, 'unique.txt'), 'w', encoding='utf-8') as unique_file, \
+            open(os.path.join(dst_dir, 'duplicates.txt'), 'w', encoding='utf-8') as dup_file:
+        for digest, records in merge(file_paths):
+            kept = records[0]
+            unique_file.write(f'{kept.host}\t{kept.path}\n')
+            unique += 1
+            for record in records[1:]:
+                dup_file.write(f'{record.host}\t{record.path}\t{kept.host}\t{kept.path}\n')
+                duplicates += 1
+    return unique, duplicates
+
+
+def main(argv=None):
+    import argparse
+    from collect import Collect
+    parser = argparse.ArgumentParser(description="Write and merge per-host manifests")
+    commands = parser.add_subparsers(dest='command', required=True)
+    write = commands.add_parser('write', help="write the manifest of local folders")
+    write.add_argument('paths', nargs='+')
+    write.add_argument('-o', '--output', required=True)
+    write.add_argument('--host')
+    write.add_argument('--jobs', type=int)
+    write.add_argument('--algorithm', default='sha1', help="hash algorithm, see hashers.py")
+    write.add_argument('--archives', action='store_true', help="collect zip and 7z members")
+    merge_cmd = commands.add_parser('merge', help="merge the manifests of several hosts")
+    merge_cmd.add_argument('manifests', nargs='+')
+    merge_cmd.add_argument('-o', '--output', required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'write':
+        with Collect(args.paths, recursive=True, archives=args.archives,
+                     algorithm=args.algorithm) as collection:
+            count = collection.write_manifest(args.output, args.host, args.jobs)
+        print(f"{count} files written to {args.output}")
+    else:
+        unique, duplicates = merge_to(args.manifests, args.output)
+        print(f"{unique} unique files, {duplicates} duplicates")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+"store.py" Content-addressed collection store
+
+The "collections" folder holds one copy of each unique file, named by its content hash:
+    <root>/<first two hash digits>/<hash><ext>
+so a file whose hash is already present is never copied again, whatever its name or folder.
+
+The store is kept with one hash algorithm, recorded in the file ".algorithm" at its root. A
+file is copied at most once and read at most once: when its hash is not yet known, it is
+computed from the data as it is copied. When the hash is known, the copy is left to the file
+system where possible -- a reflink (copy-on-write clone), os.copy_file_range() within the
+kernel, or optionally a hard link -- falling back to a plain copy. Copies run on a bounded pool
+of threads, reading each source device as its IOScheduler policy says.
+"""
+import os
+import threading
+
+from archive import ArchiveMember
+from hash_pool import HashPool
+from hashers import Hasher, DEFAULT_ALGORITHM
+from io_scheduler import IOScheduler
+from tools import File, Error
+
+COPY_BLOCK = 1024 * 1024
+ALGORITHM_FILE_NAME = '.algorithm'
+
+# Linux ioctl cloning a whole file on copy-on-write file systems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst) -> bool:
+    try:
+        import fcntl
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (ImportError, OSError):
+        return False
+
+
+def _copy_file_range(src, dst, size) -> bool:
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+            if count == 0:
+                break
+            copied += count
+    except OSError:
+        if copied:
+            raise
+        return False
+    return copied == size
+
+
+class CollectionStore:
+    """Folder of unique files named by content hash
+
+    jobs    -- number of copies run at the same time by add_all
+    link    -- hard link files on the same device as the store instead of copying them. The
+               stored file then shares the source's content: only safe when the source is never
+               edited in place
+    verify  -- hash files while copying them even when their hash is already known, failing the
+               copy if the content does not match
+    algorithm -- hash algorithm naming the files of a new store; an existing store keeps its own,
+               and files hashed with another algorithm are hashed again as they are copied
+    scheduler -- IOScheduler ordering the copies of add_all by source device
+    """
+    def __init__(self, root: str, jobs: int = 4, link=False, verify=False,
+                 algorithm: str = DEFAULT_ALGORITHM, scheduler: IOScheduler = None):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        algorithm_path = os.path.join(self.root, ALGORITHM_FILE_NAME)
+        if os.path.isfile(algorithm_path):
+            with open(algorithm_path) as f:
+                algorithm = f.read().strip()
+        else:
+            with open(algorithm_path, 'w') as f:
+                f.write(algorithm + '\n')
+        self.hasher = Hasher(algorithm)
+        self.jobs = jobs
+        self.scheduler = scheduler
+        self.link = link
+        self.verify = verify
+        self._lock = threading.Lock()
+        self._temp_dir = os.path.join(self.root, '.tmp')
+        os.makedirs(self._temp_dir, exist_ok=True)
+        self._device = os.stat(self.root).st_dev
+        self._digests: {str: str} = {}
+        for sub in os.listdir(self.root):
+            sub_path = os.path.join(self.root, sub)
+            if len(sub) == 2 and os.path.isdir(sub_path):
+                for name in os.listdir(sub_path):
+                    self._digests[os.path.splitext(name)[0]] = os.path.join(sub_path, name)
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._digests
+
+    def __len__(self):
+        return len(self._digests)
+
+    def path_for(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + ext.lower())
+
+    def add(self, file: File) -> (str, bool):
+        """Store a file unless its content is already stored; return the stored path and whether
+        the file was copied"""
+        same_algorithm = file.hasher.name == self.hasher.name
+        digest = file._hash if same_algorithm else None
+        if digest is None and same_algorithm and file._cache is not None:
+            digest = file._cache.get(file)
+        if digest is not None and digest in self._digests:
+            return self._digests[digest], False
+
+        temp_path = os.path.join(self._temp_dir, f'{threading.get_ident()}-{file.file_name}')
+        try:
+            if isinstance(file, ArchiveMember):
+                file.archive.extract(file, temp_path)
+                digest = file.hash if same_algorithm else self.hasher.hash_file(temp_path)
+            else:
+                digest = self._copy(file, temp_path, digest)
+            with self._lock:
+                if digest in self._digests:
+                    os.remove(temp_path)
+                    return self._digests[digest], False
+                dst_path = self.path_for(digest, file.ext)
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                os.replace(temp_path, dst_path)
+                self._digests[digest] = dst_path
+            return dst_path, True
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def add_all(self, files: [File]) -> [(str, bool)]:
+        """Store many files on a pool of jobs threads, scheduled as reads of their devices;
+        results are in the order given"""
+        return HashPool(self.jobs, scheduler=self.scheduler).apply(self.add, files)
+
+    def _copy(self, file: File, temp_path, digest) -> str:
+        """Copy a file to temp_path, preserving its modification time; return its hash"""
+        if digest is not None and not self.verify:
+            if self.link and file.stats.st_dev == self._device:
+                try:
+                    os.link(file.file_path, temp_path)
+                    return digest
+                except OSError:
+                    pass
+            with open(file.file_path, 'rb') as src, open(temp_path, 'wb') as dst:
+                copied = _reflink(src, dst) or _copy_file_range(src, dst, file.size)
+            if copied:
+                os.utime(temp_path, ns=(file.stats.st_atime_ns, file.stats.st_mtime_ns))
+                return digest
+
+        # Plain copy, hashing the data on its way through
+        hasher = self.hasher.new()
+        with open(file.file_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            while block := src.read(COPY_BLOCK):
+                hasher.update(block)
+                dst.write(block)
+        os.utime(temp_path, ns=(file.stats.st_atime_ns, file.stats.st_mtime_ns))
+        copied_digest = hasher.hexdigest()
+        if digest is not None and copied_digest != digest:
+            Error(f"Copy {file.file_name} -- content does not match its hash", exit=False)
+            raise OSError(f"{file.file_path} changed while being copied")
+        if file._hash is None and file.hasher.name == self.hasher.name:
+            file._hash = copied_digest
+            if file._metrics is not None:
+                file._counted_hash(file.size)
+            if file._cache is not None:
+                file._cache.put(file, copied_digest)
+        return copied_digest
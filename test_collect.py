@@ -2,15 +2,23 @@
 """
 Python "unittest" test module for photo collector library/program
 """
+import asyncio
 from copy import deepcopy
+from datetime import datetime, timedelta
+import hashlib
+import json
 import os
+import queue
 import re
 import shutil
 from singleton_decorator import singleton
+import struct
 import subprocess
 import sys
+import threading
 import time
 import unittest
+import zipfile
 
 # The "tools.py" library module is maintained under a Tools repository. However, it also needs to
 # be copied into this project repository so that its current state can be committed to the
@@ -30,7 +38,25 @@ from tools import (chdir, make_folder, replicate, SingletonPattern, rewire_unitt
                    File,
                    C_ROOT, PROGRAM_ABS_DIR, PROGRAM_NAME, IS_WINDOWS)
 
+from archive import Archive, ArchiveMember
+from archive_engine import ArchiveEngine
+from async_collect import AsyncCollect
 from collect import Collect
+from collection_index import CollectionIndex
+from dedup import IncrementalDedup, stream_dedup
+from dir_manifest import DirManifest
+from external_dedup import ExternalDedup
+from hash_cache import HashCache
+from hash_pool import HashPool
+from hashers import Hasher, READ_STRATEGIES, available
+from io_scheduler import IOScheduler, Policy, device_kind
+from journal import Journal
+from metrics import Metrics
+from perceptual import Fingerprints
+from query_index import period
+import shards
+from store import CollectionStore
+from watch import Inotify
 
 IMAGE_TYPES = ('.jpg', '.png', '.bmp', '.tif', '.jpeg')
 
@@ -365,6 +391,14 @@ class Test3_Collection(CommonTest):
         collection = Collect(self._deep_photo_folder, 'txt', recursive=True)
         self.assertEqual(len(collection.files), 2, self.unexpected)
 
+    def test_folder5rec_file_info(self):
+        # The walker fills in file type and stats from the directory scan
+        collection = Collect(self._deep_photo_folder, recursive=True)
+        for file in collection.files:
+            self.assertTrue(file._is_file)
+            self.assertIsNotNone(file._stats)
+            self.assertEqual(file.stats.st_size, os.path.getsize(file.file_path))
+
 
 def create_archives():
     """Create several archive files in TestData using files in TestData"""
@@ -397,11 +431,1429 @@ class Test4_ZipExtraction(CommonTest):
         collect = Collect(self.archive_files['zip'], extract=EXTRACTION_DIR, exts=IMAGE_TYPES)
         self.assertNotEqual(len(collect.files), 0)
 
+    def test_7z_archive(self):
+        collect = Collect(self.archive_files['7z'], extract=EXTRACTION_DIR, exts=IMAGE_TYPES)
+        self.assertNotEqual(len(collect.files), 0)
+        for file in collect.files:
+            self.assertTrue(file.file_path.startswith(self.archive_files['7z'] + '!'))
+
+    def test_zip_member_hash(self):
+        collect = Collect(self.archive_files['zip'], archives=True)
+        with zipfile.ZipFile(self.archive_files['zip']) as z:
+            for file in collect.files:
+                content = z.read(file.member_name)
+                self.assertEqual(file.hash, hashlib.sha1(content).hexdigest())
+                self.assertEqual(file.size, len(content))
+
+    def test_extract_unique(self):
+        # A member already present as a plain file is a duplicate and is not extracted
+        dir_path = os.path.join(TEST_ROOT, 'archive_unique')
+        make_folder(dir_path)
+        shutil.copy(self.archive_files['zip'], dir_path)
+        with zipfile.ZipFile(self.archive_files['zip']) as z:
+            members = [x for x in z.infolist() if not x.is_dir()]
+            with open(os.path.join(dir_path, 'plain_copy'), 'wb') as f:
+                f.write(z.read(members[0]))
+        extract_dir = os.path.join(TEST_ROOT, 'archive_unique_extract')
+        make_folder(extract_dir)
+        collect = Collect(dir_path, extract=extract_dir)
+        extracted = collect.extract_unique()
+        self.assertLess(len(extracted), len(members))
+        for file_path in extracted:
+            self.assertTrue(os.path.isfile(file_path))
+
+    def test_same_archive_names(self):
+        # Takeout exports of different accounts share their names
+        dir_path = os.path.join(TEST_ROOT, 'archive_same_names')
+        for sub, data in (('a', b'AAA'), ('b', b'BBB')):
+            make_folder(os.path.join(dir_path, sub))
+            with zipfile.ZipFile(os.path.join(dir_path, sub, 'takeout-001.zip'), 'w') as z:
+                z.writestr('Photos/img.jpg', data)
+        extract_dir = os.path.join(TEST_ROOT, 'archive_same_names_extract')
+        make_folder(extract_dir)
+        extracted = Collect(dir_path, recursive=True, extract=extract_dir).extract_unique()
+        self.assertEqual(len(set(extracted)), 2)
+        contents = set()
+        for file_path in extracted:
+            with open(file_path, 'rb') as f:
+                contents.add(f.read())
+        self.assertEqual(contents, {b'AAA', b'BBB'})
+
+    def test_zip_opened_once(self):
+        dir_path = os.path.join(TEST_ROOT, 'archive_opened_once')
+        make_folder(dir_path)
+        archive_path = os.path.join(dir_path, 'many.zip')
+        with zipfile.ZipFile(archive_path, 'w') as z:
+            for n in range(5):
+                z.writestr(f'{n}.jpg', bytes([n]) * 100)
+        from unittest import mock
+        with mock.patch('zipfile.ZipFile', wraps=zipfile.ZipFile) as opened:
+            with Archive(archive_path) as archive:
+                for member in archive.members():
+                    member.hash
+            self.assertEqual(opened.call_count, 1)
+            self.assertIsNone(archive._zip)
+
 
 class Test5_ExploreVolumes(CommonTest):
     pass
 
 
+class Test6_HashCache(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.cache_path = os.path.join(TEST_ROOT, 'hash_cache.sqlite')
+        if os.path.exists(cls.cache_path):
+            os.remove(cls.cache_path)
+
+    def test_cache_reuse(self):
+        with Collect(self._many_photo_folder, hash_cache=self.cache_path) as collection:
+            hashes = {file.file_path: file.hash for file in collection.files}
+        with Collect(self._many_photo_folder, hash_cache=self.cache_path) as collection:
+            for file in collection.files:
+                self.assertEqual(collection.hash_cache.get(file), hashes[file.file_path])
+                self.assertEqual(file.hash, hashes[file.file_path])
+
+    def test_cache_changed_file(self):
+        dir_path = os.path.join(TEST_ROOT, 'hash_cache_changed')
+        make_folder(dir_path)
+        file_path = os.path.join(dir_path, 'changed.jpg')
+        with open(file_path, 'wb') as f:
+            f.write(b'original')
+        with Collect(dir_path, hash_cache=self.cache_path) as collection:
+            first_hash = collection.files[0].hash
+        with open(file_path, 'ab') as f:
+            f.write(b' and changed')
+        with Collect(dir_path, hash_cache=self.cache_path) as collection:
+            self.assertIsNone(collection.hash_cache.get(collection.files[0]))
+            self.assertNotEqual(collection.files[0].hash, first_hash)
+
+    def test_close(self):
+        # A cache opened by the collection is closed with it, one given is left open
+        with Collect(self._many_photo_folder, hash_cache=self.cache_path) as collection:
+            pass
+        self.assertIsNone(collection.hash_cache._db)
+        with HashCache(self.cache_path) as cache:
+            with Collect(self._many_photo_folder, hash_cache=cache):
+                pass
+            self.assertIsNotNone(cache._db)
+
+
+class Test7_Dedup(CommonTest):
+
+    def test_no_duplicates(self):
+        dedup = Collect(self._many_photo_folder).dedup()
+        self.assertEqual(len(dedup.unique), len(self._src_images))
+        self.assertEqual(len(dedup.duplicates), 0)
+
+    def test_subfolder_duplicates(self):
+        # Folder 5 and its subfolder hold the same files
+        dedup = Collect(self._deep_photo_folder, recursive=True).dedup()
+        self.assertEqual(len(dedup.unique), len(self._src_files))
+        self.assertEqual(len(dedup.duplicates), len(self._src_files))
+        for file in dedup.duplicates:
+            original = dedup.original[file.file_path]
+            self.assertEqual(original.file_name, file.file_name)
+            self.assertEqual(original.hash, file.hash)
+
+    def test_overlapping_paths(self):
+        dedup = Collect([self._photo_folder, self._photo_folder]).dedup()
+        self.assertEqual(len(dedup.unique), 1)
+        self.assertEqual(len(dedup.duplicates), 0)
+
+    def test_same_size_different_content(self):
+        dir_path = os.path.join(TEST_ROOT, 'dedup_same_size')
+        make_folder(dir_path)
+        block = b'x' * 10000
+        for name, content in (('a.jpg', block + b'1' + block), ('b.jpg', block + b'2' + block),
+                              ('c.jpg', block + b'1' + block)):
+            with open(os.path.join(dir_path, name), 'wb') as f:
+                f.write(content)
+        dedup = Collect(dir_path).dedup()
+        self.assertEqual(len(dedup.unique), 2)
+        self.assertEqual(len(dedup.duplicates), 1)
+        duplicate = dedup.duplicates[0]
+        self.assertEqual({duplicate.file_name, dedup.original[duplicate.file_path].file_name},
+                         {'a.jpg', 'c.jpg'})
+        self.assertEqual(dedup.partial_hashed, 3)
+        self.assertEqual(dedup.full_hashed, 3)
+
+
+class Test8_HashPool(CommonTest):
+
+    def test_hash_all(self):
+        collection = Collect(self._deep_photo_folder, recursive=True)
+        expected = [File(file.file_path).hash for file in collection.files]
+        self.assertEqual(collection.hash_all(jobs=4, per_device=2), expected)
+
+    def test_partial_hash_order(self):
+        collection = Collect(self._deep_photo_folder, recursive=True)
+        expected = [File(file.file_path).partial_hash for file in collection.files]
+        pool = HashPool(jobs=3, per_device=1)
+        self.assertEqual(list(pool.imap(iter(collection.files), 'partial_hash')), expected)
+
+    def test_missing_file(self):
+        pool = HashPool(jobs=2)
+        file = File(os.path.join(self._empty_folder, 'missing.jpg'))
+        with self.assertRaises(OSError):
+            pool.map([file])
+
+    def test_deleted_file(self):
+        # Deleted between the walk and hashing: the file alone is reported and left out
+        dir_path = os.path.join(TEST_ROOT, 'deleted_before_hash')
+        make_folder(dir_path)
+        for n in range(4):
+            with open(os.path.join(dir_path, f'{n}.jpg'), 'wb') as f:
+                f.write(b'same' * 3000 if n < 3 else b'diff' * 3000)
+        collection = Collect(dir_path)
+        unknown = File(os.path.join(dir_path, 'gone.jpg'))
+        os.remove(os.path.join(dir_path, '0.jpg'))
+        pool = HashPool(jobs=2)
+        hashes = pool.map(collection.files + [unknown], skip_errors=True)
+        self.assertEqual(hashes[0], None)
+        self.assertEqual(hashes[4], None)
+        self.assertEqual(hashes[1], hashes[2])
+        dedup = collection.dedup(jobs=2)
+        self.assertEqual([x.file_name for x in dedup.failed], ['0.jpg'])
+        self.assertEqual([x.file_name for x in dedup.unique], ['1.jpg', '3.jpg'])
+        self.assertEqual([x.file_name for x in dedup.duplicates], ['2.jpg'])
+        self.assertIsNone(collection.hash_all()[0])
+
+
+def make_exif_jpeg(file_path, date_time: str, make='TestCam'):
+    """Write a minimal JPEG file holding an EXIF segment with Make and DateTimeOriginal"""
+    make = make.encode() + b'\0'
+    date_time = date_time.encode() + b'\0'
+    # TIFF header, IFD0 (Make, Exif IFD pointer), Exif IFD (DateTimeOriginal), then the strings
+    ifd0 = 8
+    exif_ifd = ifd0 + 2 + 2 * 12 + 4
+    make_at = exif_ifd + 2 + 12 + 4
+    date_at = make_at + len(make)
+    tiff = b'II*\0' + struct.pack('<I', ifd0)
+    tiff += struct.pack('<H', 2)
+    tiff += struct.pack('<HHII', 0x010F, 2, len(make), make_at)
+    tiff += struct.pack('<HHII', 0x8769, 4, 1, exif_ifd) + struct.pack('<I', 0)
+    tiff += struct.pack('<H', 1)
+    tiff += struct.pack('<HHII', 0x9003, 2, len(date_time), date_at) + struct.pack('<I', 0)
+    tiff += make + date_time
+    app1 = b'Exif\0\0' + tiff
+    with open(file_path, 'wb') as f:
+        f.write(b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1)
+        f.write(b'\xff\xda' + os.urandom(5000) + b'\xff\xd9')
+
+
+def make_mp4(file_path, seconds_since_1904: int, moov_first=True):
+    """Write a minimal MP4 file holding a version 0 movie header"""
+    mvhd = b'\0\0\0\0' + struct.pack('>II', seconds_since_1904, seconds_since_1904) + bytes(88)
+    moov = struct.pack('>I', 16 + len(mvhd)) + b'moov' + struct.pack('>I', 8 + len(mvhd)) + b'mvhd'
+    moov += mvhd
+    ftyp = struct.pack('>I', 16) + b'ftypisom' + bytes(4)
+    mdat = struct.pack('>I', 8 + 20000) + b'mdat' + os.urandom(20000)
+    with open(file_path, 'wb') as f:
+        f.write(ftyp + (moov + mdat if moov_first else mdat + moov))
+
+
+class Test9_Metadata(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.meta_folder = os.path.join(TEST_ROOT, 'metadata')
+        make_folder(cls.meta_folder)
+        make_exif_jpeg(os.path.join(cls.meta_folder, 'exif.jpg'), '2019:07:04 10:20:30')
+        make_mp4(os.path.join(cls.meta_folder, 'front.mp4'), 3_645_000_000)
+        make_mp4(os.path.join(cls.meta_folder, 'back.mp4'), 3_645_000_000, moov_first=False)
+        with open(os.path.join(cls.meta_folder, 'empty.jpg'), 'wb'):
+            pass
+
+    def _file(self, name):
+        return File(os.path.join(self.meta_folder, name))
+
+    def test_jpeg_exif(self):
+        file = self._file('exif.jpg')
+        self.assertEqual(file.exif['Make'], 'TestCam')
+        self.assertEqual(file.taken_at, datetime(2019, 7, 4, 10, 20, 30))
+
+    def test_single_read_hash(self):
+        file = self._file('exif.jpg')
+        file.scan()
+        self.assertIsNotNone(file._hash)
+        self.assertEqual(file.hash, self._file('exif.jpg').hash)
+
+    def test_mp4_creation_time(self):
+        expected = datetime(1904, 1, 1) + timedelta(seconds=3_645_000_000)
+        self.assertEqual(self._file('front.mp4').taken_at, expected)
+        self.assertEqual(self._file('back.mp4').taken_at, expected)
+
+    def test_no_metadata(self):
+        for file in (self._file('empty.jpg'), TestFile('notes.txt', self._nonphoto_folder)):
+            self.assertEqual(file.exif, {})
+            self.assertIsNone(file.taken_at)
+        self.assertEqual(self._file('empty.jpg').hash, hashlib.sha1(b'').hexdigest())
+
+
+class Test10_DirManifest(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.tree = os.path.join(TEST_ROOT, 'manifest_tree')
+        make_folder(cls.tree)
+        for sub in ('a', os.path.join('a', 'b'), 'c'):
+            make_folder(os.path.join(cls.tree, sub))
+            for name in ('one.jpg', 'two.png', 'three.txt'):
+                with open(os.path.join(cls.tree, sub, name), 'wb') as f:
+                    f.write(name.encode())
+        cls.manifest_path = os.path.join(TEST_ROOT, 'manifest.pickle')
+        if os.path.exists(cls.manifest_path):
+            os.remove(cls.manifest_path)
+
+    def _age_tree(self):
+        # Folders changed just before being listed are not trusted; set their times back
+        past = time.time() - 60
+        for dir_path, _, _ in os.walk(self.tree):
+            os.utime(dir_path, (past, past))
+
+    def _collect(self):
+        with Collect(self.tree, IMAGE_TYPES, recursive=True,
+                     manifest=self.manifest_path) as collection:
+            return collection
+
+    def test_rescan(self):
+        self._age_tree()
+        first = self._collect()
+        self.assertEqual(first.manifest.listed, 4)
+        rerun = self._collect()
+        self.assertEqual(rerun.manifest.listed, 0)
+        self.assertEqual(rerun.manifest.reused, 4)
+        self.assertEqual(sorted(x.file_path for x in rerun.files),
+                         sorted(x.file_path for x in first.files))
+        # Only names are recorded, files of reused listings being stat'ed again
+        c_path = os.path.join(self.tree, 'c')
+        self.assertEqual(sorted(rerun.manifest.get(c_path, os.stat(c_path).st_mtime_ns)[1]),
+                         sorted(os.listdir(c_path)))
+
+        # Only the changed folder is listed again
+        with open(os.path.join(self.tree, 'c', 'new.jpg'), 'wb') as f:
+            f.write(b'new')
+        shutil.rmtree(os.path.join(self.tree, 'a', 'b'))
+        changed = self._collect()
+        self.assertEqual(changed.manifest.listed, 2)
+        self.assertEqual(len(changed.files), len(first.files) - 1)
+
+    def test_rewritten_in_place(self):
+        cache = os.path.join(TEST_ROOT, 'manifest_hashes.sqlite')
+        if os.path.exists(cache):
+            os.remove(cache)
+        photo = os.path.join(self.tree, 'c', 'one.jpg')
+
+        def photo_hash():
+            with Collect(os.path.join(self.tree, 'c'), IMAGE_TYPES, recursive=True,
+                         manifest=self.manifest_path, hash_cache=cache) as collection:
+                return next(x for x in collection.files if x.file_path == photo).hash
+
+        past = time.time() - 60
+        os.utime(os.path.dirname(photo), (past, past))
+        photo_hash()
+        # The folder keeps its modification time, and its listing is reused
+        with open(photo, 'wb') as f:
+            f.write(b'rewritten in place')
+        os.utime(os.path.dirname(photo), (past, past))
+        self.assertEqual(photo_hash(), hashlib.sha1(b'rewritten in place').hexdigest())
+
+
+class Test11_FileTable(CommonTest):
+
+    def test_slots(self):
+        file = File(os.path.join(self._photo_folder, 'any.jpg'))
+        self.assertFalse(hasattr(file, '__dict__'))
+        self.assertEqual(file.file_path, os.path.join(self._photo_folder, 'any.jpg'))
+        self.assertEqual((file.name, file.ext), ('any', '.jpg'))
+
+    def test_table(self):
+        files = Collect(self._deep_photo_folder, recursive=True).files
+        table = Collect(self._deep_photo_folder, recursive=True, table=True).table
+        self.assertEqual(len(table), len(files))
+        self.assertEqual(len(table.dirs), 2)
+        self.assertEqual(sorted(table.path(x) for x in range(len(table))),
+                         sorted(x.file_path for x in files))
+        file = files[0]
+        self.assertIn(file.file_path, [table.path(x) for x in table.find_size(file.size)])
+
+    def test_table_digests(self):
+        table = Collect(self._deep_photo_folder, recursive=True, table=True).table
+        for row in range(len(table)):
+            table.set_digest(row, table.file(row).hash)
+        # Folder 5 and its subfolder hold the same files
+        groups = list(table.same_digest())
+        self.assertEqual(len(groups), len(self._src_files))
+        for rows in groups:
+            self.assertEqual(len(rows), 2)
+            self.assertEqual(table.find_digest(table.digest(rows[0])), rows)
+
+    def test_table_members(self):
+        dir_path = os.path.join(TEST_ROOT, 'table_members')
+        make_folder(dir_path)
+        with zipfile.ZipFile(os.path.join(dir_path, 'photos.zip'), 'w') as z:
+            z.writestr('a/1.jpg', b'one' * 100)
+        table = Collect(dir_path, archives=True, table=True).table
+        file = table.file(0)
+        self.assertIsInstance(file, ArchiveMember)
+        self.assertEqual((file.size, file.hash), (300, hashlib.sha1(b'one' * 100).hexdigest()))
+        self.assertEqual(file.file_path, table.path(0))
+
+
+class Test12_Stream(CommonTest):
+
+    def test_lazy(self):
+        collection = Collect(self._deep_photo_folder, recursive=True, lazy=True)
+        self.assertEqual(len(collection.files), 0)
+        found = [file.file_path for file in collection.iter_files()]
+        self.assertEqual(found, [file.file_path for file in
+                                 Collect(self._deep_photo_folder, recursive=True).files])
+
+    def test_first_result(self):
+        files = Collect(self._deep_photo_folder, recursive=True, lazy=True).stream(jobs=2)
+        file = next(files)
+        self.assertIsNotNone(file._hash)
+        files.close()
+
+    def test_stream_dedup(self):
+        collection = Collect(self._deep_photo_folder, recursive=True, lazy=True)
+        results = list(stream_dedup(collection.stream(jobs=2)))
+        duplicates = [(file, original) for file, original in results if original]
+        self.assertEqual(len(results), 2 * len(self._src_files))
+        self.assertEqual(len(duplicates), len(self._src_files))
+        for file, original in duplicates:
+            self.assertEqual(file.hash, original.hash)
+            self.assertNotEqual(file.file_path, original.file_path)
+
+
+class Test13_FileFilter(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.tree = os.path.join(TEST_ROOT, 'filter_tree')
+        make_folder(cls.tree)
+        for sub in ('2019', os.path.join('2019', '07'), os.path.join('2019', '07', 'deep'),
+                    '2020', 'node_modules', '$RECYCLE.BIN', os.path.join('2020', '@eaDir')):
+            make_folder(os.path.join(cls.tree, sub))
+            for name, size in (('small.jpg', 10), ('big.JPG', 5000), ('note.txt', 10)):
+                with open(os.path.join(cls.tree, sub, name), 'wb') as f:
+                    f.write(b'x' * size)
+
+    def _collect(self, **kwargs):
+        # A fresh manifest counts the folders listed
+        manifest_path = os.path.join(TEST_ROOT, 'filter_manifest.pickle')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        manifest = DirManifest(manifest_path)
+        collection = Collect(self.tree, IMAGE_TYPES, recursive=True, manifest=manifest,
+                             **kwargs)
+        dirs = {os.path.relpath(x.dir_path, self.tree) for x in collection.files}
+        return collection, dirs
+
+    def test_default_exclusions(self):
+        collection, dirs = self._collect()
+        self.assertEqual(dirs, {'2019', os.path.join('2019', '07'),
+                                os.path.join('2019', '07', 'deep'), '2020'})
+        # Excluded folders are not even listed: root, 2019, 07, deep and 2020
+        self.assertEqual(collection.manifest.listed, 5)
+
+    def test_ext_case(self):
+        collection, _ = self._collect()
+        self.assertEqual(len(collection.files), 8)
+
+    def test_exts_and_not_exts(self):
+        collection = Collect(self._many_photo_folder, IMAGE_TYPES, not_exts='bmp')
+        expected = [x for x in self._src_images if x.ext != '.bmp']
+        self.assertEqual(len(collection.files), len(expected))
+
+    def test_max_depth(self):
+        _, dirs = self._collect(max_depth=1)
+        self.assertEqual(dirs, {'2019', '2020'})
+
+    def test_size(self):
+        collection, _ = self._collect(min_size=100)
+        self.assertEqual({x.file_name for x in collection.files}, {'big.JPG'})
+        collection, _ = self._collect(max_size=100)
+        self.assertEqual({x.file_name for x in collection.files}, {'small.jpg'})
+
+    def test_include_dirs(self):
+        collection, dirs = self._collect(include_dirs=['2019/07'], exclude_dirs=['deep'])
+        self.assertEqual(dirs, {os.path.join('2019', '07')})
+        # The 2020 subtree cannot lead to 2019/07 and is pruned: root, 2019 and 07 are listed
+        self.assertEqual(collection.manifest.listed, 3)
+
+
+class Test14_Store(CommonTest):
+
+    def setUp(self):
+        self.root = os.path.join(TEST_ROOT, 'store')
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+
+    def test_store_unique(self):
+        collection = Collect(self._deep_photo_folder, recursive=True)
+        paths = collection.store_unique(self.root, jobs=2)
+        self.assertEqual(len(paths), len(self._src_files))
+        for path in paths:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            self.assertEqual(os.path.splitext(os.path.basename(path))[0], digest)
+            self.assertEqual(os.path.basename(os.path.dirname(path)), digest[:2])
+
+    def test_no_copy_twice(self):
+        files = Collect(self._deep_photo_folder, recursive=True).files
+        store = CollectionStore(self.root)
+        added = [x for _, x in store.add_all(files)]
+        self.assertEqual(added.count(True), len(self._src_files))
+        # Copying computed the hash of each file
+        self.assertTrue(all(x._hash is not None for x in files))
+        # A store reopened on the same folder knows what it holds
+        store = CollectionStore(self.root, link=True)
+        self.assertEqual(len(store), len(self._src_files))
+        self.assertFalse(any(x for _, x in store.add_all(files)))
+
+    def test_known_hash(self):
+        file = Collect(self._many_photo_folder).files[0]
+        file.hash
+        path, added = CollectionStore(self.root, verify=True).add(file)
+        self.assertTrue(added)
+        self.assertEqual(os.stat(path).st_mtime_ns, file.stats.st_mtime_ns)
+
+
+class Test15_Metrics(CommonTest):
+
+    def test_counters(self):
+        metrics = Metrics()
+        collection = Collect(self._deep_photo_folder, recursive=True, metrics=metrics)
+        collection.hash_all(jobs=2)
+        counters = metrics.counters
+        self.assertEqual(counters['files_matched'], len(collection.files))
+        self.assertGreater(counters['dirs_listed'], 1)
+        self.assertEqual(counters['stat_calls'], len(collection.files))
+        self.assertEqual(counters['files_hashed'], len(collection.files))
+        self.assertEqual(counters['bytes_hashed'], sum(x.size for x in collection.files))
+        self.assertEqual(set(metrics.stages), {'walk', 'hash'})
+
+    def test_cache_hits(self):
+        cache_path = os.path.join(TEST_ROOT, 'metrics_cache.sqlite')
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        with Collect(self._many_photo_folder, hash_cache=cache_path) as collection:
+            collection.hash_all()
+        metrics = Metrics()
+        collection = Collect(self._many_photo_folder, hash_cache=cache_path, metrics=metrics)
+        collection.hash_all()
+        self.assertEqual(metrics.counters['cache_hits'], len(collection.files))
+        self.assertEqual(metrics.counters['files_hashed'], 0)
+        collection.close()
+
+    def test_progress(self):
+        reports = []
+        metrics = Metrics(progress=reports.append, interval=3600)
+        Collect(self._deep_photo_folder, recursive=True, metrics=metrics).close()
+        # Throttled to the final report
+        self.assertEqual(len(reports), 1)
+        reports = []
+        metrics = Metrics(progress=reports.append, interval=0)
+        Collect(self._deep_photo_folder, recursive=True, metrics=metrics)
+        self.assertGreater(len(reports), metrics.counters['dirs_listed'])
+
+    def test_json_lines(self):
+        sink_path = os.path.join(TEST_ROOT, 'metrics.jsonl')
+        if os.path.exists(sink_path):
+            os.remove(sink_path)
+        metrics = Metrics(sink=sink_path, interval=0)
+        with Collect(self._deep_photo_folder, recursive=True, metrics=metrics) as collection:
+            collection.dedup()
+        with open(sink_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertTrue(records[-1]['final'])
+        self.assertEqual(records[-1]['counters']['files_matched'], len(collection.files))
+        self.assertIn('dedup', records[-1]['stages'])
+
+
+class Test16_Imports(CommonTest):
+
+    def _loaded(self, code):
+        env = dict(os.environ, SYNC_MODULES='0')
+        return subprocess.run([sys.executable, '-c', code], cwd=PROGRAM_ABS_DIR, env=env,
+                              check=True, capture_output=True, text=True).stdout.split()
+
+    def test_deferred_modules(self):
+        loaded = self._loaded("import sys, collect; "
+                              "print(*(x for x in ('py7zr', 'sqlite3', 'unittest', "
+                              "'sync_modules') if x in sys.modules))")
+        self.assertEqual(loaded, [])
+
+    def test_c_root(self):
+        loaded = self._loaded("import tools; print('C_ROOT' in vars(tools)); "
+                              "from tools import C_ROOT; print(C_ROOT == tools.C_ROOT)")
+        self.assertEqual(loaded, ['False', 'True'])
+
+
+class Test17_Async(CommonTest):
+
+    def test_aiter_files(self):
+        async def run():
+            async with AsyncCollect(self._deep_photo_folder, recursive=True) as collection:
+                return [file.file_path async for file in collection.aiter_files()]
+        expected = [x.file_path for x in Collect(self._deep_photo_folder, recursive=True).files]
+        self.assertEqual(asyncio.run(run()), expected)
+
+    def test_astream(self):
+        async def run():
+            async with AsyncCollect(self._deep_photo_folder, recursive=True, jobs=1,
+                                    queue_size=1) as collection:
+                return [file async for file in collection.astream()]
+        files = asyncio.run(run())
+        self.assertEqual(len(files), 2 * len(self._src_files))
+        self.assertTrue(all(x._hash is not None for x in files))
+
+    def test_ahash(self):
+        file = Collect(self._many_photo_folder).files[0]
+        self.assertEqual(asyncio.run(file.ahash()), File(file.file_path).hash)
+
+    def test_cancel(self):
+        async def run():
+            async with AsyncCollect(self._deep_photo_folder, recursive=True,
+                                    queue_size=1) as collection:
+                found = []
+
+                async def consume():
+                    async for file in collection.astream():
+                        found.append(file)
+                        await asyncio.sleep(3600)
+                task = asyncio.create_task(consume())
+                while not found:
+                    await asyncio.sleep(0.01)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                return found
+        self.assertEqual(len(asyncio.run(run())), 1)
+
+
+class Test18_CollectionIndex(CommonTest):
+
+    def setUp(self):
+        self.tree = os.path.join(TEST_ROOT, 'index_tree')
+        make_folder(self.tree)
+        for sub in ('a', 'b'):
+            make_folder(os.path.join(self.tree, sub))
+        self._write('a/1.jpg', b'x' * 10000)
+        self._write('a/2.jpg', b'y' * 10000)
+        self._write('a/3.jpg', b'z' * 500)
+        self._write('b/1.jpg', b'x' * 10000)
+        self._write('b/4.jpg', b'q' * 777)
+        self.db_path = os.path.join(TEST_ROOT, 'index.sqlite')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def _write(self, rel_path, data):
+        with open(os.path.join(self.tree, rel_path), 'wb') as f:
+            f.write(data)
+
+    def _path(self, rel_path):
+        return os.path.join(self.tree, *rel_path.split('/'))
+
+    def _index(self, *rel_paths, **kwargs):
+        """Collect and dedup each folder in turn, as separate runs"""
+        for rel_path in rel_paths:
+            with Collect(self._path(rel_path), recursive=True, index=self.db_path) as collection:
+                collection.dedup()
+                collection.index.close()
+        return CollectionIndex(self.db_path, **kwargs)
+
+    def test_incremental_runs(self):
+        with self._index('a', 'b') as index:
+            self.assertEqual(index.unique(), [self._path(x) for x in
+                                              ('a/1.jpg', 'a/2.jpg', 'a/3.jpg', 'b/4.jpg')])
+            # The second run found b/1.jpg a duplicate of a/1.jpg, collected on the first
+            self.assertEqual(index.duplicates(), [(self._path('b/1.jpg'), self._path('a/1.jpg'))])
+            self.assertEqual(index.copies(hashlib.sha1(b'x' * 10000).hexdigest()),
+                             [self._path('a/1.jpg'), self._path('b/1.jpg')])
+
+    def test_unique_per_root(self):
+        with self._index('a', 'b') as index:
+            self.assertEqual(index.unique(self._path('b')),
+                             [self._path('b/1.jpg'), self._path('b/4.jpg')])
+            self.assertEqual(index.duplicates(self._path('b')), [])
+
+    def test_gone(self):
+        self._index('a').close()
+        os.remove(self._path('a/2.jpg'))
+        with self._index('a') as index:
+            self.assertEqual(index.gone(), [self._path('a/2.jpg')])
+            self.assertEqual(len(index), 2)
+
+    def test_resolved_once(self):
+        from unittest import mock
+        import collection_index
+        self._index('a', 'b').close()
+        # a/1.jpg and a/2.jpg, of the same size, were told apart by partial hash: neither they
+        # nor the files of b are looked up again
+        with mock.patch.object(collection_index, 'find_file',
+                               wraps=collection_index.find_file) as find_file:
+            with self._index('a') as index:
+                self.assertEqual(find_file.call_count, 0)
+                self.assertEqual(len(index.unique()), 4)
+        self._write('b/4.jpg', b'r' * 10000)
+        with mock.patch.object(collection_index, 'find_file',
+                               wraps=collection_index.find_file) as find_file:
+            with self._index('b') as index:
+                self.assertEqual(find_file.call_count, 2)
+                self.assertEqual(len(index.unique()), 4)
+
+    def test_unresolved(self):
+        with Collect(self.tree, recursive=True, index=self.db_path) as collection:
+            self.assertRaises(ValueError, collection.index.unique)
+            collection.dedup()
+            self.assertEqual(len(collection.index.unique()), 4)
+
+    def test_narrower_filter(self):
+        self._index('').close()
+        # Files skipped by the filter, or in folders pruned, are not gone
+        for kwargs in ({'exts': ['png']}, {'min_size': 1000}, {'max_depth': 0},
+                       {'exclude_dirs': ['a']}):
+            with Collect(self.tree, recursive=True, index=self.db_path, **kwargs) as collection:
+                self.assertEqual(collection.index.gone(), [])
+                self.assertEqual(len(collection.index), 5)
+        os.remove(self._path('a/3.jpg'))
+        with Collect(self.tree, recursive=True, index=self.db_path, exclude_dirs=['b']):
+            pass
+        with CollectionIndex(self.db_path) as index:
+            self.assertEqual(index.gone(), [self._path('a/3.jpg')])
+            self.assertEqual(len(index), 4)
+
+    def test_index_in_root(self):
+        # The database files, its hidden default name included, are never collected
+        for db_path in (self._path('a'), self._path('a/index.sqlite')):
+            for _ in range(2):
+                with Collect(self.tree, recursive=True, patterns=['*', '.*'],
+                             index=db_path) as collection:
+                    self.assertEqual(len(collection.files), 5)
+                    self.assertEqual(len(collection.index), 5)
+                    self.assertEqual(collection.index.gone(), [])
+                    db_path = collection.index.db_path
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    def test_changed(self):
+        self._index('a', 'b').close()
+        self._write('b/1.jpg', b'w' * 10000)
+        with self._index('b') as index:
+            self.assertEqual(index.duplicates(), [])
+
+    def test_fresh(self):
+        self._index('a').close()
+        with self._index('b', fresh=True) as index:
+            self.assertEqual(len(index), 0)
+            self.assertEqual(index.run, 1)
+
+
+def _have_imaging():
+    try:
+        import numpy
+        import PIL
+    except ImportError:
+        return False
+    return True
+
+
+@unittest.skipUnless(_have_imaging(), "Pillow and NumPy are not installed")
+class Test19_Perceptual(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        import numpy
+        from PIL import Image, ImageDraw
+        cls.folder = os.path.join(TEST_ROOT, 'similar')
+        make_folder(cls.folder)
+        # Pictures of random shapes, each saved at three sizes in three formats
+        for n in range(3):
+            rng = numpy.random.default_rng(n)
+            image = Image.new('RGB', (400, 300))
+            draw = ImageDraw.Draw(image)
+            for _ in range(12):
+                x, y, w, h = (int(v) for v in rng.integers(0, 300, 4))
+                draw.ellipse([x, y, x + w // 2 + 20, y + h // 2 + 20],
+                             fill=tuple(int(v) for v in rng.integers(0, 256, 3)))
+            for width, ext in ((400, 'jpg'), (200, 'png'), (100, 'tif')):
+                image.resize((width, width * 3 // 4)).save(
+                    os.path.join(cls.folder, f'picture{n}_{width}.{ext}'))
+
+    def test_clusters(self):
+        clusters = Collect(self.folder).similar()
+        self.assertEqual(sorted(sorted(x.file_name for x in cluster) for cluster in clusters),
+                         [[f'picture{n}_100.tif', f'picture{n}_200.png', f'picture{n}_400.jpg']
+                          for n in range(3)])
+
+    def test_not_images(self):
+        fingerprints = Fingerprints(Collect(self._many_photo_folder).files)
+        self.assertEqual(len(fingerprints), 0)
+
+    def test_pairs(self):
+        import numpy
+        fingerprints = Fingerprints()
+        values = [0, 0b1011, 0b1011 << 40, 2**64 - 1, 2**64 - 2]
+        fingerprints.hashes = numpy.array(values, dtype=numpy.uint64)
+        fingerprints.files = values
+        i, j = fingerprints.pairs(3)
+        self.assertEqual(list(zip(i.tolist(), j.tolist())), [(0, 1), (0, 2), (3, 4)])
+        self.assertEqual(fingerprints.near(0b1, 2), [0, 0b1011])
+
+
+class Test20_Shards(CommonTest):
+    """Local folders stand in for hosts"""
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.hosts = os.path.join(TEST_ROOT, 'hosts')
+        make_folder(cls.hosts)
+        contents = {'pc': [b'a' * 100, b'b' * 200, b'c' * 300],
+                    'nas': [b'b' * 200, b'd' * 400, b'd' * 400]}
+        for host, datas in contents.items():
+            make_folder(os.path.join(cls.hosts, host))
+            for n, data in enumerate(datas):
+                with open(os.path.join(cls.hosts, host, f'{n}.jpg'), 'wb') as f:
+                    f.write(data)
+        cls.manifests = []
+        for host, ext in (('pc', '.gz'), ('nas', '')):
+            manifest = os.path.join(cls.hosts, f'{host}.manifest{ext}')
+            Collect(os.path.join(cls.hosts, host)).write_manifest(manifest, host)
+            cls.manifests.append(manifest)
+
+    def test_sorted(self):
+        for manifest in self.manifests:
+            digests = [x.digest for x in shards.read_manifest(manifest)]
+            self.assertEqual(digests, sorted(digests))
+            self.assertEqual(len(digests), 3)
+
+    def test_merge(self):
+        groups = {digest: [(x.host, os.path.basename(x.path)) for x in records]
+                  for digest, records in shards.merge(self.manifests)}
+        self.assertEqual(groups[hashlib.sha1(b'b' * 200).hexdigest()],
+                         [('pc', '1.jpg'), ('nas', '0.jpg')])
+        self.assertEqual(groups[hashlib.sha1(b'd' * 400).hexdigest()],
+                         [('nas', '1.jpg'), ('nas', '2.jpg')])
+        self.assertEqual(len(groups), 4)
+
+    def test_merge_to(self):
+        output = os.path.join(self.hosts, 'merged')
+        self.assertEqual(shards.merge_to(self.manifests, output), (4, 2))
+        with open(os.path.join(output, 'duplicates.txt')) as f:
+            hosts = [line.split('\t')[0::2] for line in f]
+        self.assertEqual(sorted(hosts), [['nas', 'nas'], ['nas', 'pc']])
+
+    def test_command_line(self):
+        manifest = os.path.join(self.hosts, 'cli.manifest')
+        shards.main(['write', '-o', manifest, '--host', 'cli', os.path.join(self.hosts, 'pc')])
+        self.assertEqual({x.host for x in shards.read_manifest(manifest)}, {'cli'})
+
+
+class Test21_Hashers(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.hash_dir = os.path.join(TEST_ROOT, 'hashers')
+        make_folder(cls.hash_dir)
+        cls.data = os.urandom(3 * 1024 * 1024 + 123)
+        cls.file_path = os.path.join(cls.hash_dir, 'big.jpg')
+        with open(cls.file_path, 'wb') as f:
+            f.write(cls.data)
+        with open(os.path.join(cls.hash_dir, 'empty.jpg'), 'wb'):
+            pass
+
+    def test_algorithms(self):
+        for algorithm in ('sha1', 'sha256', 'blake2b'):
+            with Collect(self.file_path, algorithm=algorithm) as collection:
+                self.assertEqual(collection.files[0].hash,
+                                 hashlib.new(algorithm, self.data).hexdigest())
+        self.assertRaises(ValueError, Hasher, 'md4-ish')
+
+    def test_strategies_agree(self):
+        for algorithm in available():
+            digests = set()
+            for strategy in READ_STRATEGIES:
+                try:
+                    hasher = Hasher(algorithm, strategy)
+                except ValueError:
+                    continue
+                digests.add(hasher.hash_file(self.file_path))
+                self.assertEqual(hasher.hash_file(os.path.join(self.hash_dir, 'empty.jpg')),
+                                 hasher.new().hexdigest())
+            self.assertEqual(len(digests), 1, algorithm)
+
+    def test_cache_per_algorithm(self):
+        cache_path = os.path.join(self.hash_dir, 'cache.sqlite')
+        with Collect(self.file_path, hash_cache=cache_path) as collection:
+            sha1 = collection.files[0].hash
+        with Collect(self.file_path, hash_cache=cache_path, algorithm='sha256') as collection:
+            self.assertIsNone(collection.hash_cache.get(collection.files[0]))
+            self.assertNotEqual(collection.files[0].hash, sha1)
+
+    def test_manifest_algorithm(self):
+        manifests = []
+        for algorithm in ('sha1', 'blake2b'):
+            manifest = os.path.join(self.hash_dir, f'{algorithm}.manifest')
+            Collect(self.file_path, algorithm=algorithm).write_manifest(manifest, algorithm)
+            self.assertEqual(shards.read_header(manifest)['algorithm'], algorithm)
+            manifests.append(manifest)
+        self.assertRaises(ValueError, list, shards.merge(manifests))
+
+    def test_store_algorithm(self):
+        root = os.path.join(self.hash_dir, 'store')
+        with Collect(self.file_path, algorithm='sha256') as collection:
+            paths = collection.store_unique(root)
+        self.assertEqual(os.path.basename(paths[0]),
+                         hashlib.sha256(self.data).hexdigest() + '.jpg')
+        # The store keeps its algorithm; files hashed otherwise are hashed again as copied
+        self.assertEqual(CollectionStore(root, algorithm='sha1').hasher.name, 'sha256')
+        with Collect(self.file_path) as collection:
+            self.assertEqual(collection.store_unique(root), paths)
+
+
+class Test22_ArchiveEngine(CommonTest):
+    """Zips within zips, as in Takeout exports"""
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.engine_dir = os.path.join(TEST_ROOT, 'archive_engine')
+        shutil.rmtree(cls.engine_dir, ignore_errors=True)
+        make_folder(cls.engine_dir)
+        inner = os.path.join(cls.engine_dir, 'inner.zip')
+        with zipfile.ZipFile(inner, 'w') as z:
+            z.writestr('deep/photo.jpg', b'deep' * 100)
+        cls.outer = os.path.join(cls.engine_dir, 'outer.zip')
+        with zipfile.ZipFile(cls.outer, 'w') as z:
+            z.writestr('top.jpg', b'top' * 100)
+            z.write(inner, 'nested/inner.zip')
+        os.remove(inner)
+        cls.renamed = os.path.join(cls.engine_dir, 'renamed.zip')
+        shutil.copyfile(cls.outer, cls.renamed)
+        cls.cache = os.path.join(cls.engine_dir, 'cache')
+
+    def test_nested(self):
+        with ArchiveEngine(self.cache, jobs=2) as engine:
+            engine.unpack([self.outer])
+            files = dict(engine.files(self.outer))
+        self.assertEqual(sorted(os.path.relpath(x, self.engine_dir) for x in files),
+                         [os.path.join('outer.zip!nested', 'inner.zip!deep', 'photo.jpg'),
+                          'outer.zip!top.jpg'])
+        for path in files.values():
+            self.assertTrue(os.path.isfile(path))
+
+    def test_depth_limit(self):
+        with ArchiveEngine(self.cache, max_depth=0) as engine:
+            engine.unpack([self.outer])
+            names = [os.path.relpath(x, self.engine_dir) for x in dict(engine.files(self.outer))]
+        self.assertEqual(sorted(names), [os.path.join('outer.zip!nested', 'inner.zip'),
+                                         'outer.zip!top.jpg'])
+
+    def test_cache(self):
+        with ArchiveEngine(self.cache) as engine:
+            engine.unpack([self.outer])
+        with ArchiveEngine(self.cache) as engine:
+            dirs = engine.unpack([self.renamed, self.outer])
+            self.assertEqual(engine.unpacked, 0)
+            self.assertEqual(dirs[self.renamed], dirs[self.outer])
+
+    def test_lost_race(self):
+        from unittest import mock
+        rename = os.rename
+
+        def unpacked_meanwhile(src, dst):
+            # Another run renames its copy into place first
+            make_folder(dst)
+            with open(os.path.join(dst, 'top.jpg'), 'wb'):
+                pass
+            rename(src, dst)
+
+        cache = os.path.join(self.engine_dir, 'race_cache')
+        shutil.rmtree(cache, ignore_errors=True)
+        with ArchiveEngine(cache, max_depth=0) as engine, \
+                mock.patch('os.rename', unpacked_meanwhile):
+            dirs = engine.unpack([self.outer])
+            self.assertEqual(engine.unpacked, 0)
+        self.assertTrue(os.path.isdir(dirs[self.outer]))
+        self.assertEqual(os.listdir(engine.temp_dir), [])
+
+    def test_bad_archive(self):
+        bad = os.path.join(self.engine_dir, 'bad.zip')
+        with open(bad, 'wb') as f:
+            f.write(b'not a zip')
+        with ArchiveEngine(self.cache) as engine:
+            self.assertIsNone(engine.unpack([bad])[bad])
+            self.assertEqual(list(engine.files(bad)), [])
+
+
+class Test23_IOScheduler(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.io_dir = os.path.join(TEST_ROOT, 'io_scheduler')
+        make_folder(cls.io_dir)
+        for n in range(12):
+            with open(os.path.join(cls.io_dir, f'{n:02}.jpg'), 'wb') as f:
+                f.write(bytes([n]) * 1000)
+
+    def _files(self):
+        return Collect(self.io_dir).files
+
+    def test_device_kind(self):
+        self.assertIn(device_kind(os.stat(self.io_dir).st_dev),
+                      ('hdd', 'ssd', 'network', 'unknown'))
+
+    def test_policies(self):
+        dev = os.stat(self.io_dir).st_dev
+        scheduler = IOScheduler({'hdd': 3}, devices={self.io_dir: Policy(1, 'inode')})
+        self.assertEqual(scheduler.policies['hdd'], Policy(3, 'extent'))
+        self.assertEqual(scheduler.policy(dev), Policy(1, 'inode'))
+        self.assertEqual(IOScheduler(devices={dev: 'ssd'}, streams=2).policy(dev).streams, 2)
+        self.assertRaises(ValueError, IOScheduler, {'hdd': Policy(1, 'random')})
+
+    def test_read_order(self):
+        files = self._files()
+        files.reverse()
+        scheduler = IOScheduler(devices={self.io_dir: Policy(1, 'inode')})
+        order = []
+        results = HashPool(4, scheduler=scheduler).apply(
+            lambda file: order.append(file.stats.st_ino) or file.hash, files)
+        self.assertEqual(order, sorted(order))
+        self.assertEqual(results, [File(x.file_path).hash for x in files])
+
+    def test_streams(self):
+        scheduler = IOScheduler(devices={self.io_dir: Policy(2, 'found')})
+        self.assertEqual(self._max_streams(HashPool(8, scheduler=scheduler)), 2)
+
+    def _max_streams(self, pool: HashPool) -> int:
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def read(file):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return file.hash
+
+        pool.apply(read, self._files())
+        return running[1]
+
+    def test_unknown_device(self):
+        # Not held back: as many streams as jobs
+        scheduler = IOScheduler(devices={self.io_dir: 'unknown'})
+        self.assertIsNone(scheduler.policy(os.stat(self.io_dir).st_dev).streams)
+        self.assertEqual(self._max_streams(HashPool(6, scheduler=scheduler)), 6)
+
+    def test_extent_order(self):
+        keyed = []
+
+        class Scheduler(IOScheduler):
+            def sort_key(self, file, policy):
+                keyed.append(threading.current_thread())
+                return -file.stats.st_ino
+
+        scheduler = Scheduler(devices={self.io_dir: Policy(1, 'extent')})
+        order = []
+        HashPool(4, scheduler=scheduler).apply(
+            lambda file: order.append(file.stats.st_ino) or file.hash, self._files())
+        self.assertEqual(order, sorted(order, reverse=True))
+        self.assertEqual(len(keyed), 12)
+        self.assertNotIn(threading.current_thread(), keyed)
+
+    def test_collect_scheduler(self):
+        scheduler = IOScheduler(streams=1)
+        collection = Collect(self.io_dir, scheduler=scheduler)
+        self.assertEqual(collection.hash_all(jobs=4),
+                         [File(x.file_path).hash for x in collection.files])
+
+
+class Test24_Journal(CommonTest):
+    """Runs interrupted, then resumed"""
+
+    def setUp(self):
+        self.tree = os.path.join(TEST_ROOT, 'journal_tree')
+        shutil.rmtree(self.tree, ignore_errors=True)
+        self.roots = [os.path.join(self.tree, x) for x in ('a', 'b')]
+        for n, root in enumerate(self.roots):
+            make_folder(root)
+            for m in range(4):
+                with open(os.path.join(root, f'{m}.jpg'), 'wb') as f:
+                    f.write(bytes([n, m]) * 500)
+        self.journal_path = os.path.join(self.tree, 'run.journal')
+
+    def _interrupted_run(self):
+        """Hash the files of the first root, then stop as if interrupted"""
+        with Collect(self.roots, journal=self.journal_path) as collection:
+            for file in collection.files[:4]:
+                file.hash
+        return collection
+
+    def test_resume_hashes(self):
+        self._interrupted_run()
+        metrics = Metrics()
+        with Collect(self.roots, journal=self.journal_path, resume=True,
+                     metrics=metrics) as collection:
+            self.assertTrue(collection.journal.resumed)
+            hashes = collection.hash_all()
+        self.assertEqual(metrics.counters['files_hashed'], 4)
+        self.assertEqual(metrics.counters['cache_hits'], 4)
+        self.assertEqual(hashes, [File(x.file_path).hash for x in collection.files])
+
+    def test_resume_walk(self):
+        self._interrupted_run()
+        with open(os.path.join(self.roots[0], 'new.jpg'), 'wb') as f:
+            f.write(b'new')
+        with Collect(self.roots, journal=self.journal_path, resume=True) as collection:
+            self.assertEqual(len(collection.files), 8)
+        with Collect(self.roots, journal=self.journal_path) as collection:
+            self.assertEqual(len(collection.files), 9)
+
+    def test_resume_mid_walk(self):
+        from unittest import mock
+        root = self.roots[0]
+        for n in range(4):
+            make_folder(os.path.join(root, f's{n}'))
+            for m in range(2):
+                with open(os.path.join(root, f's{n}', f'{m}.jpg'), 'wb') as f:
+                    f.write(bytes([n, m]) * 100)
+        list_dir = Collect._list_dir
+        listed = []
+
+        def interrupted(collection, dir_path):
+            # Stop on listing the third subfolder, the first two being walked
+            if len(listed) == 3:
+                raise KeyboardInterrupt
+            listed.append(dir_path)
+            return list_dir(collection, dir_path)
+
+        with Journal(self.journal_path, [root]) as journal, \
+                mock.patch.object(Collect, '_list_dir', interrupted):
+            self.assertRaises(KeyboardInterrupt, Collect, root, recursive=True, journal=journal)
+        with open(os.path.join(root, 's0', 'new.jpg'), 'wb') as f:
+            f.write(b'new')
+        metrics = Metrics()
+        with Collect(root, recursive=True, journal=self.journal_path, resume=True,
+                     metrics=metrics) as collection:
+            self.assertEqual(len(collection.files), 13)
+        # The folder changed since and the two not walked
+        self.assertEqual(metrics.counters['dirs_listed'], 3)
+
+    def test_changed_file(self):
+        self._interrupted_run()
+        changed = os.path.join(self.roots[0], '0.jpg')
+        with open(changed, 'ab') as f:
+            f.write(b'more')
+        with Collect(self.roots, journal=self.journal_path, resume=True) as collection:
+            file = next(x for x in collection.files if x.file_path == changed)
+            self.assertEqual(file.hash, File(changed).hash)
+
+    def test_cut_record(self):
+        self._interrupted_run()
+        with open(self.journal_path, 'a') as f:
+            f.write('{"hash": ["/cut sh')
+        with Journal(self.journal_path, self.roots, resume=True) as journal:
+            self.assertTrue(journal.resumed)
+            self.assertEqual(len(journal.files(self.roots[0])), 4)
+
+    def test_other_run(self):
+        self._interrupted_run()
+        with Journal(self.journal_path, self.roots, 'sha256', resume=True) as journal:
+            self.assertFalse(journal.resumed)
+            self.assertIsNone(journal.files(self.roots[0]))
+
+    def test_resume_extract(self):
+        archive_path = os.path.join(self.tree, 'photos.zip')
+        with zipfile.ZipFile(archive_path, 'w') as z:
+            z.writestr('x.jpg', b'x' * 100)
+        extract_dir = os.path.join(self.tree, 'extracted')
+        with Collect(archive_path, journal=self.journal_path, extract=extract_dir) as collection:
+            paths = collection.extract_unique()
+        os.remove(paths[0])
+        with open(paths[0], 'wb') as f:
+            f.write(b'kept')
+        with Collect(archive_path, journal=self.journal_path, extract=extract_dir,
+                     resume=True) as collection:
+            self.assertEqual(collection.extract_unique(), paths)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), b'kept')
+
+    def test_copy_interrupted(self):
+        from unittest import mock
+        src = File(os.path.join(self.roots[0], '0.jpg'))
+        dst = os.path.join(self.tree, 'copy.jpg')
+
+        def copy(src_path, dst_path):
+            with open(dst_path, 'wb') as f:
+                f.write(b'partial')
+            raise KeyboardInterrupt
+
+        with mock.patch('shutil.copy', copy):
+            self.assertRaises(KeyboardInterrupt, src.copy_to, dst)
+        self.assertFalse(os.path.exists(dst))
+
+
+class Test25_QueryIndex(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.query_dir = os.path.join(TEST_ROOT, 'query_index')
+        shutil.rmtree(cls.query_dir, ignore_errors=True)
+        folders = {'2019-07-14 Hillsboro': [b'a' * 100, b'b' * 200],
+                   os.path.join('Pix', '2019', 'Beach trip'): [b'a' * 100],
+                   '201907_': [b'c' * 300],
+                   'Misc': [b'd' * 400]}
+        for folder, datas in folders.items():
+            make_folder(os.path.join(cls.query_dir, folder))
+            for n, data in enumerate(datas):
+                with open(os.path.join(cls.query_dir, folder, f'{n}.jpg'), 'wb') as f:
+                    f.write(data)
+        make_exif_jpeg(os.path.join(cls.query_dir, 'Misc', 'exif.jpg'), '2019:07:20 10:00:00')
+        cls.collection = Collect(cls.query_dir, recursive=True)
+        cls.collection.hash_all()
+        cls.index = cls.collection.query_index(exif=True)
+
+    def _names(self, files):
+        return sorted(os.path.relpath(x.file_path, self.query_dir) for x in files)
+
+    def test_period(self):
+        self.assertEqual(period('202110_'), (datetime(2021, 10, 1), datetime(2021, 11, 1)))
+        self.assertEqual(period('Trip 1999.12.31')[1], datetime(2000, 1, 1))
+        self.assertIsNone(period('Hillsboro 09'))
+        self.assertIsNone(period('20190230'))
+
+    def test_dated(self):
+        self.assertEqual(self._names(self.index.dated('2019-07')),
+                         [os.path.join('2019-07-14 Hillsboro', '0.jpg'),
+                          os.path.join('2019-07-14 Hillsboro', '1.jpg'),
+                          os.path.join('201907_', '0.jpg'),
+                          os.path.join('Misc', 'exif.jpg')])
+        self.assertEqual(len(self.index.dated('2019')), 5)
+        self.assertEqual(len(self.index.dated('2019-07-14')), 2)
+        self.assertEqual(self.index.dated('2018'), [])
+        self.assertRaises(ValueError, self.index.dated, 'July')
+
+    def test_copies(self):
+        digest = hashlib.sha1(b'a' * 100).hexdigest()
+        self.assertEqual(self._names(self.index.copies(digest)),
+                         [os.path.join('2019-07-14 Hillsboro', '0.jpg'),
+                          os.path.join('Pix', '2019', 'Beach trip', '0.jpg')])
+        self.assertEqual(len(self.index.sized(200)), 1)
+
+    def test_under(self):
+        self.assertEqual(self._names(self.index.under(os.path.join(self.query_dir, 'Pix'))),
+                         [os.path.join('Pix', '2019', 'Beach trip', '0.jpg')])
+        self.assertEqual(len(self.index.under(self.query_dir)), len(self.collection.files))
+        # A folder name is not a prefix of its sibling's
+        self.assertEqual(self.index.under(os.path.join(self.query_dir, 'Mis')), [])
+
+    def test_activity(self):
+        self.assertEqual(len(self.index.activity('hillsboro')), 2)
+        self.assertEqual(len(self.index.activity('Beach')), 1)
+        self.assertIn('trip', self.index.activities())
+
+
+class Test26_ExternalDedup(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.ext_dir = os.path.join(TEST_ROOT, 'external_dedup')
+        shutil.rmtree(cls.ext_dir, ignore_errors=True)
+        for sub in ('a', 'b', 'c'):
+            make_folder(os.path.join(cls.ext_dir, sub))
+            for n in range(20):
+                # Same sizes with different content, and copies across folders
+                data = bytes([n % 7]) * (1000 + n % 5) if sub != 'c' else bytes([n]) * 1000
+                with open(os.path.join(cls.ext_dir, sub, f'{n}.jpg'), 'wb') as f:
+                    f.write(data)
+        with zipfile.ZipFile(os.path.join(cls.ext_dir, 'c', 'old.zip'), 'w') as z:
+            z.writestr('copy.jpg', bytes([3]) * 1003)
+
+    def test_same_as_dedup(self):
+        dedup = Collect(self.ext_dir, recursive=True, archives=True).dedup()
+        expected = {x.file_path: dedup.original[x.file_path].file_path for x in dedup.duplicates}
+        lists = os.path.join(TEST_ROOT, 'external_dedup_lists')
+        collection = Collect(self.ext_dir, recursive=True, archives=True, lazy=True)
+        self.assertEqual(collection.dedup_to(lists, memory=2000),
+                         (len(dedup.unique), len(dedup.duplicates)))
+        with open(os.path.join(lists, 'duplicates.txt')) as f:
+            found = dict(line.rstrip('\n').split('\t') for line in f)
+        self.assertEqual(found, expected)
+        with open(os.path.join(lists, 'unique.txt')) as f:
+            self.assertEqual(sorted(f.read().split('\n')[:-1]),
+                             sorted(x.file_path for x in dedup.unique))
+
+    def test_runs(self):
+        files = Collect(self.ext_dir, recursive=True).files
+        dedup = ExternalDedup(memory=1000)
+        results = list(dedup.run(iter(files)))
+        self.assertEqual(dedup.records, len(files))
+        self.assertGreater(dedup.runs, 3)
+        self.assertEqual(len(results), len(files))
+        sizes = [os.path.getsize(path) for path, _ in results]
+        self.assertEqual(sizes, sorted(sizes))
+
+    def test_large_group(self):
+        folder = os.path.join(TEST_ROOT, 'external_dedup_group')
+        make_folder(folder)
+        # A single size group of files sharing their partial hash three by three, five of them
+        # copies of two contents
+        for n in range(30):
+            data = bytearray(20000)
+            data[10000] = n // 5 if n < 5 else n
+            data[0] = n // 3
+            with open(os.path.join(folder, f'{n:02}.jpg'), 'wb') as f:
+                f.write(data)
+        collection = Collect(folder)
+        files = collection.files
+        dedup = collection.dedup()
+        expected = {x.file_path: dedup.original[x.file_path].file_path for x in dedup.duplicates}
+        external = ExternalDedup(memory=3000, pool=HashPool(2))
+        results = list(external.run(iter(files)))
+        self.assertEqual({x: y for x, y in results if y is not None}, expected)
+        self.assertEqual(sorted(x for x, y in results if y is None),
+                         sorted(x.file_path for x in dedup.unique))
+        # Besides the runs of records, the group was spilled to runs of partial and full hashes
+        self.assertGreater(external.runs, 10)
+
+    def test_newline_names(self):
+        folder = os.path.join(TEST_ROOT, 'external_dedup_newline')
+        shutil.rmtree(folder, ignore_errors=True)
+        make_folder(folder)
+        # A small group and a group large enough to be spilled, with names holding newlines
+        for n in range(12):
+            data = bytes([0]) * 3000 if n < 2 else bytes([n % 4]) * 4000
+            with open(os.path.join(folder, f'{n}\nline\t.jpg'), 'wb') as f:
+                f.write(data)
+        files = Collect(folder).files
+        results = dict(ExternalDedup(memory=500).run(iter(files)))
+        self.assertEqual(sorted(results), sorted(x.file_path for x in files))
+        self.assertEqual(results[os.path.join(folder, '1\nline\t.jpg')],
+                         os.path.join(folder, '0\nline\t.jpg'))
+        self.assertEqual(results[os.path.join(folder, '6\nline\t.jpg')],
+                         os.path.join(folder, '10\nline\t.jpg'))
+
+
+def _has_inotify() -> bool:
+    try:
+        Inotify().close()
+    except OSError:
+        return False
+    return True
+
+
+class Test27_Watch(CommonTest):
+
+    @classmethod
+    def extraSetUpClass(cls):
+        cls.watch_dir = os.path.join(TEST_ROOT, 'watch')
+
+    def setUp(self):
+        shutil.rmtree(self.watch_dir, ignore_errors=True)
+        make_folder(os.path.join(self.watch_dir, 'old'))
+        for n in range(3):
+            self._write(os.path.join('old', f'{n}.jpg'), bytes([n]) * 2000)
+        self._write('note.txt', b'text')
+
+    def _write(self, rel_path, data: bytes):
+        with open(os.path.join(self.watch_dir, rel_path), 'wb') as f:
+            f.write(data)
+
+    def _start(self, **kwargs):
+        """Run a watcher on a thread; return the queue of its results"""
+        collection = Collect(self.watch_dir, ['jpg'], recursive=True, lazy=True)
+        watcher = collection.watch(settle=0.3, **kwargs)
+        results = queue.Queue()
+
+        def run():
+            for result in watcher.run():
+                results.put(result)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.addCleanup(watcher.close)
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(watcher.stop)
+        return watcher, results
+
+    def _take(self, results, count, timeout=10.0) -> {str: str}:
+        """Take count results, as relative paths with that of the original, if any"""
+        taken = {}
+        for _ in range(count):
+            file, original = results.get(timeout=timeout)
+            taken[os.path.relpath(file.file_path, self.watch_dir)] = (
+                os.path.relpath(original.file_path, self.watch_dir) if original else None)
+        return taken
+
+    def check_changes(self, **kwargs):
+        watcher, results = self._start(**kwargs)
+        self.assertEqual(self._take(results, 3), {os.path.join('old', f'{n}.jpg'): None
+                                                  for n in range(3)})
+        make_folder(os.path.join(self.watch_dir, 'trip'))
+        self._write(os.path.join('trip', 'copy.jpg'), bytes([1]) * 2000)
+        self._write('new.jpg', bytes([7]) * 2000)
+        self._write('new.txt', bytes([7]) * 2000)
+        self.assertEqual(self._take(results, 2), {
+            os.path.join('trip', 'copy.jpg'): os.path.join('old', '1.jpg'), 'new.jpg': None})
+
+        # The copy of a file removed is unique; a file changed is collected again
+        os.remove(os.path.join(self.watch_dir, 'old', '2.jpg'))
+        time.sleep(0.5)
+        self._write('again.jpg', bytes([2]) * 2000)
+        self._write('new.jpg', bytes([0]) * 2000)
+        self.assertEqual(self._take(results, 2), {'again.jpg': None,
+                                                  'new.jpg': os.path.join('old', '0.jpg')})
+        self.assertEqual(len(watcher.dedup), 5)
+
+        # A file being written is only collected once complete
+        with open(os.path.join(self.watch_dir, 'trip', 'slow.jpg'), 'wb') as f:
+            for _ in range(8):
+                f.write(b'x' * 1000)
+                f.flush()
+                time.sleep(0.1)
+        file, original = results.get(timeout=10)
+        self.assertEqual(file.file_name, 'slow.jpg')
+        self.assertEqual(file.size, 8000)
+        time.sleep(0.5)
+        self.assertTrue(results.empty())
+        return watcher
+
+    @unittest.skipUnless(_has_inotify(), "inotify not available")
+    def test_inotify(self):
+        watcher = self.check_changes()
+        self.assertFalse(watcher.polling)
+
+    def test_polling(self):
+        watcher = self.check_changes(polling=True, poll_interval=0.1)
+        self.assertTrue(watcher.polling)
+
+    def test_close_twice(self):
+        watcher = Collect(self.watch_dir, lazy=True).watch()
+        watcher.close()
+        watcher.close()
+        watcher.stop()
+
+    def test_incremental_dedup(self):
+        files = Collect(os.path.join(self.watch_dir, 'old'), ['jpg']).files
+        dedup = IncrementalDedup()
+        self.assertEqual([original for _, original in dedup.add_all(files)], [None] * 3)
+        copy = os.path.join(self.watch_dir, 'copy.jpg')
+        shutil.copyfile(files[0].file_path, copy)
+        self.assertIs(dedup.add(File(copy)), files[0])
+        # The copy takes the place of the original removed
+        self.assertIs(dedup.remove(files[0].file_path), files[0])
+        self.assertEqual(dedup.add(File(files[0].file_path)).file_path, copy)
+        self.assertEqual(len(dedup), 4)
+        os.remove(copy)
+
+
 class Test99_CommandLine(CommonTest):
     """
     Test command line options
@@ -2,32 +2,38 @@ import contextlib
 from copy import deepcopy
 from datetime import datetime
 from glob import glob
-import hashlib
+import mmap
 import os
 import re
 import shutil
 import sys
-import subprocess
-import traceback
-import unittest
-
-import py7zr
 
 # The "tools.py" library module is maintained under a Tools repository. However, it also needs to
 # be copied into this project repository so that its current state can be committed to the
 # project repository. The same is true for "sync_modules.py" which is a small module unlikely to
-# change frequently.
-import sync_modules
+# change frequently. Setting SYNC_MODULES=0 in the environment skips the synchronization, as on
+# machines without the Tools repository or for short-lived runs.
+if os.environ.get('SYNC_MODULES', '1') != '0':
+    import sync_modules
+
+# Modules only needed by some functions (py7zr, tempfile, traceback, unittest) are imported by
+# those functions, keeping the import of this module, and of everything using it, fast. So are
+# the modules of the photo collection project (hashers, metadata) used by File, as other
+# projects share this module without them.
 
 
 PROGRAM_DIR, PROGRAM_FILE_NAME = os.path.split(sys.argv[0])
 PROGRAM_ABS_DIR = os.path.abspath(PROGRAM_DIR)
 PROGRAM_NAME = os.path.splitext(PROGRAM_FILE_NAME)[0]
 
-C_ROOT = list(filter(lambda x: os.path.isdir(x + os.sep + 'Windows'), ['/mnt/c', '/c', 'C:']))[0]
-C_ROOT += os.sep
 IS_WINDOWS = 'win' in sys.platform
 
+# Bytes read from each end of a file for its partial hash
+PARTIAL_HASH_BLOCK = 4096
+
+# Bytes of a file examined for metadata when the file cannot be memory-mapped
+METADATA_BLOCK = 1024 * 1024
+
 
 class Error:
     def __init__(self, msg, exit=True, trace=False):
@@ -35,6 +41,7 @@ class Error:
             msg += ' -- program terminated'
         print(f"ERROR: {msg}")
         if trace:
+            import traceback
             traceback.print_stack()
         if exit:
             sys.exit(2)
@@ -110,17 +117,27 @@ def _getTestCaseNames(self, test_class):
 
 
 def rewire_unittest():
+    import unittest
     setattr(unittest.TestLoader, 'getTestCaseNames', _getTestCaseNames)
 
 
+def _register_7zip():
+    """Register the 7z format with shutil, once per process"""
+    if not any(name == '7zip' for name, *_ in shutil.get_unpack_formats()):
+        import py7zr
+        shutil.register_unpack_format('7zip', ['.7z'], py7zr.unpack_7zarchive)
+
+
 def unpack_archive(src_archive_file:str, dst_dir:str):
     """Unpack an archive file into the destination directory--may be 7z, 7zip, zip, or other 
     format"""
-    shutil.register_unpack_format('7zip', ['.7z'], py7zr.unpack_7zarchive)
+    if src_archive_file.lower().endswith('.7z'):
+        _register_7zip()
     shutil.unpack_archive(src_archive_file, dst_dir)
 
 def pack_archive(dst_archive_file:str, files:[]):
     """Create an archive file--the extent indicates the format"""
+    import py7zr
     shutil.register_archive_format('7zip', ['7z'], py7zr.pack_7zarchive())
     dir_path, file_name = os.path.split(dst_archive_file)
     base_name, format = os.path.splitext(file_name)
@@ -128,6 +145,24 @@ def pack_archive(dst_archive_file:str, files:[]):
         format = format[1:]
     shutil.make_archive(base_name, format)
 
+def _c_root() -> str:
+    """The Windows system drive root, as seen from Windows, WSL or MSYS; the temporary folder
+    where there is none"""
+    import tempfile
+    for root in ('/mnt/c', '/c', 'C:'):
+        if os.path.isdir(root + os.sep + 'Windows'):
+            return root + os.sep
+    return os.path.join(tempfile.gettempdir(), '')
+
+
+def __getattr__(name):
+    """Module attributes computed on first use: C_ROOT probes the file system"""
+    if name == 'C_ROOT':
+        globals()['C_ROOT'] = value = _c_root()
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class SingletonPattern:
     """Singleton Pattern decorator"""
     _instance = None
@@ -143,25 +178,53 @@ class SingletonPattern:
 
 
 class File:
-    """Generic file handler"""
+    """Generic file handler
+
+    A collection may hold millions of files, so a File keeps its attributes in slots rather than
+    a per-instance dict, holds its folder path as an interned string shared by all files of the
+    folder, and derives the full path and base name instead of storing them.
+    """
+    __slots__ = ('dir_path', 'file_name', 'ext', '_exists', '_is_dir', '_is_file', '_hash',
+                 '_partial_hash', '_exif', '_stats', '_cache', '_metrics', '_hasher')
+
     def __init__(self, file_path, dir_path=None):
         """file_path is just the file name if dir_path is specified"""
         if dir_path:
-            self.file_path = os.path.abspath(os.path.join(dir_path, file_path))
-            self.dir_path = dir_path
-            self.file_name = file_path
-        else:
-            self.file_path = os.path.abspath(file_path)
-            self.dir_path, self.file_name = os.path.split(self.file_path)
-        self.name, self.ext = os.path.splitext(self.file_name)
+            file_path = os.path.join(dir_path, file_path)
+        dir_path, self.file_name = os.path.split(os.path.abspath(file_path))
+        self.dir_path = sys.intern(dir_path)
+        self.ext = os.path.splitext(self.file_name)[1]
         self._exists = None
         self._is_dir = None
         self._is_file = None
         self._hash = None
+        self._partial_hash = None
+        self._exif = None
         self._stats = None
+        self._cache = None
+        self._metrics = None
+        self._hasher = None
+
+    @classmethod
+    def from_stats(cls, file_path, stats: os.stat_result = None):
+        """Create a File known to be a regular file, with stats already obtained, if any"""
+        file = cls(file_path)
+        file._is_file = True
+        file._is_dir = False
+        file._exists = True
+        file._stats = stats
+        return file
 
     def __str__(self):
         return f"{self.file_name} -- {self.file_path}"
+
+    @property
+    def file_path(self):
+        return os.path.join(self.dir_path, self.file_name)
+
+    @property
+    def name(self):
+        return os.path.splitext(self.file_name)[0]
         
     @property
     def is_dir(self):
@@ -187,26 +250,144 @@ class File:
             self._exists = self._is_dir or self._is_file
         return self._exists
 
+    @property
+    def hasher(self) -> 'Hasher':
+        """Hash algorithm and read strategy of the file, SHA-1 unless set by its collection"""
+        if self._hasher is None:
+            from hashers import DEFAULT_HASHER
+            return DEFAULT_HASHER
+        return self._hasher
+
     @property
     def hash(self):
+        """Hex digest of the file content, by default SHA-1; a persistent hash cache, if attached,
+        is tried first and updated when the file has to be read"""
         if self._hash is None:
-            with open(self.file_path, 'rb') as f:
-                self._hash = hashlib.file_digest(f, 'sha1').hexdigest()
+            if self._cache is not None:
+                self._hash = self._cache.get(self)
+                if self._metrics is not None:
+                    self._metrics.count('cache_misses' if self._hash is None else 'cache_hits')
+                if self._hash is not None:
+                    return self._hash
+            self._hash = self.hasher.hash_file(self.file_path)
+            if self._metrics is not None:
+                self._counted_hash(self.size)
+            if self._cache is not None:
+                self._cache.put(self, self._hash)
+        return self._hash
+
+    async def ahash(self, executor=None) -> str:
+        """Hash value obtained without blocking the event loop: the file is read on an executor
+        thread, by default the loop's default executor"""
+        if self._hash is None:
+            import asyncio
+            await asyncio.get_running_loop().run_in_executor(executor, getattr, self, 'hash')
         return self._hash
 
+    def _counted_hash(self, size):
+        """Count a hash computed over size bytes of the file in the attached metrics"""
+        self._metrics.count('files_hashed')
+        self._metrics.count('bytes_hashed', size)
+
+    def scan(self):
+        """Read the file once to obtain both its hash and its metadata
+
+        The file is memory-mapped so that the hash is computed over the whole content while the
+        metadata is parsed in place from the same pages, without a second read. A file that
+        cannot be mapped (empty, or on a file system without mmap support) is streamed instead,
+        with metadata taken from its first METADATA_BLOCK bytes.
+        """
+        import metadata
+        if self._hash is None and self._cache is not None:
+            self._hash = self._cache.get(self)
+            if self._metrics is not None:
+                self._metrics.count('cache_misses' if self._hash is None else 'cache_hits')
+        with open(self.file_path, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                data = None
+            if data is not None:
+                with data:
+                    self._exif = metadata.parse(data)
+                    if self._hash is None:
+                        self._hash = self.hasher.new(data).hexdigest()
+                        if self._metrics is not None:
+                            self._counted_hash(len(data))
+                        if self._cache is not None:
+                            self._cache.put(self, self._hash)
+                return
+            block = f.read(METADATA_BLOCK)
+            self._exif = metadata.parse(block)
+            if self._hash is None:
+                digest = self.hasher.new(block)
+                while block := f.read(METADATA_BLOCK):
+                    digest.update(block)
+                self._hash = digest.hexdigest()
+                if self._metrics is not None:
+                    self._counted_hash(f.tell())
+                if self._cache is not None:
+                    self._cache.put(self, self._hash)
+
+    @property
+    def exif(self) -> dict:
+        """EXIF tags of a photo, or the creation time of a video; empty when none are found"""
+        if self._exif is None:
+            self.scan()
+        return self._exif
+
+    @property
+    def taken_at(self) -> datetime | None:
+        """Date and time the photo or video was taken, according to its metadata"""
+        import metadata
+        return metadata.taken_at(self.exif)
+
+    @property
+    def partial_hash(self):
+        """Hash of the first and last PARTIAL_HASH_BLOCK bytes of the file
+
+        A file no larger than two blocks is read whole, in which case the partial hash is also
+        its full hash.
+        """
+        if self._partial_hash is None:
+            with open(self.file_path, 'rb') as f:
+                digest = self.hasher.new(f.read(PARTIAL_HASH_BLOCK))
+                whole = self.size <= 2 * PARTIAL_HASH_BLOCK
+                if not whole:
+                    f.seek(-PARTIAL_HASH_BLOCK, os.SEEK_END)
+                digest.update(f.read())
+                if self._metrics is not None:
+                    self._metrics.count('bytes_hashed', min(self.size, 2 * PARTIAL_HASH_BLOCK))
+            self._partial_hash = digest.hexdigest()
+            if whole and self._hash is None:
+                self._hash = self._partial_hash
+        return self._partial_hash
+
+    @property
+    def size(self):
+        return self.stats.st_size
+
     @property
     def stats(self):
         if self._stats is None:
-            self._stats = os.stats(self.file_path)
+            self._stats = os.stat(self.file_path)
         return self._stats
 
     def copy_to(self, dst_path):
-        """Copy file to destination path"""
+        """Copy file to destination path
+
+        An interruption (KeyboardInterrupt) is passed on to the caller, so that the run can be
+        checkpointed and ended gracefully, once the partial copy is removed.
+        """
         try:
             shutil.copy(self.file_path, dst_path)
         except PermissionError:
             Error(f"Copy {self.file_name} to {dst_path} -- no permission")
         except KeyboardInterrupt:
-            Error(f"Copy {self.file_name} to {dst_path} -- Keyboard interrupt")
+            if os.path.isdir(dst_path):
+                dst_path = os.path.join(dst_path, self.file_name)
+            if os.path.isfile(dst_path):
+                os.remove(dst_path)
+            raise
         except Exception as exc:
             Error(f"Copy {self.file_name} to {dst_path} -- {exc}")
@@ -0,0 +1,509 @@
+#!/usr/bin/python3
+"""
+"watch.py" Watch mode: collect files as they arrive
+
+Camera uploads and cloud sync folders receive new files all day; collecting them again on a
+schedule would walk millions of unchanged files every time. A Watcher walks the collection paths
+once, then waits for changes to the folders walked and collects only the files new or changed:
+    * On Linux, the folders are watched through inotify, the kernel telling of each file
+      created, written, moved or deleted, so that waiting costs no CPU at all
+    * Elsewhere, or once the inotify watches run out (fs.inotify.max_user_watches), the
+      modification times of the folders are polled every few seconds and the folders changed
+      are listed again -- which notices files added, replaced or removed, but not a file
+      rewritten in place
+A file is only collected once it has settled: left unchanged in size and modification time for a
+few seconds, so that a file still being written or downloaded is not hashed half-way. The files
+new or changed are hashed and deduplicated against those already known as they settle, by an
+IncrementalDedup (see dedup.py); files removed are forgotten.
+"""
+import errno
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from archive import ArchiveMember, is_archive
+from dedup import Dedup, IncrementalDedup
+from hash_pool import HashPool
+from metrics import stage
+from tools import File
+
+if TYPE_CHECKING:
+    from collect import Collect
+
+# Seconds a file must be left unchanged before it is collected, and between polls of the folders
+# when they are not watched through inotify
+SETTLE_TIME = 2.0
+POLL_INTERVAL = 5.0
+
+# inotify events, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+# Header of an inotify event: watch descriptor, mask, cookie and length of the name that follows
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """An inotify instance, through the C library; OSError is raised where not available"""
+    def __init__(self):
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            self._init = libc.inotify_init1
+            self._add = libc.inotify_add_watch
+            self._rm = libc.inotify_rm_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available") from None
+        self._add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._get_errno = ctypes.get_errno
+        self.fd = self._init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, file_path=None):
+        code = self._get_errno()
+        raise OSError(code, os.strerror(code), file_path)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add(self, dir_path) -> int:
+        """Watch a folder; return its watch descriptor"""
+        wd = self._add(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            self._raise(dir_path)
+        return wd
+
+    def remove(self, wd: int):
+        """Stop watching a folder; a folder removed is no longer watched anyway"""
+        self._rm(self.fd, wd)
+
+    def read(self) -> [(int, int, str)]:
+        """Return the events waiting, as (watch descriptor, mask, name) tuples"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Watcher:
+    """Collects the files of a Collect's paths, then the files new or changed as they settle
+
+    collect       -- Collect choosing the paths and files, and how they are hashed; best a lazy
+                     one, the Watcher walking the paths itself
+    jobs          -- number of threads hashing files
+    settle        -- seconds a file must be left unchanged before it is collected
+    poll_interval -- seconds between polls of the folders, when not watched through inotify
+    polling       -- poll the folders even where inotify is available
+
+    Only folders are watched: a collection path that is a file is collected once.
+    """
+    def __init__(self, collect: 'Collect', jobs: int = None, settle: float = SETTLE_TIME,
+                 poll_interval: float = POLL_INTERVAL, polling=False):
+        self.collect = collect
+        self.pool = HashPool(jobs, scheduler=collect.scheduler)
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.dedup: IncrementalDedup = None
+        # Folders walked, with their path relative to the collection path, depth, and whether
+        # their files are wanted
+        self._dirs: {str: (str, int, bool)} = {}
+        # Names of the files collected, by folder; an archive stands for its members
+        self._by_dir: {str: set} = {}
+        # Size and modification time of the archives collected, and the paths of their members
+        self._archives: {str: ((int, int), [str])} = {}
+        # Files waiting to settle: when to look at them next, and their size and modification
+        # time when last looked at
+        self._pending: {str: (float, (int, int))} = {}
+        self._inotify = None
+        self._wds: {int: str} = {}
+        self._dir_wds: {str: int} = {}
+        self._mtimes: {str: int} = {}
+        self._polled = time.monotonic()
+        if not polling:
+            try:
+                self._inotify = Inotify()
+            except OSError:
+                pass
+        self._stopped = threading.Event()
+        self._stop_r, self._stop_w = os.pipe()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def polling(self) -> bool:
+        """Whether the folders are polled rather than watched through inotify"""
+        return self._inotify is None
+
+    def stop(self):
+        """Make run() return, from any thread"""
+        self._stopped.set()
+        if self._stop_w < 0:
+            # Closed already
+            return
+        os.write(self._stop_w, b'.')
+
+    def close(self):
+        self.stop()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        if self._stop_r >= 0:
+            os.close(self._stop_r)
+            os.close(self._stop_w)
+            self._stop_r = self._stop_w = -1
+
+    def run(self, initial=True):
+        """Generate each file with the earlier file it duplicates, or None when unique so far:
+        the files found walking the collection paths, unless not initial, then the files new or
+        changed as they settle, until stop() is called"""
+        collect = self.collect
+        collect._on_dir = self._watch_dir
+        try:
+            files = []
+            with stage(collect.metrics, 'walk'):
+                for dir_path in collect.paths:
+                    for file in collect._iter_path(dir_path):
+                        if collect.index is not None:
+                            collect.index.add(file)
+                        files.append(file)
+            with stage(collect.metrics, 'dedup'):
+                dedup = Dedup(files, self.pool)
+                if collect.index is not None:
+                    for file in files:
+                        collect.index.set_hashes(file)
+                    collect.index.resolve(self.pool, files)
+            self.dedup = IncrementalDedup(dedup)
+            for file in files:
+                self._record(file)
+            if initial:
+                for file in files:
+                    yield file, dedup.original.get(file.file_path)
+            del files, dedup
+            while not self._stopped.is_set():
+                batch = self._wait()
+                if not batch:
+                    continue
+                with stage(collect.metrics, 'watch'):
+                    results = self.dedup.add_all(batch, self.pool)
+                    for file, _ in results:
+                        self._record(file)
+                        if collect.index is not None:
+                            collect.index.add(file)
+                    self._flush()
+                if collect.metrics is not None:
+                    collect.metrics.count('files_watched', len(results))
+                yield from results
+        finally:
+            collect._on_dir = None
+
+    def _flush(self):
+        """Write back the hash values of the files collected"""
+        if self.collect.hash_cache is not None:
+            self.collect.hash_cache.flush()
+        if self.collect.index is not None:
+            self.collect.index.flush()
+
+    def _wait(self) -> [File]:
+        """Wait for files to settle, or for stop(); return the files settled, if any"""
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            files = self._settled(now)
+            if files:
+                return files
+            timeout = min(x for x, _ in self._pending.values()) - now if self._pending else None
+            if self._inotify is None:
+                poll_time = self._polled + self.poll_interval - now
+                timeout = poll_time if timeout is None else min(timeout, poll_time)
+            waited = [self._stop_r] + ([self._inotify] if self._inotify is not None else [])
+            ready = select.select(waited, [], [], None if timeout is None else max(0, timeout))[0]
+            if self._inotify is not None and self._inotify in ready:
+                self._read_events()
+            if self._inotify is None and time.monotonic() >= self._polled + self.poll_interval:
+                self._poll()
+        return []
+
+    def _settled(self, now: float) -> [File]:
+        """Collect the files pending that are due and have settled"""
+        files = []
+        for path, (due, seen) in list(self._pending.items()):
+            if due > now:
+                continue
+            try:
+                stats = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            key = (stats.st_size, stats.st_mtime_ns)
+            # First looked at: settled if not modified for a while; then, if left unchanged
+            if key != seen and (seen is not None or time.time() - stats.st_mtime < self.settle):
+                self._pending[path] = (now + self.settle, key)
+                continue
+            del self._pending[path]
+            if stat.S_ISREG(stats.st_mode) and not self._known(path, stats):
+                files += self._collect_file(path, stats)
+        return files
+
+    def _known(self, path, stats: os.stat_result) -> bool:
+        """Whether a file was collected, and is unchanged since"""
+        key = (stats.st_size, stats.st_mtime_ns)
+        archive = self._archives.get(path)
+        if archive is not None:
+            return archive[0] == key
+        file = self.dedup.get(path)
+        return file is not None and (file.size, file.stats.st_mtime_ns) == key
+
+    def _collect_file(self, path, stats: os.stat_result) -> [File]:
+        """Return the files to collect for a file settled: itself, or an archive's members"""
+        collect = self.collect
+        name = os.path.basename(path)
+        if collect.archives and is_archive(name):
+            # Members may have been added or removed
+            self._remove(path)
+            return list(collect._iter_archive(path))
+        file_filter = collect.filter
+        if not file_filter.wants_name(name) or (
+                file_filter.sized and not file_filter.wants_size(stats.st_size)):
+            return []
+        return [collect._attach(File.from_stats(path, stats))]
+
+    def _record(self, file: File):
+        """Record a file collected"""
+        path = file.file_path
+        if isinstance(file, ArchiveMember):
+            archive_stats = file.archive.stats
+            path = file.archive.archive_path
+            archive = self._archives.setdefault(
+                path, ((archive_stats.st_size, archive_stats.st_mtime_ns), []))
+            archive[1].append(file.file_path)
+        dir_path, name = os.path.split(path)
+        self._by_dir.setdefault(dir_path, set()).add(name)
+
+    def _remove(self, path):
+        """Forget a file removed, or an archive and its members"""
+        self._pending.pop(path, None)
+        dir_path, name = os.path.split(path)
+        names = self._by_dir.get(dir_path)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self._by_dir[dir_path]
+        archive = self._archives.pop(path, None)
+        for file_path in archive[1] if archive is not None else [path]:
+            self.dedup.remove(file_path)
+
+    def _watch_dir(self, dir_path, rel_path, depth, included):
+        """Watch a folder about to be listed by the walk"""
+        self._dirs[dir_path] = (rel_path, depth, included)
+        if self._inotify is not None:
+            try:
+                wd = self._inotify.add(dir_path)
+            except OSError as exc:
+                if exc.errno not in (errno.ENOSPC, errno.ENOMEM):
+                    # Gone already, or not readable: not walked either
+                    return
+                self._fall_back()
+            else:
+                self._wds[wd] = dir_path
+                self._dir_wds[dir_path] = wd
+                return
+        try:
+            self._mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            pass
+
+    def _fall_back(self):
+        """Poll the folders once out of inotify watches; all are listed again at the next poll,
+        for the changes made since they were walked"""
+        self._inotify.close()
+        self._inotify = None
+        self._wds.clear()
+        self._dir_wds.clear()
+        self._mtimes = dict.fromkeys(self._dirs, 0)
+
+    def _new_dir(self, dir_path):
+        """Walk a folder created, or moved in, under a folder walked; its files are pending"""
+        if dir_path in self._dirs or not self.collect.recursive:
+            return
+        parent, name = os.path.split(dir_path)
+        state = self._dirs.get(parent)
+        if state is None:
+            return
+        rel_path, depth, included = state
+        rel_path = f'{rel_path}/{name}' if rel_path else name
+        included = self.collect.filter.dir_state(name, rel_path, depth + 1, included)
+        if included is None:
+            return
+        now = time.monotonic()
+        for file in self.collect._walk(dir_path, rel_path, depth + 1, included):
+            self._pending.setdefault(file.file_path, (now, None))
+
+    def _forget_dir(self, dir_path):
+        """Forget a folder removed, or moved away, and everything under it"""
+        prefix = os.path.join(dir_path, '')
+        for path in [x for x in self._dirs if x == dir_path or x.startswith(prefix)]:
+            del self._dirs[path]
+            self._mtimes.pop(path, None)
+            wd = self._dir_wds.pop(path, None)
+            if wd is not None:
+                del self._wds[wd]
+                self._inotify.remove(wd)
+            for name in list(self._by_dir.get(path, ())):
+                self._remove(os.path.join(path, name))
+        for path in [x for x in self._pending if x.startswith(prefix)]:
+            del self._pending[path]
+
+    def _read_events(self):
+        now = time.monotonic()
+        for wd, mask, name in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: list every folder again
+                for dir_path in list(self._dirs):
+                    if dir_path in self._dirs:
+                        # Unless forgotten with a folder above it
+                        self._relist(dir_path)
+                continue
+            dir_path = self._wds.get(wd)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._wds[wd]
+                if self._dir_wds.get(dir_path) == wd:
+                    del self._dir_wds[dir_path]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # A collection path; other folders are forgotten on the events of their parent
+                self._forget_dir(dir_path)
+                continue
+            path = os.path.join(dir_path, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._new_dir(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._forget_dir(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._remove(path)
+            elif self._dirs[dir_path][2] and self.collect._wanted(name):
+                # A file moved in is complete; one being written is given time to settle
+                self._pending[path] = (now if mask & IN_MOVED_TO else now + self.settle, None)
+
+    def _poll(self):
+        """List again the folders whose modification time changed"""
+        self._polled = time.monotonic()
+        for dir_path in list(self._dirs):
+            if dir_path not in self._dirs:
+                # Forgotten with a folder above it
+                continue
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                self._forget_dir(dir_path)
+                continue
+            if mtime_ns != self._mtimes.get(dir_path):
+                self._mtimes[dir_path] = mtime_ns
+                self._relist(dir_path)
+
+    def _relist(self, dir_path):
+        """List a folder again: files new or changed are pending, files and folders no longer
+        there are forgotten, and new folders are walked"""
+        listing = self.collect._list_dir(dir_path)
+        if listing is None:
+            return
+        subdirs, files, _ = listing
+        if self.collect.recursive:
+            for name in subdirs:
+                self._new_dir(os.path.join(dir_path, name))
+            subdirs = set(subdirs)
+            for path in [x for x in self._dirs if os.path.dirname(x) == dir_path]:
+                if os.path.basename(path) not in subdirs:
+                    self._forget_dir(path)
+        now = time.monotonic()
+        names = set()
+        if self._dirs[dir_path][2]:
+            for name, stats in files:
+                if not self.collect._wanted(name):
+                    continue
+                names.add(name)
+                path = os.path.join(dir_path, name)
+                try:
+                    stats = stats or os.stat(path)
+                except OSError:
+                    continue
+                if path not in self._pending and not self._known(path, stats):
+                    self._pending[path] = (now, None)
+        for name in self._by_dir.get(dir_path, set()) - names:
+            self._remove(os.path.join(dir_path, name))
+
+
+def main(argv=None) -> int:
+    import argparse
+    from collect import Collect
+    parser = argparse.ArgumentParser(
+        description="Collect photo files as they arrive, printing each new unique file, or each "
+                    "duplicate with the file it duplicates")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--exts', nargs='*', help="extensions of the files collected")
+    parser.add_argument('--archives', action='store_true', help="collect zip and 7z members")
+    parser.add_argument('--hash-cache', help="hash cache database file, or its folder")
+    parser.add_argument('--jobs', type=int)
+    parser.add_argument('--settle', type=float, default=SETTLE_TIME,
+                        help="seconds a file must be left unchanged before it is collected")
+    parser.add_argument('--poll', type=float, metavar='SECONDS',
+                        help="poll the folders every SECONDS instead of watching them")
+    parser.add_argument('--all', action='store_true',
+                        help="also print the files found walking the paths")
+    args = parser.parse_args(argv)
+
+    with Collect(args.paths, args.exts, recursive=True, archives=args.archives,
+                 hash_cache=args.hash_cache, lazy=True) as collection, \
+            Watcher(collection, args.jobs, args.settle, args.poll or POLL_INTERVAL,
+                    polling=args.poll is not None) as watcher:
+        try:
+            for file, original in watcher.run(args.all):
+                print(file.file_path if original is None
+                      else f'{file.file_path}\t{original.file_path}', flush=True)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())